@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+from enum import IntFlag
+
+from blessed import Terminal
+
+
+class Capability(IntFlag):
+    """Optional terminal features that the video encoder can rely on.
+
+    The values must match the ones defined in `termblit`.
+    """
+
+    NONE = 0
+    REPEAT = 1
+    ERASE_CHARACTERS = 2
+    SCROLL_REGION = 4
+    RECTANGLES = 8
+
+
+# Extension reported in the primary device attributes (DA1) of the terminals
+# supporting the rectangular area operations, such as DECFRA
+RECTANGULAR_EDITING = 28
+
+# Delay after which the terminal is assumed not to answer the DA1 query
+DEVICE_ATTRIBUTES_TIMEOUT = 0.5
+
+
+def has_flag(term: Terminal, name: str) -> bool:
+    """Return whether the terminfo entry of the terminal sets the given boolean."""
+    return bool(term._jinxed_term.tigetflag(name) > 0)
+
+
+def detect_capabilities(term: Terminal) -> Capability:
+    """Detect the optional features of the terminal using its terminfo entry,
+    and its device attributes."""
+    capabilities = Capability.NONE
+    if not term.does_styling:
+        return capabilities
+    # REP (`CSI n b`) repeats the preceding graphic character
+    if term.rep:
+        capabilities |= Capability.REPEAT
+    # ECH (`CSI n X`) only uses the current background color if the
+    # terminal supports back color erase (bce)
+    if term.ech and has_flag(term, "bce"):
+        capabilities |= Capability.ERASE_CHARACTERS
+    # Scrolling region (DECSTBM) along with SU (`CSI n S`) and SD (`CSI n T`)
+    if term.csr and term.indn and term.rin:
+        capabilities |= Capability.SCROLL_REGION
+    # Rectangular fill (DECFRA) is only known from the device attributes
+    attributes = term.get_device_attributes(timeout=DEVICE_ATTRIBUTES_TIMEOUT)
+    if attributes is not None and RECTANGULAR_EDITING in attributes.extensions:
+        capabilities |= Capability.RECTANGLES
+    return capabilities
+
+
+# Synchronized output mode, delaying the display of a frame until it is complete
+SYNCHRONIZED_OUTPUT = 2026
+
+# Delay after which the terminal is assumed not to answer the DECRQM query
+DEC_MODE_TIMEOUT = 0.5
+
+
+def detect_synchronized_output(term: Terminal) -> bool:
+    """Return whether the terminal may support synchronized output (DEC 2026).
+
+    Only the terminals reporting the mode as unknown or permanently reset are
+    excluded, the others being sent the mode changes anyway.
+    """
+    if not term.does_styling:
+        return True
+    response = term.get_dec_mode(SYNCHRONIZED_OUTPUT, timeout=DEC_MODE_TIMEOUT)
+    return response.value not in (
+        response.NOT_RECOGNIZED,
+        response.PERMANENTLY_RESET,
+    )
@@ -12,6 +12,7 @@ class ColorMode(IntEnum):
     HAS_4_BIT_COLOR = 2
     HAS_8_BIT_COLOR = 3
     HAS_24_BIT_COLOR = 4
+    HAS_PALETTE_COLOR = 5
 
     def cycle(self) -> ColorMode:
         """Cycle to the next color mode, for testing purposes."""
@@ -26,6 +27,8 @@ class ColorMode(IntEnum):
             return "Could not detect color mode"
         if self == ColorMode.HAS_24_BIT_COLOR:
             return "True color"
+        if self == ColorMode.HAS_PALETTE_COLOR:
+            return "Palette color"
         return f"{self.number_of_colors} colors"
 
     @property
@@ -41,6 +44,8 @@ class ColorMode(IntEnum):
             return 256
         if self == ColorMode.HAS_24_BIT_COLOR:
             return 1 << 24
+        if self == ColorMode.HAS_PALETTE_COLOR:
+            return 256
         assert False
 
 
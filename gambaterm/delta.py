@@ -0,0 +1,375 @@
+from __future__ import annotations
+
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from itertools import count
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Deque
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import structlog
+
+from .colors import ColorMode
+from .console import Console, GameboyColor
+from .main import add_base_arguments, AppConfig
+from .termblit import quantize
+from .delta_protocol import (
+    HEADER,
+    MAX_MESSAGE_SIZE,
+    Compression,
+    FrameEncoder,
+    MessageType,
+    ProtocolError,
+    choose_compression,
+    compression_argument,
+    pack_welcome,
+    unpack_hello,
+)
+
+logger = structlog.get_logger()
+
+# Frames are skipped while this amount of data is waiting to be sent
+CONGESTION_THRESHOLD = 64 * 1024
+HANDSHAKE_TIMEOUT = 5.0
+
+
+async def read_message(reader: asyncio.StreamReader) -> tuple[MessageType, bytes]:
+    header = await reader.readexactly(HEADER.size)
+    message_type, size = HEADER.unpack(header)
+    if message_type not in set(MessageType) or size > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"Invalid message header {message_type}, {size}")
+    return MessageType(message_type), await reader.readexactly(size)
+
+
+class DeltaSession:
+    """State shared between the connection and the emulator thread."""
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.writer = writer
+        self.pressed: set[Console.Input] = set()
+        self.events: Deque[Console.Event] = deque()
+        self.closed = threading.Event()
+        self.sent_bytes = 0
+
+    def send(self, data: bytes) -> None:
+        """Send data from the emulator thread."""
+        self.sent_bytes += len(data)
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def congested(self) -> bool:
+        return self.writer.transport.get_write_buffer_size() > CONGESTION_THRESHOLD
+
+    async def receive(self, reader: asyncio.StreamReader) -> None:
+        """Receive the inputs and events of the client, until it disconnects."""
+        try:
+            while True:
+                message_type, payload = await read_message(reader)
+                if message_type == MessageType.INPUT and len(payload) == 1:
+                    self.pressed = {
+                        value for value in Console.Input if payload[0] & value
+                    }
+                elif message_type == MessageType.EVENT and len(payload) == 1:
+                    self.events.append(Console.Event(payload[0]))
+                else:
+                    raise ProtocolError(f"Unexpected {message_type.name} message")
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.closed.set()
+
+
+def thread_target(
+    console: Console,
+    session: DeltaSession,
+    compression: Compression,
+    frame_advance: int = 1,
+    break_after: int | None = None,
+    speed: float = 1.0,
+) -> None:
+    """Run the emulator, sending the frames as tile deltas to the client.
+
+    The frames are skipped while the connection is congested, since the deltas
+    are computed against the last sent frame.
+    """
+    video = np.full((console.HEIGHT, console.WIDTH), 0, np.uint32)
+    audio = np.full((2 * console.TICKS_IN_FRAME, 2), 0, np.int16)
+    quantized = video.copy()
+    encoder = FrameEncoder(console.HEIGHT, console.WIDTH, compression)
+    fps = console.FPS * speed
+    new_frame = False
+    start = time.time()
+    for i in count():
+        if session.closed.is_set():
+            return
+        if break_after is not None and i >= break_after:
+            return
+
+        # Tick the emulator
+        console.set_input(session.pressed)
+        while session.events:
+            console.handle_event(session.events.popleft())
+        offset, samples = console.advance_one_frame(video, audio)
+        new_frame = new_frame or offset > 0
+
+        # Send the frame
+        if i % frame_advance == 0 and new_frame and not session.congested():
+            new_frame = False
+            quantize(video, ColorMode.HAS_24_BIT_COLOR, quantized)
+            if data := encoder.encode(quantized):
+                session.send(data)
+
+        # Timing sync
+        deadline = start + samples / console.TICKS_IN_FRAME / fps
+        current = time.time()
+        if current < deadline - 1e-3:
+            time.sleep(deadline - current)
+        start = deadline
+
+
+async def handle_client(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    app_config: AppConfig,
+    console_cls: type[Console],
+    compressions: list[Compression],
+    executor: ThreadPoolExecutor,
+    clients: set[asyncio.StreamWriter],
+    max_clients: int,
+) -> None:
+    peername = writer.get_extra_info("peername") or "unix socket"
+    session_logger = logger.bind(peer=str(peername))
+    try:
+        message_type, payload = await asyncio.wait_for(
+            read_message(reader), HANDSHAKE_TIMEOUT
+        )
+        if message_type != MessageType.HELLO:
+            raise ProtocolError(f"Unexpected {message_type.name} message")
+        compression = choose_compression(unpack_hello(payload), compressions)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as exc:
+        session_logger.warning("Rejected delta client", reason=str(exc))
+        writer.close()
+        return
+
+    # Each session holds a thread of the executor, so the clients over the limit
+    # would wait for a free thread forever
+    if len(clients) >= max_clients:
+        session_logger.warning(
+            "Rejected delta client", reason=f"Too many clients ({max_clients})"
+        )
+        writer.close()
+        return
+    clients.add(writer)
+
+    # Clients are anonymous, so each session gets its own save directory,
+    # removed on disconnection
+    with tempfile.TemporaryDirectory(prefix="gambaterm-delta-") as save_directory:
+        app_config.save_directory = Path(save_directory)
+        loop = asyncio.get_running_loop()
+        console = await loop.run_in_executor(
+            executor, console_cls.from_app_config, app_config
+        )
+        writer.write(
+            pack_welcome(
+                compression,
+                console.WIDTH,
+                console.HEIGHT,
+                Path(console.romfile).name,
+            )
+        )
+        session_logger.info("Delta client connected", compression=compression.name)
+
+        session = DeltaSession(writer)
+        receive_task = asyncio.create_task(session.receive(reader))
+        start_time = time.monotonic()
+        try:
+            await loop.run_in_executor(
+                executor,
+                thread_target,
+                console,
+                session,
+                compression,
+                app_config.frame_advance,
+                app_config.break_after,
+                app_config.speed,
+            )
+        finally:
+            session.closed.set()
+            receive_task.cancel()
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+            clients.discard(writer)
+            elapsed = time.monotonic() - start_time
+            session_logger.info(
+                "Client disconnected",
+                duration=elapsed,
+                total_tx_bytes=session.sent_bytes,
+                avg_tx_rate_kbps=session.sent_bytes * 8 / elapsed / 1000
+                if elapsed
+                else 0,
+            )
+
+
+@asynccontextmanager
+async def run_delta_server(
+    bind: str,
+    port: int,
+    unix_socket: Path | None,
+    console_cls: type[Console],
+    namespace: argparse.Namespace,
+    compressions: list[Compression],
+    executor: ThreadPoolExecutor,
+    max_clients: int,
+) -> AsyncIterator[asyncio.Server]:
+    clients: set[asyncio.StreamWriter] = set()
+
+    async def client_connected(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            await handle_client(
+                reader,
+                writer,
+                AppConfig.from_namespace(namespace),
+                console_cls,
+                compressions,
+                executor,
+                clients,
+                max_clients,
+            )
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(client_connected, unix_socket)
+        logger.info("Running delta server", path=str(unix_socket))
+    else:
+        server = await asyncio.start_server(client_connected, bind, port)
+        actual_bind, actual_port = server.sockets[0].getsockname()[:2]
+        logger.info("Running delta server", bind=actual_bind, port=actual_port)
+    try:
+        yield server
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def main(
+    parser_args: tuple[str, ...] | None = None,
+    console_cls: type[Console] = GameboyColor,
+) -> None:
+    parser = argparse.ArgumentParser(
+        prog="gambaterm-delta",
+        description="Gambatte front-end sending the frames as compact binary deltas, "
+        "to be displayed using `gambaterm-delta-client`",
+    )
+    add_base_arguments(parser)
+    console_cls.add_console_arguments(parser)
+    parser.add_argument(
+        "--frame-advance",
+        "--fa",
+        type=int,
+        default=1,
+        help="Number of frames to run before sending the next one (default is 1)",
+    )
+    parser.add_argument(
+        "--break-after",
+        "--ba",
+        type=int,
+        default=None,
+        help="Number of frames to run before closing the connection "
+        "(doesn't stop by default)",
+    )
+    parser.add_argument(
+        "--speed",
+        "-s",
+        type=float,
+        default=1.0,
+        help="Control the execution speed (default is 1.0)",
+    )
+    parser.add_argument(
+        "--bind",
+        "-b",
+        type=str,
+        default="127.0.0.1",
+        help="Bind address of the server, "
+        "use `0.0.0.0` for all interfaces (default is localhost)",
+    )
+    parser.add_argument(
+        "--port",
+        "-p",
+        type=int,
+        default=8024,
+        help="Port of the server (default is 8024)",
+    )
+    parser.add_argument(
+        "--unix-socket",
+        "-u",
+        type=Path,
+        default=None,
+        help="Listen on this unix socket instead of a TCP port",
+    )
+    parser.add_argument(
+        "--compression",
+        type=compression_argument,
+        nargs="+",
+        default=Compression.available(),
+        metavar="{" + ",".join(c.name.lower() for c in Compression.available()) + "}",
+        help="Compressions allowed for the frames, the clients choosing among them "
+        "(default is all the available ones)",
+    )
+    parser.add_argument(
+        "--max-clients",
+        type=int,
+        default=32,
+        help="Maximum number of clients connected at the same time, "
+        "the other ones being rejected (default is 32)",
+    )
+
+    namespace = parser.parse_args(parser_args)
+    bind: str = namespace.__dict__.pop("bind")
+    port: int = namespace.__dict__.pop("port")
+    unix_socket: Path | None = namespace.__dict__.pop("unix_socket")
+    compressions: list[Compression] = namespace.__dict__.pop("compression")
+    max_clients: int = namespace.__dict__.pop("max_clients")
+    namespace.input_file = None
+    namespace.color_mode = None
+    namespace.skip_inputs = 0
+    namespace.cpr_sync = False
+    if not namespace.romfile.exists():
+        raise SystemExit(f"ROM file `{namespace.romfile}` does not exist")
+    if max_clients < 1:
+        raise SystemExit("At least one client must be allowed")
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_clients) as executor:
+
+            async def async_main() -> None:
+                async with run_delta_server(
+                    bind,
+                    port,
+                    unix_socket,
+                    console_cls,
+                    namespace,
+                    compressions,
+                    executor,
+                    max_clients,
+                ):
+                    await asyncio.Future()
+
+            asyncio.run(async_main())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Reference client of the delta protocol (see `delta_protocol`), displaying the
+frames sent by `gambaterm-delta` in the terminal.
+
+The frames are decoded locally and printed using the usual renderers, the remote
+emulator being exposed as a console. The inputs are sent back to the server.
+"""
+
+from __future__ import annotations
+
+import time
+import socket
+import argparse
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+from blessed import Terminal
+
+from .run import run
+from .colors import detect_local_color_mode, ColorMode
+from .console import Console, GameboyColor
+from .main import add_tuning_arguments
+from .keyboard_input import console_input_from_keyboard_context
+from .delta_protocol import (
+    Compression,
+    FrameDecoder,
+    MessageReader,
+    MessageType,
+    ProtocolError,
+    compression_argument,
+    pack_hello,
+    pack_message,
+    unpack_welcome,
+)
+
+HANDSHAKE_TIMEOUT = 5.0
+
+
+def connect(address: str) -> socket.socket:
+    """Connect to `host:port`, or to a unix socket given by its path."""
+    if ":" not in address or Path(address).exists():
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        return sock
+    host, port = address.rsplit(":", 1)
+    sock = socket.create_connection((host.strip("[]"), int(port)))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class RemoteConsole(Console):
+    """Console running on a delta server.
+
+    Advancing a frame shows the last frame received from the server, if any.
+    The inputs and events are forwarded to the server.
+    """
+
+    FPS = GameboyColor.FPS
+    TICKS_IN_FRAME = GameboyColor.TICKS_IN_FRAME
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        compressions: list[Compression] | None = None,
+    ):
+        self.sock = sock
+        self.reader = MessageReader()
+        self.input_mask = 0
+        self.received_bytes = 0
+        if compressions is None:
+            compressions = Compression.available()
+
+        # Handshake
+        self.sock.settimeout(HANDSHAKE_TIMEOUT)
+        self.sock.sendall(pack_hello(compressions))
+        message = None
+        while message is None:
+            try:
+                self.receive()
+            except EOFError as exc:
+                raise ProtocolError("The server refused the connection") from exc
+            message = next(iter(self.reader), None)
+        message_type, payload = message
+        if message_type != MessageType.WELCOME:
+            raise ProtocolError(f"Unexpected {message_type.name} message")
+        compression, width, height, name = unpack_welcome(payload)
+        self.compression = compression
+        self.WIDTH, self.HEIGHT = width, height
+        self.romfile = name
+        self.last_video = None
+        self.decoder = FrameDecoder(height, width, compression)
+        self.sock.setblocking(False)
+
+    def receive(self) -> bool:
+        """Read the available data, if any, raising EOFError when the server
+        disconnects."""
+        try:
+            data = self.sock.recv(1 << 16)
+        except BlockingIOError:
+            return False
+        except socket.timeout as exc:
+            raise ProtocolError("The server did not answer") from exc
+        if not data:
+            raise EOFError
+        self.received_bytes += len(data)
+        self.reader.feed(data)
+        return True
+
+    def send(self, data: bytes) -> None:
+        self.sock.setblocking(True)
+        try:
+            self.sock.sendall(data)
+        finally:
+            self.sock.setblocking(False)
+
+    def set_input(self, input_set: set[Console.Input]) -> None:
+        mask = sum(input_set)
+        if mask != self.input_mask:
+            self.send(pack_message(MessageType.INPUT, bytes([mask])))
+            self.input_mask = mask
+
+    def handle_event(self, event: Console.Event) -> None:
+        self.send(pack_message(MessageType.EVENT, bytes([event])))
+
+    def advance_one_frame(
+        self, video: npt.NDArray[np.uint32], audio: npt.NDArray[np.int16]
+    ) -> tuple[int, int]:
+        # All the received frames are decoded, only the last one being shown
+        new_frame = False
+        while True:
+            for message_type, payload in self.reader:
+                if message_type != MessageType.FRAME:
+                    raise ProtocolError(f"Unexpected {message_type.name} message")
+                self.decoder.decode(payload)
+                new_frame = True
+            if not self.receive():
+                break
+        if new_frame:
+            self.decoder.image(video)
+            self.last_video = video
+        return int(new_frame), self.TICKS_IN_FRAME
+
+
+def main(parser_args: tuple[str, ...] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="gambaterm-delta-client",
+        description="Display the frames sent by a `gambaterm-delta` server",
+    )
+    parser.add_argument(
+        "address",
+        metavar="ADDRESS",
+        help="Address of the server, either `host:port` or the path to a unix socket",
+    )
+    parser.add_argument(
+        "--compression",
+        type=compression_argument,
+        nargs="+",
+        default=None,
+        metavar="{" + ",".join(c.name.lower() for c in Compression.available()) + "}",
+        help="Compressions supported by the client, in order of preference "
+        "(default is all the available ones)",
+    )
+    add_tuning_arguments(parser)
+    args = parser.parse_args(parser_args)
+
+    try:
+        sock = connect(args.address)
+    except (OSError, ValueError) as error:
+        raise SystemExit(f"Could not connect to `{args.address}`: {error}")
+
+    terminal = Terminal()
+    with sock, terminal.raw():
+        try:
+            console = RemoteConsole(sock, args.compression)
+            color_mode = args.color_mode
+            if color_mode is None:
+                color_mode = detect_local_color_mode(terminal)
+                if color_mode == ColorMode.COULD_NOT_DETECT:
+                    color_mode = ColorMode.HAS_8_BIT_COLOR
+            terminal.stream.write(
+                terminal.enter_fullscreen + terminal.clear + terminal.hide_cursor
+            )
+            terminal.stream.flush()
+            with console_input_from_keyboard_context(console, terminal) as get_input:
+                run(
+                    console,
+                    get_input,
+                    term=terminal,
+                    frame_advance=args.frame_advance,
+                    color_mode=color_mode,
+                    break_after=args.break_after,
+                    speed=args.speed,
+                    use_cpr_sync=args.cpr_sync,
+                    encoder_threads=args.encoder_threads,
+                    renderer=args.renderer,
+                    fit_terminal=args.fit_terminal,
+                    perceptual_threshold=args.perceptual_threshold,
+                    interlaced=args.interlaced,
+                    deflicker=args.deflicker,
+                    stream_chunk_size=args.stream_chunk_size,
+                )
+        except (KeyboardInterrupt, EOFError):
+            pass
+        except (RuntimeError, ProtocolError) as error:
+            exit(str(error))
+        finally:
+            time.sleep(0.1)
+            terminal.stream.write(
+                terminal.clear + terminal.exit_fullscreen + terminal.normal_cursor
+            )
+            terminal.stream.flush()
+
+
+if __name__ == "__main__":
+    main()
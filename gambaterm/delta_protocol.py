@@ -0,0 +1,297 @@
+"""
+Compact binary protocol sending the frames as palette-indexed tile deltas.
+
+Every message starts with a header made of its type (1 byte) and the size of
+its payload (4 bytes, big-endian). After the handshake (a HELLO message from the
+client listing the compressions it supports, answered by a WELCOME message with
+the chosen compression and the dimensions of the screen), the server sends FRAME
+messages and the client sends INPUT and EVENT messages.
+
+A frame payload is made of:
+- the number of redefined palette entries (2 bytes), followed by the index
+  (1 byte) and RGB color (3 bytes) of each of them
+- a bitmap of the changed 8x8 tiles, in row-major order
+- the 64 palette indices of each changed tile
+
+The frame payloads are compressed as a single stream, flushed after each frame,
+so that the tiles repeated across frames are compressed too.
+"""
+
+from __future__ import annotations
+
+import zlib
+import struct
+import argparse
+import importlib
+from enum import IntEnum
+from types import ModuleType
+from typing import Callable, Iterator
+
+import numpy as np
+import numpy.typing as npt
+
+from .colors import ColorMode
+from .run import Palette
+from .termblit import quantize
+
+MAGIC = b"GBTD"
+VERSION = 1
+TILE_SIZE = 8
+# Larger messages are rejected, as a protection against invalid streams
+MAX_MESSAGE_SIZE = 1 << 20
+
+HEADER = struct.Struct(">BI")
+HELLO = struct.Struct(">4sBB")
+WELCOME = struct.Struct(">4sBBHHB")
+PALETTE_COUNT = struct.Struct(">H")
+PALETTE_ENTRY = np.dtype([("index", "u1"), ("rgb", "u1", 3)])
+
+
+class MessageType(IntEnum):
+    HELLO = 1
+    WELCOME = 2
+    FRAME = 3
+    INPUT = 4
+    EVENT = 5
+
+
+class ProtocolError(ValueError):
+    """Invalid or unexpected message."""
+
+
+def zstd_module() -> ModuleType | None:
+    """Return the zstd module of the standard library (python 3.14+), if any."""
+    try:
+        return importlib.import_module("compression.zstd")
+    except ImportError:
+        return None
+
+
+class Compression(IntEnum):
+    NONE = 0
+    ZLIB = 1
+    ZSTD = 2
+
+    @classmethod
+    def available(cls) -> list[Compression]:
+        """Return the supported compressions, in order of preference."""
+        result = [cls.ZLIB, cls.NONE]
+        if zstd_module() is not None:
+            result.insert(0, cls.ZSTD)
+        return result
+
+    def compressor(self) -> Callable[[bytes], bytes]:
+        """Return a function compressing the successive payloads of a stream."""
+        if self == Compression.ZLIB:
+            zlib_compressor = zlib.compressobj()
+            return lambda data: zlib_compressor.compress(data) + zlib_compressor.flush(
+                zlib.Z_SYNC_FLUSH
+            )
+        if self == Compression.ZSTD:
+            module = zstd_module()
+            assert module is not None
+            zstd_compressor = module.ZstdCompressor()
+            return lambda data: bytes(
+                zstd_compressor.compress(data, zstd_compressor.FLUSH_BLOCK)
+            )
+        return bytes
+
+    def decompressor(self) -> Callable[[bytes], bytes]:
+        """Return a function decompressing the successive payloads of a stream."""
+        if self == Compression.ZLIB:
+            return zlib.decompressobj().decompress
+        if self == Compression.ZSTD:
+            module = zstd_module()
+            assert module is not None
+            zstd_decompressor = module.ZstdDecompressor()
+            return lambda data: bytes(zstd_decompressor.decompress(data))
+        return bytes
+
+
+def compression_argument(value: str) -> Compression:
+    try:
+        result = Compression[value.upper()]
+    except KeyError:
+        result = None
+    if result not in Compression.available():
+        raise argparse.ArgumentTypeError(f"unsupported compression `{value}`")
+    assert result is not None
+    return result
+
+
+def pack_message(message_type: MessageType, payload: bytes = b"") -> bytes:
+    return HEADER.pack(message_type, len(payload)) + payload
+
+
+def pack_hello(compressions: list[Compression]) -> bytes:
+    payload = HELLO.pack(MAGIC, VERSION, len(compressions)) + bytes(compressions)
+    return pack_message(MessageType.HELLO, payload)
+
+
+def unpack_hello(payload: bytes) -> list[Compression]:
+    """Return the compressions supported by the client, in order of preference."""
+    if len(payload) < HELLO.size:
+        raise ProtocolError("Truncated HELLO message")
+    magic, version, count = HELLO.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise ProtocolError(f"Unsupported protocol {magic!r} version {version}")
+    return [
+        Compression(value)
+        for value in payload[HELLO.size : HELLO.size + count]
+        if value in set(Compression)
+    ]
+
+
+def pack_welcome(compression: Compression, width: int, height: int, name: str) -> bytes:
+    payload = WELCOME.pack(MAGIC, VERSION, compression, width, height, TILE_SIZE)
+    return pack_message(MessageType.WELCOME, payload + name.encode())
+
+
+def unpack_welcome(payload: bytes) -> tuple[Compression, int, int, str]:
+    """Return the compression, the dimensions of the screen and the rom name."""
+    if len(payload) < WELCOME.size:
+        raise ProtocolError("Truncated WELCOME message")
+    magic, version, compression, width, height, tile_size = WELCOME.unpack_from(payload)
+    if magic != MAGIC or version != VERSION or tile_size != TILE_SIZE:
+        raise ProtocolError(f"Unsupported protocol {magic!r} version {version}")
+    name = payload[WELCOME.size :].decode(errors="replace")
+    return Compression(compression), width, height, name
+
+
+def choose_compression(
+    requested: list[Compression], allowed: list[Compression]
+) -> Compression:
+    """Return the first compression requested by the client that is allowed."""
+    for compression in requested:
+        if compression in allowed:
+            return compression
+    return Compression.NONE
+
+
+class MessageReader:
+    """Split a stream of bytes into messages."""
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
+
+    def __iter__(self) -> Iterator[tuple[MessageType, bytes]]:
+        while len(self.buffer) >= HEADER.size:
+            message_type, size = HEADER.unpack_from(self.buffer)
+            if message_type not in set(MessageType) or size > MAX_MESSAGE_SIZE:
+                raise ProtocolError(f"Invalid message header {message_type}, {size}")
+            if len(self.buffer) < HEADER.size + size:
+                return
+            payload = bytes(self.buffer[HEADER.size : HEADER.size + size])
+            del self.buffer[: HEADER.size + size]
+            yield MessageType(message_type), payload
+
+
+class FrameEncoder:
+    """Encode the frames as the changed tiles of the last sent frame.
+
+    The colors are stored in a persistent palette, the colors of the last sent
+    frame keeping their index. The same indices thus always mean the same colors,
+    and only the new colors have to be sent. Frames using more than 256 colors
+    are reduced to 256 colors, and sent entirely.
+    """
+
+    def __init__(
+        self, height: int, width: int, compression: Compression = Compression.NONE
+    ) -> None:
+        assert height % TILE_SIZE == 0 and width % TILE_SIZE == 0
+        self.palette = Palette()
+        # Colors known by the client (0 means undefined)
+        self.colors = np.zeros(Palette.SIZE, np.uint32)
+        self.frame = np.zeros((height, width), np.uint8)
+        self.last_frame = self.frame.copy()
+        self.quantized = np.zeros((height, width), np.uint32)
+        self.keyframe = True
+        self.compress = compression.compressor()
+
+    def encode(self, image: npt.NDArray[np.uint32]) -> bytes:
+        """Return the FRAME message updating the last sent frame to the given image,
+        or an empty string if it is unchanged."""
+        if not self.palette.index(image, self.frame):
+            self.palette = Palette()
+            quantize(image, ColorMode.HAS_8_BIT_COLOR, self.quantized)
+            assert self.palette.index(self.quantized, self.frame)
+            self.keyframe = True
+
+        # Colors used by the frame, and not known by the client yet
+        used = self.palette.stamps == self.palette.generation
+        colors = self.palette.colors | np.uint32(0xFF000000)
+        updates = np.flatnonzero(used & (colors != self.colors))
+        entries = np.zeros(len(updates), PALETTE_ENTRY)
+        entries["index"] = updates
+        colors = colors[updates]
+        entries["rgb"] = np.stack([colors >> 16, colors >> 8, colors], axis=1) & 0xFF
+        self.colors[updates] = colors
+
+        # Changed tiles
+        height, width = self.frame.shape
+        shape = (height // TILE_SIZE, TILE_SIZE, width // TILE_SIZE, TILE_SIZE)
+        tiles = self.frame.reshape(shape).swapaxes(1, 2)
+        if self.keyframe:
+            changed = np.ones(tiles.shape[:2], bool)
+        else:
+            changed = (self.frame != self.last_frame).reshape(shape).any(axis=(1, 3))
+        self.keyframe = False
+        self.palette.commit()
+        self.frame, self.last_frame = self.last_frame, self.frame
+        if not changed.any() and not len(updates):
+            return b""
+
+        payload = b"".join(
+            [
+                PALETTE_COUNT.pack(len(updates)),
+                entries.tobytes(),
+                np.packbits(changed).tobytes(),
+                tiles[changed].tobytes(),
+            ]
+        )
+        return pack_message(MessageType.FRAME, self.compress(payload))
+
+
+class FrameDecoder:
+    """Apply the FRAME messages to the current frame."""
+
+    def __init__(
+        self, height: int, width: int, compression: Compression = Compression.NONE
+    ) -> None:
+        assert height % TILE_SIZE == 0 and width % TILE_SIZE == 0
+        self.colors = np.zeros(Palette.SIZE, np.uint32)
+        self.frame = np.zeros((height, width), np.uint8)
+        self.decompress = compression.decompressor()
+
+    def decode(self, payload: bytes) -> None:
+        data = self.decompress(payload)
+        height, width = self.frame.shape
+        shape = (height // TILE_SIZE, TILE_SIZE, width // TILE_SIZE, TILE_SIZE)
+        bitmap_size = (shape[0] * shape[2] + 7) // 8
+        try:
+            (count,) = PALETTE_COUNT.unpack_from(data)
+            offset = PALETTE_COUNT.size
+            entries = np.frombuffer(data, PALETTE_ENTRY, count, offset)
+            offset += entries.nbytes
+            bitmap = np.frombuffer(data, np.uint8, bitmap_size, offset)
+            offset += bitmap_size
+            bits = np.unpackbits(bitmap, count=shape[0] * shape[2])
+            changed = bits.astype(bool).reshape(shape[0], shape[2])
+            count = int(changed.sum()) * TILE_SIZE * TILE_SIZE
+            tiles = np.frombuffer(data, np.uint8, count, offset)
+        except (struct.error, ValueError) as exc:
+            raise ProtocolError("Truncated FRAME message") from exc
+        rgb = entries["rgb"].astype(np.uint32)
+        self.colors[entries["index"]] = (
+            0xFF000000 | (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+        )
+        self.frame.reshape(shape).swapaxes(1, 2)[changed] = tiles.reshape(
+            -1, TILE_SIZE, TILE_SIZE
+        )
+
+    def image(self, output: npt.NDArray[np.uint32]) -> None:
+        """Write the colors of the current frame."""
+        np.take(self.colors, self.frame, out=output)
@@ -0,0 +1,142 @@
+"""
+Print the frames as an image, using the kitty graphics protocol.
+
+See https://sw.kovidgoyal.net/kitty/graphics-protocol/
+"""
+
+from __future__ import annotations
+
+import zlib
+import base64
+import contextlib
+from collections import deque
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Deque
+
+import numpy as np
+import numpy.typing as npt
+
+# Payloads are sent in chunks of at most 4096 bytes
+CHUNK_SIZE = 4096
+
+
+def rgb_view(image: npt.NDArray[np.uint32]) -> npt.NDArray[np.uint8]:
+    """Return the 24-bit RGB view of an image (as expected by `f=24`)."""
+    return image.view(np.uint8).reshape(*image.shape, 4)[..., 2::-1]
+
+
+def graphics_command(keys: str, payload: bytes = b"") -> bytes:
+    """Return the APC sequences of a graphics command, splitting its payload."""
+    data = base64.standard_b64encode(payload)
+    if not data:
+        return b"\033_G" + keys.encode() + b"\033\\"
+    if len(data) <= CHUNK_SIZE:
+        return b"\033_G" + keys.encode() + b";" + data + b"\033\\"
+    chunks = [data[i : i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+    result = [b"\033_G" + keys.encode() + b",m=1;" + chunks[0] + b"\033\\"]
+    result += [b"\033_Gm=1;" + chunk + b"\033\\" for chunk in chunks[1:-1]]
+    result += [b"\033_Gm=0;" + chunks[-1] + b"\033\\"]
+    return b"".join(result)
+
+
+class KittyGraphics:
+    """Frames printed as a single image, scaled by the terminal to a cell area.
+
+    When the terminal runs on the same machine, the frames are transmitted using
+    POSIX shared memory (`t=s`), so that only a small control sequence is printed.
+    Otherwise, the changed rectangle of the frame is edited (`a=f`), using a
+    zlib-compressed payload.
+    """
+
+    IMAGE_ID = 1
+    PLACEMENT_ID = 1
+    # The terminal unlinks the shared memory objects it has read, the ones
+    # that are still around after this many frames are considered lost
+    SEGMENT_LIFETIME = 60
+
+    def __init__(self, shared_memory: bool) -> None:
+        self.shared_memory = shared_memory
+        self.segments: Deque[str] = deque()
+        self.transmitted = False
+
+    def blit(
+        self,
+        image: npt.NDArray[np.uint32],
+        last: npt.NDArray[np.uint32] | None,
+        refx: int,
+        refy: int,
+        columns: int,
+        rows: int,
+    ) -> bytes:
+        """Return the sequences printing the image, or the part that changed since
+        the last image (if provided)."""
+        height, width = image.shape
+        if self.shared_memory:
+            keys = f"t=s,f=24,s={width},v={height}"
+            return self.place(keys, self.share(image), refx, refy, columns, rows)
+        if last is None or not self.transmitted:
+            keys = f"f=24,o=z,s={width},v={height}"
+            payload = zlib.compress(rgb_view(image).tobytes(), 1)
+            return self.place(keys, payload, refx, refy, columns, rows)
+
+        # Bounding rectangle of the changed pixels
+        changed = image != last
+        changed_rows = np.flatnonzero(changed.any(axis=1))
+        if not changed_rows.size:
+            return b""
+        changed_columns = np.flatnonzero(changed.any(axis=0))
+        top, bottom = changed_rows[0], changed_rows[-1] + 1
+        left, right = changed_columns[0], changed_columns[-1] + 1
+        payload = zlib.compress(rgb_view(image[top:bottom, left:right]).tobytes(), 1)
+        keys = (
+            f"a=f,i={self.IMAGE_ID},r=1,x={left},y={top},"
+            f"s={right - left},v={bottom - top},f=24,o=z,q=2"
+        )
+        return graphics_command(keys, payload)
+
+    def place(
+        self, keys: str, payload: bytes, refx: int, refy: int, columns: int, rows: int
+    ) -> bytes:
+        """Transmit and display the whole image, replacing the previous one."""
+        self.transmitted = True
+        keys = (
+            f"a=T,i={self.IMAGE_ID},p={self.PLACEMENT_ID},{keys},"
+            f"c={columns},r={rows},C=1,q=2"
+        )
+        return f"\033[{refx};{refy}H".encode() + graphics_command(keys, payload)
+
+    def share(self, image: npt.NDArray[np.uint32]) -> bytes:
+        """Write the image into a new shared memory object, and return its name."""
+        segment = SharedMemory(create=True, size=image.size * 3)
+        # The terminal owns the object from now on
+        resource_tracker.unregister(
+            segment._name, "shared_memory"  # type: ignore[attr-defined]
+        )
+        try:
+            output = np.ndarray((*image.shape, 3), np.uint8, segment.buf)
+            output[...] = rgb_view(image)
+            del output
+        finally:
+            segment.close()
+        self.segments.append(segment.name)
+        while len(self.segments) > self.SEGMENT_LIFETIME:
+            self.unlink(self.segments.popleft())
+        return segment.name.encode()
+
+    @staticmethod
+    def unlink(name: str) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            segment = SharedMemory(name)
+            segment.close()
+            segment.unlink()
+
+    def close(self) -> bytes:
+        """Unlink the remaining shared memory objects, and return the sequence
+        deleting the image."""
+        while self.segments:
+            self.unlink(self.segments.popleft())
+        if not self.transmitted:
+            return b""
+        self.transmitted = False
+        return graphics_command(f"a=d,d=I,i={self.IMAGE_ID},q=2")
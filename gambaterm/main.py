@@ -14,6 +14,7 @@ from .run import run
 from .console import GameboyColor, Console
 from .audio import audio_player
 from .colors import detect_local_color_mode, ColorMode
+from .renderers import Renderer
 from .input_getter import BaseInputGetter
 from .keyboard_input import console_input_from_keyboard_context
 from .controller_input import combine_console_input_from_controller_context
@@ -34,6 +35,13 @@ class AppConfig:
     speed: float
     skip_inputs: int
     cpr_sync: bool
+    encoder_threads: int = 1
+    renderer: Renderer = Renderer.BLOCKS
+    fit_terminal: bool = False
+    perceptual_threshold: float = 0.0
+    interlaced: bool = False
+    deflicker: bool = False
+    stream_chunk_size: int = 0
     save_directory: Path | None = None
     console_namespace: argparse.Namespace = field(default_factory=argparse.Namespace)
 
@@ -74,6 +82,27 @@ def add_input_file_arguments(parser: argparse.ArgumentParser) -> None:
     )
 
 
+def thread_count(value: str) -> int:
+    result = int(value)
+    if result < 1:
+        raise argparse.ArgumentTypeError("the value must be at least 1")
+    return result
+
+
+def perceptual_threshold(value: str) -> float:
+    result = float(value)
+    if not result >= 0:
+        raise argparse.ArgumentTypeError("the value must be positive")
+    return result
+
+
+def chunk_size(value: str) -> int:
+    result = int(value)
+    if result < 0:
+        raise argparse.ArgumentTypeError("the value must be positive")
+    return result
+
+
 def add_tuning_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
         "--color-mode",
@@ -81,7 +110,8 @@ def add_tuning_arguments(parser: argparse.ArgumentParser) -> None:
         type=lambda x: ColorMode(int(x)),
         default=None,
         help="Force a color mode "
-        "(1: 4 greyscale colors, 2: 16 colors, 3: 256 colors, 4: 24-bit colors). "
+        "(1: 4 greyscale colors, 2: 16 colors, 3: 256 colors, 4: 24-bit colors, "
+        "5: 24-bit colors using a redefined 256-color palette). "
         "Note: the color mode can be cycled at runtime by pressing the Tab key, "
         "which is useful for testing the different color modes supported by the terminal.",
     )
@@ -113,6 +143,67 @@ def add_tuning_arguments(parser: argparse.ArgumentParser) -> None:
         action="store_true",
         help="Use CPR synchronization to prevent video buffering",
     )
+    parser.add_argument(
+        "--encoder-threads",
+        "--et",
+        type=thread_count,
+        default=1,
+        help="Number of threads used to encode the frames, "
+        "each of them encoding a horizontal band of the screen (default is 1)",
+    )
+    parser.add_argument(
+        "--renderer",
+        "-r",
+        type=Renderer,
+        choices=list(Renderer),
+        default=Renderer.BLOCKS,
+        metavar="{" + ",".join(renderer.value for renderer in Renderer) + "}",
+        help="Output format of the video frames (blocks: half-block characters, "
+        "quadrants: quadrant characters using 2x2 pixels per cell, "
+        "sextants: sextant characters using 2x3 pixels per cell, "
+        "sixel: sixel graphics, kitty: kitty graphics protocol, "
+        "using shared memory when the terminal is local) "
+        "(default is blocks)",
+    )
+    parser.add_argument(
+        "--fit-terminal",
+        "--ft",
+        action="store_true",
+        help="Scale the video up by an integer factor to fill the terminal "
+        "(for the renderers printing characters)",
+    )
+    parser.add_argument(
+        "--perceptual-threshold",
+        "--pt",
+        type=perceptual_threshold,
+        default=0.0,
+        help="Skip the color changes that are less perceptible than this threshold "
+        "(as a CIE76 delta E, about 2.3 being just noticeable), to save bandwidth "
+        "on slow connections (default is 0, printing every change)",
+    )
+    parser.add_argument(
+        "--interlaced",
+        "--il",
+        action="store_true",
+        help="When the terminal cannot keep up, print every other row of cells "
+        "in alternance rather than skipping frames (except for the kitty renderer)",
+    )
+    parser.add_argument(
+        "--deflicker",
+        "--df",
+        action="store_true",
+        help="Blend the 8x8 tiles alternating between two images on every other "
+        "frame (e.g. sprites blinking for transparency) into a stable image",
+    )
+    parser.add_argument(
+        "--stream-chunk-size",
+        "--scs",
+        type=chunk_size,
+        default=0,
+        help="Encode the frames by bands and send them by chunks of this size "
+        "while the rest of the frame is being encoded, e.g. 32768 to match the "
+        "SSH packet size (default is 0, sending each frame once encoded)",
+    )
 
 
 def add_local_only_arguments(parser: argparse.ArgumentParser) -> None:
@@ -181,9 +272,9 @@ def main(
     if args.write_input:
         input_context = write_input_context(input_context, args.write_input)
 
-    if args.color_mode not in [None, 1, 2, 3, 4]:
+    if args.color_mode not in [None, 1, 2, 3, 4, 5]:
         exit(
-            f"Invalid color mode `{args.color_mode}`: the value must be between 1 and 4"
+            f"Invalid color mode `{args.color_mode}`: the value must be between 1 and 5"
         )
 
     # Enter terminal raw mode
@@ -217,6 +308,13 @@ def main(
                         break_after=args.break_after,
                         speed=args.speed,
                         use_cpr_sync=args.cpr_sync,
+                        encoder_threads=args.encoder_threads,
+                        renderer=args.renderer,
+                        fit_terminal=args.fit_terminal,
+                        perceptual_threshold=args.perceptual_threshold,
+                        interlaced=args.interlaced,
+                        deflicker=args.deflicker,
+                        stream_chunk_size=args.stream_chunk_size,
                     )
 
         # Deal with ctrl+c and ctrl+d exceptions
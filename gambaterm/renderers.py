@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+from enum import Enum, IntEnum
+
+
+class GlyphSet(IntEnum):
+    """Characters used to print the pixels of a terminal cell.
+
+    The values must match the ones defined in `termblit`.
+    """
+
+    # 1x2 pixels per cell
+    HALF_BLOCKS = 0
+    # 2x2 pixels per cell
+    QUADRANTS = 1
+    # 2x3 pixels per cell
+    SEXTANTS = 2
+
+    @property
+    def cell_width(self) -> int:
+        return 1 if self == GlyphSet.HALF_BLOCKS else 2
+
+    @property
+    def cell_height(self) -> int:
+        return 3 if self == GlyphSet.SEXTANTS else 2
+
+
+class Renderer(Enum):
+    """Output format of the video frames."""
+
+    # Half-block characters, printing two pixels per cell
+    BLOCKS = "blocks"
+    # Quadrant characters, printing four pixels per cell using two colors
+    QUADRANTS = "quadrants"
+    # Sextant characters, printing six pixels per cell using two colors
+    SEXTANTS = "sextants"
+    # Sixel graphics, printing the actual pixels
+    SIXEL = "sixel"
+    # Kitty graphics protocol, printing the actual pixels
+    KITTY = "kitty"
+
+    def report(self) -> str:
+        """Return a human-readable report of the renderer."""
+        return self.value.capitalize()
+
+    @property
+    def glyph_set(self) -> GlyphSet:
+        """Return the glyph set of the renderers printing characters."""
+        if self == Renderer.QUADRANTS:
+            return GlyphSet.QUADRANTS
+        if self == Renderer.SEXTANTS:
+            return GlyphSet.SEXTANTS
+        return GlyphSet.HALF_BLOCKS
@@ -5,21 +5,57 @@ import re
 import sys
 import time
 import contextlib
+import functools
 from itertools import count
-from collections import deque
-from typing import Deque, Iterator
+from collections import Counter, deque
+from typing import Callable, Deque, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import numpy as np
+import numpy.typing as npt
 from blessed import Terminal
 
-from .termblit import blit
+from .termblit import (
+    blit,
+    blit_into,
+    index_colors,
+    is_unchanged,
+    max_blit_size,
+    max_sixel_size,
+    perceptual_filter,
+    quantize,
+    sixel_blit_into,
+)
 from .audio import MaybeAudioOut, DISABLED_AUDIO_OUT
 from .console import Console
 from .input_getter import BaseInputGetter
 from .colors import ColorMode
+from .capabilities import (
+    Capability,
+    detect_capabilities,
+    detect_synchronized_output,
+)
+from .renderers import GlyphSet, Renderer
+from .kitty import KittyGraphics
+from .remote_terminal import RemoteTerminal
 
 _CPR_RE = re.compile(r"\x1b\[\d+;\d+R")
 
+# Must match the value defined in `termblit`
+MAX_SIXEL_SCALE = 16
+
+# Cursor state of the encoder (row, column, foreground and background colors),
+# with an unknown position and colors. Must match the values defined in `termblit`.
+UNKNOWN_CURSOR = (-1, -1, 0x100, 0x100)
+UNKNOWN_COLOR = 0x100
+
+# Control sequences written around the frames
+SYNC_BEGIN = b"\033[?2026h"
+SYNC_END = b"\033[?2026l"
+RESET_COLORS = b"\033[0m"
+CLEAR_SCREEN = b"\033[H\033[2J"
+CPR_REQUEST = b"\033[1;1H\033[6n"
+
 
 @contextlib.contextmanager
 def timing(deltas: Deque[float]) -> Iterator[None]:
@@ -30,13 +66,627 @@ def timing(deltas: Deque[float]) -> Iterator[None]:
         deltas.append(time.perf_counter() - start)
 
 
-def get_ref(width: int, height: int, console: Console) -> tuple[int, int]:
-    refx = 2 + max(0, (height - console.HEIGHT // 2) // 2)
-    refy = 3 + max(0, (width - console.WIDTH) // 2)
+def get_ref(
+    width: int,
+    height: int,
+    console: Console,
+    glyph_set: GlyphSet = GlyphSet.HALF_BLOCKS,
+    scale: int = 1,
+) -> tuple[int, int]:
+    refx = 2 + max(0, (height - console.HEIGHT * scale // glyph_set.cell_height) // 2)
+    refy = 3 + max(0, (width - console.WIDTH * scale // glyph_set.cell_width) // 2)
     return refx, refy
 
 
-def write_frame(term: Terminal, frame_data: bytes | bytearray) -> None:
+def get_fit_scale(
+    width: int,
+    height: int,
+    console: Console,
+    glyph_set: GlyphSet = GlyphSet.HALF_BLOCKS,
+) -> int:
+    """Return the largest integer scale at which the video fits in the terminal."""
+    rows = console.HEIGHT // glyph_set.cell_height
+    columns = console.WIDTH // glyph_set.cell_width
+    return max(1, min((height - 1) // rows, (width - 3) // columns))
+
+
+def get_image_layout(
+    term: Terminal, width: int, height: int, console: Console
+) -> tuple[int, int, int, int, int]:
+    """Return the integer scale of the image printed using graphics (sixel or kitty),
+    its centered position, and the number of columns and rows it covers.
+
+    The size of the cells is derived from the pixel size of the terminal,
+    assuming 10x20 pixels when it is not reported (e.g. over the network).
+    """
+    cell_width = term.pixel_width // width if term.pixel_width else 10
+    cell_height = term.pixel_height // height if term.pixel_height else 20
+    # Keep the first and last rows free, so that the image never scrolls the screen
+    scale = min(
+        width * cell_width // console.WIDTH,
+        (height - 2) * cell_height // console.HEIGHT,
+        MAX_SIXEL_SCALE,
+    )
+    scale = max(scale, 1)
+    columns = -(-console.WIDTH * scale // cell_width)
+    rows = -(-console.HEIGHT * scale // cell_height)
+    refx = 2 + max(0, (height - 2 - rows) // 2)
+    refy = 1 + max(0, (width - columns) // 2)
+    return scale, refx, refy, columns, rows
+
+
+@functools.cache
+def get_encoder_executor() -> ThreadPoolExecutor:
+    """Thread pool shared by all the sessions to encode frame bands in parallel."""
+    return ThreadPoolExecutor(
+        max_workers=os.cpu_count() or 1, thread_name_prefix="encoder"
+    )
+
+
+class Palette:
+    """Persistent palette of 256 colors, used to store the frames as color indices.
+
+    The colors used by the last printed frame keep their index, so that indexed frames
+    can be compared directly. The other entries are re-used in LRU order.
+    """
+
+    SIZE = 256
+
+    def __init__(self) -> None:
+        self.colors = np.zeros(self.SIZE, np.uint32)
+        self.stamps = np.zeros(self.SIZE, np.int64)
+        self.generation = 1
+        self.size = self.SIZE
+
+    def index(
+        self, image: npt.NDArray[np.uint32], output: npt.NDArray[np.uint8]
+    ) -> bool:
+        """Write the color indices of the image, or return False if
+        the palette cannot hold its colors (along with the last printed ones)."""
+        return index_colors(
+            image, self.colors, self.stamps, self.generation, output, self.size
+        )
+
+    def commit(self) -> None:
+        """Mark the last indexed frame as printed."""
+        self.generation += 1
+
+
+class TerminalPalette:
+    """Terminal colors redefined using OSC 4, in the palette color mode.
+
+    The palette entries are mapped to the terminal colors following the 16 standard
+    colors. Since the palette never re-uses the entries of the last printed frame,
+    the colors are never redefined while on screen.
+    """
+
+    FIRST_COLOR = 16
+    SIZE = 240
+
+    def __init__(self) -> None:
+        # Real colors always have 0xFF in the high byte, so 0 means undefined
+        self.colors = np.zeros(self.SIZE, np.uint32)
+
+    def update(self, palette: Palette) -> bytes:
+        """Return the OSC 4 sequences defining the colors of the last indexed frame."""
+        used = palette.stamps[: self.SIZE] == palette.generation
+        colors = palette.colors[: self.SIZE]
+        result = []
+        for index in np.flatnonzero(used & (colors != self.colors)):
+            color = int(colors[index])
+            r, g, b = (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF
+            result.append(
+                f"\033]4;{self.FIRST_COLOR + index};rgb:{r:02x}/{g:02x}/{b:02x}\033\\"
+            )
+            self.colors[index] = color
+        return "".join(result).encode()
+
+    def restore(self) -> bytes:
+        """Return the OSC 104 sequence restoring the redefined colors."""
+        defined = np.flatnonzero(self.colors)
+        if not defined.size:
+            return b""
+        self.colors.fill(0)
+        numbers = ";".join(str(self.FIRST_COLOR + index) for index in defined)
+        return f"\033]104;{numbers}\033\\".encode()
+
+
+class LossyFilter:
+    """Skip the color changes that are not perceptible, to save bandwidth.
+
+    The frames are compared to the colors actually displayed by the terminal, so that
+    the error never exceeds the threshold. Scene changes are printed as is, and so are
+    static screens after a short while, clearing the remaining error.
+    """
+
+    SETTLE_FRAMES = 30
+
+    def __init__(self, threshold: float, shape: tuple[int, int]) -> None:
+        self.threshold = threshold
+        self.displayed = np.zeros(shape, np.uint32)
+        self.source = np.zeros(shape, np.uint32)
+        self.static_frames = 0
+
+    def apply(self, image: npt.NDArray[np.uint32]) -> None:
+        """Replace the imperceptible changes of the image with the displayed colors."""
+        if is_unchanged(image, self.source):
+            self.static_frames += 1
+        else:
+            self.source[...] = image
+            self.static_frames = 0
+        if self.static_frames < self.SETTLE_FRAMES:
+            perceptual_filter(image, self.displayed, self.threshold)
+
+    def commit(self, image: npt.NDArray[np.uint32]) -> None:
+        """Mark the image as displayed."""
+        self.displayed[...] = image
+
+
+def blend(
+    first: npt.NDArray[np.uint32], second: npt.NDArray[np.uint32]
+) -> npt.NDArray[np.uint32]:
+    """Return the average of two images, channel by channel (rounded up)."""
+    result: npt.NDArray[np.uint32] = (
+        ((first >> 1) & 0x7F7F7F7F)
+        + ((second >> 1) & 0x7F7F7F7F)
+        + ((first | second) & 0x01010101)
+    )
+    return result
+
+
+class Deflicker:
+    """Blend the tiles alternating between two images, one frame out of two.
+
+    Games commonly blink sprites on every other frame to simulate transparency,
+    which defeats the frame deltas and strobes on slow terminals. Such tiles are
+    printed as the average of both images instead, which does not change.
+    """
+
+    TILE_SIZE = 8
+
+    def __init__(self, shape: tuple[int, int]) -> None:
+        self.previous = np.zeros(shape, np.uint32)
+        self.before = np.zeros(shape, np.uint32)
+        self.earlier = np.zeros(shape, np.uint32)
+        self.output = np.zeros(shape, np.uint32)
+
+    def tiles(self, image: npt.NDArray[np.uint32]) -> npt.NDArray[np.uint32]:
+        height, width = image.shape
+        size = self.TILE_SIZE
+        return image.reshape(height // size, size, width // size, size)
+
+    def apply(self, image: npt.NDArray[np.uint32]) -> npt.NDArray[np.uint32]:
+        """Return the image with its flickering tiles blended (the tiles that
+        alternated between two different images over the last four frames)."""
+        current, previous = self.tiles(image), self.tiles(self.previous)
+        flickering = (current == self.tiles(self.before)).all(axis=(1, 3))
+        flickering &= (previous == self.tiles(self.earlier)).all(axis=(1, 3))
+        flickering &= (current != previous).any(axis=(1, 3))
+        self.output[...] = image
+        if flickering.any():
+            np.copyto(
+                self.tiles(self.output),
+                blend(current, previous),
+                where=flickering[:, None, :, None],
+            )
+        self.earlier, self.before, self.previous = (
+            self.before,
+            self.previous,
+            self.earlier,
+        )
+        self.previous[...] = image
+        return self.output
+
+
+def interlace(
+    image: npt.NDArray[np.uint32], last: npt.NDArray[np.uint32], field: int, group: int
+) -> None:
+    """Revert every other group of rows of the image to the last frame, so that only
+    the groups of the given field (0 or 1) are updated."""
+    height, width = image.shape
+    image.reshape(height // group, group, width)[1 - field :: 2] = last.reshape(
+        height // group, group, width
+    )[1 - field :: 2]
+
+
+def get_palette_size(color_mode: ColorMode) -> int:
+    if color_mode == ColorMode.HAS_PALETTE_COLOR:
+        return TerminalPalette.SIZE
+    return Palette.SIZE
+
+
+# Full redraws are encoded by groups of cell rows, kept in a cache shared by all
+# the sessions. Encoding single rows would prevent grouping the colors across
+# rows, doubling the size of the redraws, while groups of 8 rows (two rows of
+# console tiles for half blocks) cost about 10% more.
+ROW_GROUP_SIZE = 8
+ROW_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=ROW_CACHE_SIZE)
+def encode_rows(
+    rows: bytes,
+    row_width: int,
+    refx: int,
+    refy: int,
+    width: int,
+    height: int,
+    color_mode: ColorMode,
+    capabilities: Capability,
+    glyph_set: GlyphSet,
+    scale: int,
+) -> bytes:
+    """Encode a group of cell rows (given as RGB pixels) printed over a blank area."""
+    image = np.frombuffer(bytearray(rows), np.uint32).reshape(-1, row_width)
+    return blit(
+        image,
+        None,
+        refx,
+        refy,
+        width,
+        height,
+        color_mode,
+        capabilities,
+        glyph_set=glyph_set,
+        scale=scale,
+    )
+
+
+class FrameBuffer:
+    """Preallocated output buffer, re-used to write the frames in place.
+
+    In streaming mode, the frame is encoded by bands, and the chunks of at least
+    `chunk_size` bytes are sent as soon as they are ready, while the next bands are
+    still being encoded. The chunks end right before an escape sequence.
+    """
+
+    # Minimum number of bands encoded in streaming mode
+    STREAM_BANDS = 4
+
+    def __init__(
+        self,
+        size: int,
+        send: Callable[[memoryview], None] | None = None,
+        chunk_size: int = 0,
+    ) -> None:
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.length = 0
+        self.bands: list[FrameBuffer] = []
+        # Start of the data that has not been sent yet
+        self.start = 0
+        self.send = send if chunk_size > 0 else None
+        self.chunk_size = chunk_size
+        self.stream_executor: ThreadPoolExecutor | None = None
+
+    def __len__(self) -> int:
+        return self.length
+
+    def clear(self) -> None:
+        self.length = 0
+        self.start = 0
+
+    def close(self) -> None:
+        if self.stream_executor is not None:
+            self.stream_executor.shutdown()
+            self.stream_executor = None
+
+    def chunk_boundary(self, position: int) -> int:
+        """Return the last position before `position` where the data can be split."""
+        index = self.data.rfind(b"\033", self.start + 1, position + 1)
+        if index > 0:
+            return index
+        # No escape sequence in the chunk, split between two characters instead
+        while position > self.start and 0x80 <= self.data[position] < 0xC0:
+            position -= 1
+        return position
+
+    def send_chunks(self) -> None:
+        """Send the complete chunks of the data that has not been sent yet."""
+        if self.send is None:
+            return
+        while self.length - self.start >= self.chunk_size:
+            stop = self.chunk_boundary(self.start + self.chunk_size)
+            if stop <= self.start:
+                break
+            self.send(self.view[self.start : stop])
+            self.start = stop
+
+    def reserve(self, size: int) -> memoryview:
+        """Return a view of at least `size` bytes at the end of the buffer."""
+        if self.length + size > len(self.data):
+            self.view.release()
+            self.data.extend(bytes(self.length + size - len(self.data)))
+            self.view = memoryview(self.data)
+        return self.view[self.length :]
+
+    def append(self, data: bytes | memoryview) -> None:
+        self.reserve(len(data))[: len(data)] = data
+        self.length += len(data)
+
+    def blit(
+        self,
+        image: npt.NDArray[np.uint8] | npt.NDArray[np.uint32],
+        last: npt.NDArray[np.uint8] | npt.NDArray[np.uint32] | None,
+        refx: int,
+        refy: int,
+        width: int,
+        height: int,
+        color_mode: ColorMode,
+        capabilities: Capability = Capability.NONE,
+        threads: int = 1,
+        palette: npt.NDArray[np.uint32] | None = None,
+        glyph_set: GlyphSet = GlyphSet.HALF_BLOCKS,
+        scale: int = 1,
+        state: npt.NDArray[np.int64] | None = None,
+    ) -> None:
+        if threads > 1 or self.send is not None:
+            self.blit_bands(
+                image,
+                last,
+                refx,
+                refy,
+                width,
+                height,
+                color_mode,
+                capabilities,
+                threads,
+                palette,
+                glyph_set,
+                scale,
+                state,
+            )
+            return
+        size = max_blit_size(image.shape[0], image.shape[1], scale)
+        output = self.reserve(size)
+        self.length += blit_into(
+            image,
+            last,
+            refx,
+            refy,
+            width,
+            height,
+            color_mode,
+            output,
+            capabilities,
+            palette,
+            glyph_set,
+            scale,
+            state,
+        )
+
+    def blit_bands(
+        self,
+        image: npt.NDArray[np.uint8] | npt.NDArray[np.uint32],
+        last: npt.NDArray[np.uint8] | npt.NDArray[np.uint32] | None,
+        refx: int,
+        refy: int,
+        width: int,
+        height: int,
+        color_mode: ColorMode,
+        capabilities: Capability,
+        threads: int,
+        palette: npt.NDArray[np.uint32] | None = None,
+        glyph_set: GlyphSet = GlyphSet.HALF_BLOCKS,
+        scale: int = 1,
+        state: npt.NDArray[np.int64] | None = None,
+    ) -> None:
+        """Encode horizontal bands of the image in parallel, and append them in order.
+
+        The encoder releases the GIL, and each band starts with an absolute move and
+        explicit colors, so the outputs can simply be concatenated. Only the first
+        band starts from the given cursor state, which is left as set by the last
+        band printing something.
+        """
+        # In streaming mode, the bands are encoded by the executor (by a dedicated
+        # thread if a single thread is used) while the previous ones are sent
+        streaming = self.send is not None
+        executor = get_encoder_executor()
+        band_count = threads
+        if streaming:
+            band_count = max(threads, self.STREAM_BANDS)
+            if threads == 1:
+                if self.stream_executor is None:
+                    self.stream_executor = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="stream-encoder"
+                    )
+                executor = self.stream_executor
+        cell_height = glyph_set.cell_height
+        rows = image.shape[0] // cell_height
+        bounds = [cell_height * (rows * i // band_count) for i in range(band_count + 1)]
+        while len(self.bands) < band_count:
+            self.bands.append(FrameBuffer(0))
+        bands = self.bands[:band_count]
+        states = [np.array(UNKNOWN_CURSOR, np.int64) for _ in bands]
+        if state is not None:
+            states[0][:] = state
+        futures: list[Future[None] | None] = []
+        for band, band_state, start, stop in zip(bands, states, bounds, bounds[1:]):
+            band.clear()
+            args = (
+                image[start:stop],
+                None if last is None else last[start:stop],
+                refx + start * scale // cell_height,
+                refy,
+                width,
+                height,
+                color_mode,
+                capabilities,
+                1,
+                palette,
+                glyph_set,
+                scale,
+                None if state is None else band_state,
+            )
+            # The first band is encoded by the current thread, unless streaming
+            if start == 0 and not streaming:
+                band.blit(*args)
+                futures.append(None)
+            else:
+                futures.append(executor.submit(band.blit, *args))
+        for band, band_state, future in zip(bands, states, futures):
+            if future is not None:
+                future.result()
+            self.append(band.getvalue())
+            self.send_chunks()
+            if state is not None and (band is bands[0] or len(band)):
+                state[:] = band_state
+
+    def blit_rows(
+        self,
+        image: npt.NDArray[np.uint32],
+        refx: int,
+        refy: int,
+        width: int,
+        height: int,
+        color_mode: ColorMode,
+        capabilities: Capability = Capability.NONE,
+        threads: int = 1,
+        glyph_set: GlyphSet = GlyphSet.HALF_BLOCKS,
+        scale: int = 1,
+    ) -> None:
+        """Encode a full redraw of an RGB image by groups of cell rows, re-using the
+        groups encoded before at the same position.
+
+        Like the bands, each group starts with an absolute move and explicit colors.
+        The groups do not depend on the cursor state, and reset the colors.
+        """
+        size = ROW_GROUP_SIZE * glyph_set.cell_height
+        groups = []
+        for start in range(0, image.shape[0], size):
+            group_refx = refx + start * scale // glyph_set.cell_height
+            if group_refx >= height:
+                break
+            rows = image[start : start + size]
+            args = (
+                rows.tobytes(),
+                rows.shape[1],
+                group_refx,
+                refy,
+                width,
+                height,
+                color_mode,
+                capabilities,
+                glyph_set,
+                scale,
+            )
+            groups.append(args)
+        if threads > 1:
+            executor = get_encoder_executor()
+            for data in executor.map(lambda args: encode_rows(*args), groups):
+                self.append(data)
+                self.send_chunks()
+        else:
+            for args in groups:
+                self.append(encode_rows(*args))
+                self.send_chunks()
+
+    def remove_prefix(self, size: int) -> None:
+        """Remove the first bytes of the data, none of which must have been sent."""
+        assert self.start == 0
+        self.data[: self.length - size] = self.data[size : self.length]
+        self.length -= size
+
+    def sixel_blit(
+        self,
+        image: npt.NDArray[np.uint8],
+        last: npt.NDArray[np.uint8] | None,
+        palette: npt.NDArray[np.uint32],
+        refx: int,
+        refy: int,
+        scale: int,
+    ) -> None:
+        size = max_sixel_size(image.shape[0], image.shape[1], scale)
+        output = self.reserve(size)
+        self.length += sixel_blit_into(image, last, palette, refx, refy, scale, output)
+
+    def getvalue(self) -> memoryview:
+        """Return the data that has not been sent yet."""
+        return self.view[self.start : self.length]
+
+
+class TerminalState:
+    """What the terminal already has, apart from the pixels.
+
+    The window title is only sent when it changes, and the cursor position and
+    colors left by a frame are kept for the next one instead of being reset. The
+    synchronized output mode is only used if the terminal might support it, and not
+    for the incremental frames that change no pixels. The bytes written are counted
+    by category
+    (pixels, sync, title, reset, clear, palette, cpr), to measure the overhead.
+    """
+
+    def __init__(self, synchronized_output: bool = True) -> None:
+        self.synchronized_output = synchronized_output
+        self.cursor = np.array(UNKNOWN_CURSOR, np.int64)
+        self.title = b""
+        self.counters: Counter[str] = Counter()
+        # Start of the pixels in the current frame, and bytes written since
+        self.frame_start = 0
+        self.frame_overhead = 0
+        self.frame_title = 0
+
+    def write(self, frame_data: FrameBuffer, category: str, data: bytes) -> None:
+        frame_data.append(data)
+        self.counters[category] += len(data)
+        self.frame_overhead += len(data)
+
+    def reset(self) -> bytes:
+        """Return the sequence resetting the colors, if set by the last frame."""
+        if (self.cursor[2:] == UNKNOWN_COLOR).all():
+            return b""
+        self.cursor[2:] = UNKNOWN_COLOR
+        return RESET_COLORS
+
+    def forget_cursor(self) -> None:
+        """Forget the cursor position and colors, after a full redraw by groups."""
+        self.cursor[:] = UNKNOWN_CURSOR
+
+    def begin_frame(self, frame_data: FrameBuffer, clear_sequence: bytes) -> None:
+        if self.synchronized_output:
+            self.write(frame_data, "sync", SYNC_BEGIN)
+        if clear_sequence:
+            # Erasing uses the current background color
+            self.write(frame_data, "reset", self.reset())
+            self.write(frame_data, "clear", clear_sequence)
+            self.forget_cursor()
+        self.frame_start = len(frame_data)
+        self.frame_overhead = 0
+        self.frame_title = 0
+
+    def end_frame(self, frame_data: FrameBuffer, incremental: bool) -> None:
+        pixels = len(frame_data) - self.frame_start - self.frame_overhead
+        self.counters["pixels"] += pixels
+        if not self.synchronized_output:
+            return
+        # Even small frames may be split by the connection (e.g. over ssh or telnet)
+        # and displayed half drawn, so only the frames changing nothing but the title
+        # are not wrapped
+        changes = len(frame_data) - self.frame_start - self.frame_title
+        if incremental and frame_data.start == 0 and changes == 0:
+            frame_data.remove_prefix(len(SYNC_BEGIN))
+            self.counters["sync"] -= len(SYNC_BEGIN)
+            return
+        self.write(frame_data, "sync", SYNC_END)
+
+    def request_position(self, frame_data: FrameBuffer) -> None:
+        """Write a cursor position report request (CPR), moving the cursor."""
+        self.write(frame_data, "cpr", CPR_REQUEST)
+        self.cursor[:2] = -1
+
+    def set_title(self, frame_data: FrameBuffer, sequence: bytes) -> None:
+        if sequence != self.title:
+            self.write(frame_data, "title", sequence)
+            self.frame_title += len(sequence)
+            self.title = sequence
+
+    def overhead(self) -> float:
+        """Return the share of the bytes written that are not pixels."""
+        total = sum(self.counters.values())
+        return 1 - self.counters["pixels"] / total if total else 0.0
+
+
+def write_frame(term: Terminal, frame_data: bytes | bytearray | memoryview) -> None:
     # Fix code page issue on windows:
     # `sys.stdout.buffer.raw` is a `WindowsConsoleIO` that always support UTF-8
     # regardless of the configured codepage
@@ -57,18 +707,64 @@ def run(
     break_after: int | None = None,
     speed: float = 1.0,
     use_cpr_sync: bool = False,
+    encoder_threads: int = 1,
+    renderer: Renderer = Renderer.BLOCKS,
+    fit_terminal: bool = False,
+    perceptual_threshold: float = 0.0,
+    interlaced: bool = False,
+    deflicker: bool = False,
+    stream_chunk_size: int = 0,
 ) -> None:
     assert color_mode > 0
+    assert encoder_threads > 0
+    assert perceptual_threshold >= 0
 
-    # Prepare buffers with invalid data
+    # Prepare buffers with invalid data.
+    # The video buffer is quantized to the colors of the terminal, then stored as
+    # palette indices into the frame buffer. The frame buffer and the last frame
+    # buffer are swapped after each rendered frame.
     video = np.full((console.HEIGHT, console.WIDTH), 0, np.uint32)
     audio = np.full((2 * console.TICKS_IN_FRAME, 2), 0, np.int16)
-    last_frame = video.copy()
+    quantized = video.copy()
+    frame = np.full((console.HEIGHT, console.WIDTH), 0, np.uint8)
+    last_frame = frame.copy()
+    palette = Palette()
+    palette.size = get_palette_size(color_mode)
+    terminal_palette = TerminalPalette()
+    redraw = True
 
     # Print area (default to 24x80 if terminal reports zero)
     height = term.height or 24
     width = term.width or 80
-    refx, refy = get_ref(width, height, console)
+    scale = 1
+    if fit_terminal:
+        scale = get_fit_scale(width, height, console, renderer.glyph_set)
+    refx, refy = get_ref(width, height, console, renderer.glyph_set, scale)
+
+    # Sixel and kitty images use the colors of the emulator, at an integer scale.
+    # Kitty images are transmitted using shared memory if the terminal is local.
+    sixel = renderer == Renderer.SIXEL
+    kitty = renderer == Renderer.KITTY
+    image_scale, image_columns, image_rows = 1, 0, 0
+    if sixel or kitty:
+        layout = get_image_layout(term, width, height, console)
+        image_scale, refx, refy, image_columns, image_rows = layout
+    kitty_graphics = KittyGraphics(
+        shared_memory=not isinstance(term, RemoteTerminal)
+        and "SSH_CONNECTION" not in os.environ
+    )
+    last_quantized = quantized.copy()
+
+    # Optional lossy updates, ignoring the color changes below the threshold
+    lossy_filter = None
+    if perceptual_threshold:
+        lossy_filter = LossyFilter(
+            perceptual_threshold, (console.HEIGHT, console.WIDTH)
+        )
+
+    # Optional terminal features used by the encoder
+    capabilities = detect_capabilities(term)
+    terminal_state = TerminalState(detect_synchronized_output(term))
 
     # Prepare reporting
     fps = console.FPS * speed
@@ -84,147 +780,318 @@ def run(
     data_length: Deque[int] = deque(maxlen=average_over)
     start = time.time()
 
+    # Optional blending of the tiles flickering on every other frame
+    flicker_filter = None
+    if deflicker:
+        flicker_filter = Deflicker((console.HEIGHT, console.WIDTH))
+
+    # When the terminal cannot keep up, either skip frames or print half of
+    # the rows (in groups of cell rows or sixel bands) in alternance
+    interlaced = interlaced and not kitty
+    interlace_group = 6 if sixel else renderer.glyph_set.cell_height
+    field = 0
+
     # Prepare state
     new_frame = False
     screen_ready = True
     frame_start_time = None
-    frame_data = bytearray()
+    # In streaming mode, the frames are sent by chunks while they are encoded
+    frame_data = FrameBuffer(
+        max_blit_size(console.HEIGHT, console.WIDTH) + 4096,
+        send=functools.partial(write_frame, term),
+        chunk_size=stream_chunk_size,
+    )
     current_title_sequence = b""
 
-    # Loop over emulator frames
-    for i in count():
-        # Add total deltas
-        if frame_start_time is not None:
-            total_deltas.append(time.perf_counter() - frame_start_time)
-        frame_start_time = time.perf_counter()
+    try:
+        # Loop over emulator frames
+        for i in count():
+            # Add total deltas
+            if frame_start_time is not None:
+                total_deltas.append(time.perf_counter() - frame_start_time)
+            frame_start_time = time.perf_counter()
 
-        # Break when frame limit is reach
-        if break_after is not None and i >= break_after:
-            return
+            # Break when frame limit is reach
+            if break_after is not None and i >= break_after:
+                return
 
-        # Tick the emulator
-        with timing(emu_deltas):
-            console.set_input(input_getter.get_pressed())
-            offset, samples = console.advance_one_frame(video, audio)
-            new_frame = new_frame or offset > 0
-            ticks.append(samples)
-
-        # Send audio
-        with timing(audio_deltas):
-            audio_out.send(console, audio[:samples, :])
-
-        # Read keys for ctrl-c, ctrl-d, and CPR response.
-        # If the kitty keyboard protocol is used, all inputs are sent as CSI sequences
-        # (e.g. `\x1b[99;5u` rather than raw `\x03`), so we check blessed's
-        # decoded `key_name` attribute, since it ends up being `KEY_CTRL_C` for ctrl+c
-        # and `KEY_CTRL_D` for ctrl+d regardless of the underlying encoding.
-        new_color_mode = color_mode
-        for key in input_getter.pop_keystrokes():
-            if key.key_name == "KEY_CTRL_C":
-                raise KeyboardInterrupt
-            if key.key_name == "KEY_CTRL_D":
-                raise EOFError
-            if key.key_name == "KEY_TAB":
-                new_color_mode = color_mode.cycle()
-            if key.key_name in ("KEY_PGUP", "KEY_PGDOWN"):
-                speed += 0.1 if key.key_name == "KEY_PGUP" else -0.1
-                fps = console.FPS * speed
-                average_over = int(round(fps))  # frames
-                audio_out.update_speed(console, speed)
-            if _CPR_RE.match(str(key)):
-                screen_ready = True
-
-        # Render video
-        with timing(video_deltas):
-            # Re-use the same buffer to accumulate frame data and avoid unnecessary allocations.
-            frame_data.clear()
-
-            # Detect if a shift is currently happening
-            shift = shifting and shifting[-1] > 1 / fps
-
-            # Render a new frame only if:
-            # - it is the right time according to frame_advance
-            # - a new frame is available from the emulator
-            # - the screen is ready for a new frame (either CPR sync is disabled, or enabled and we received the CPR response)
-            # - we are not currently shifting (to prevent flooding the terminal with new frames when the rendering is too slow)
-            if i % frame_advance == 0 and new_frame and screen_ready and not shift:
-                new_frame = False
-
-                # Detect terminal resize and color mode change
-                new_height = term.height or 24
-                new_width = term.width or 80
-                maybe_clear_sequence = b""
-                if (new_height, new_width) != (
-                    height,
-                    width,
-                ) or new_color_mode != color_mode:
-                    maybe_clear_sequence = b"\033[H\033[2J"
-                    height, width = new_height, new_width
-                    refx, refy = get_ref(width, height, console)
-                    color_mode = new_color_mode
-                    term.number_of_colors = new_color_mode.number_of_colors
-                    last_frame.fill(0)
-
-                # Render frame with synchronized output mode (DEC 2026) to prevent flickering
-                # when the screen is cleared, or an artificial CRT-like "rolling band" side-effects
-                # from fast "sprite blinking" meant to cause "transparency" effect on original HW,
-                # https://zladx.github.io/posts/links-awakening-partial-translucency
-                frame_data += b"\033[?2026h"
-                frame_data += maybe_clear_sequence
-                frame_data += blit(
-                    video, last_frame, refx, refy, width - 1, height, color_mode
-                )
-                frame_data += b"\033[?2026l"
-                last_frame = video.copy()
+            # Tick the emulator
+            with timing(emu_deltas):
+                console.set_input(input_getter.get_pressed())
+                offset, samples = console.advance_one_frame(video, audio)
+                new_frame = new_frame or offset > 0
+                ticks.append(samples)
 
-                # Update reporting
-                data_length.append(len(frame_data))
-                shown_frames.append(True)
+            # Send audio
+            with timing(audio_deltas):
+                audio_out.send(console, audio[:samples, :])
 
-            # Ignore this video frame
-            else:
-                data_length.append(0)
-                shown_frames.append(False)
-
-        # Pacing and synchronization
-        with timing(sync_deltas):
-            # Video sync
-            if frame_data:
-                # Send CPR request
-                if use_cpr_sync:
-                    frame_data += b"\033[1;1H\033[6n"
-                    screen_ready = False
-                # Add the current title
-                frame_data += current_title_sequence
-                # Write the entire frame in one go to avoid fragmentation
-                write_frame(term, frame_data)
-            # Timing sync
-            increment = samples / console.TICKS_IN_FRAME
-            deadline = start + increment / fps
-            current = time.time()
-            if current < deadline - 1e-3:
-                time.sleep(deadline - current)
-            # Use deadline as new reference to prevent shifting
-            shifting.append(time.time() - deadline)
-            start = deadline
-
-        # Prepare title for the next frame
-        if i % average_over == 1:
-            tps = fps * console.TICKS_IN_FRAME
-            emu_fps = tps * len(ticks) / sum(ticks)
-            video_fps = emu_fps * sum(shown_frames) / len(shown_frames)
-            total_fps = len(total_deltas) / sum(total_deltas)
-            emu_percent = sum(emu_deltas) / len(emu_deltas) * total_fps * 100
-            audio_percent = sum(audio_deltas) / len(audio_deltas) * total_fps * 100
-            video_percent = sum(video_deltas) / len(video_deltas) * total_fps * 100
-            data_rate = sum(data_length) / len(data_length) * total_fps / 1000
-            title = f"Gambaterm - {total_fps:.0f} FPS | "
-            title += f"{os.path.basename(console.romfile)} | "
-            title += (
-                f"Emu: {speed:.2f}x - {emu_fps:.0f} FPS - {emu_percent:.0f}% CPU | "
-            )
-            title += f"Video: {video_fps:.0f} FPS - {video_percent:.0f}% CPU - "
-            title += f"{data_rate:.0f} KB/s | "
-            title += f"Audio: {audio_percent:.0f}% CPU | "
-            title += f"{color_mode.report()} mode"
-            current_title_sequence = term.set_window_title(title).encode("utf-8")
+            # Read keys for ctrl-c, ctrl-d, and CPR response.
+            # If the kitty keyboard protocol is used, all inputs are sent as CSI sequences
+            # (e.g. `\x1b[99;5u` rather than raw `\x03`), so we check blessed's
+            # decoded `key_name` attribute, since it ends up being `KEY_CTRL_C` for ctrl+c
+            # and `KEY_CTRL_D` for ctrl+d regardless of the underlying encoding.
+            new_color_mode = color_mode
+            for key in input_getter.pop_keystrokes():
+                if key.key_name == "KEY_CTRL_C":
+                    raise KeyboardInterrupt
+                if key.key_name == "KEY_CTRL_D":
+                    raise EOFError
+                if key.key_name == "KEY_TAB":
+                    new_color_mode = color_mode.cycle()
+                if key.key_name in ("KEY_PGUP", "KEY_PGDOWN"):
+                    speed += 0.1 if key.key_name == "KEY_PGUP" else -0.1
+                    fps = console.FPS * speed
+                    average_over = int(round(fps))  # frames
+                    audio_out.update_speed(console, speed)
+                if _CPR_RE.match(str(key)):
+                    screen_ready = True
+
+            # Render video
+            with timing(video_deltas):
+                # Re-use the same buffer to accumulate frame data and avoid unnecessary allocations.
+                frame_data.clear()
+
+                # Detect if a shift is currently happening
+                shift = shifting and shifting[-1] > 1 / fps
+
+                # Render a new frame only if:
+                # - it is the right time according to frame_advance
+                # - a new frame is available from the emulator
+                # - the screen is ready for a new frame (either CPR sync is disabled, or enabled and we received the CPR response)
+                # - we are not currently shifting (to prevent flooding the terminal with new frames when the rendering is too slow),
+                #   unless interlacing is enabled, in which case only half of the rows are printed
+                if (
+                    i % frame_advance == 0
+                    and new_frame
+                    and screen_ready
+                    and (not shift or interlaced)
+                ):
+                    new_frame = False
+
+                    # Detect terminal resize and color mode change
+                    new_height = term.height or 24
+                    new_width = term.width or 80
+                    maybe_clear_sequence = b""
+                    if (new_height, new_width) != (
+                        height,
+                        width,
+                    ) or new_color_mode != color_mode:
+                        maybe_clear_sequence = CLEAR_SCREEN
+                        if new_color_mode != color_mode:
+                            maybe_clear_sequence += terminal_palette.restore()
+                        height, width = new_height, new_width
+                        if fit_terminal:
+                            scale = get_fit_scale(
+                                width, height, console, renderer.glyph_set
+                            )
+                        refx, refy = get_ref(
+                            width, height, console, renderer.glyph_set, scale
+                        )
+                        if sixel or kitty:
+                            layout = get_image_layout(term, width, height, console)
+                            image_scale, refx, refy, image_columns, image_rows = layout
+                        color_mode = new_color_mode
+                        palette.size = get_palette_size(color_mode)
+                        term.number_of_colors = new_color_mode.number_of_colors
+                        redraw = True
+
+                    # Render frame with synchronized output mode (DEC 2026) to prevent flickering
+                    # when the screen is cleared, or an artificial CRT-like "rolling band" side-effects
+                    # from fast "sprite blinking" meant to cause "transparency" effect on original HW,
+                    # https://zladx.github.io/posts/links-awakening-partial-translucency
+                    # Static screens (menus, text boxes, pause screens) are skipped altogether,
+                    # as well as color changes that the terminal cannot display (e.g. fades).
+                    source = video
+                    if flicker_filter:
+                        source = flicker_filter.apply(video)
+                    if kitty:
+                        quantize(source, ColorMode.HAS_24_BIT_COLOR, quantized)
+                        if lossy_filter and not redraw:
+                            lossy_filter.apply(quantized)
+                        if redraw or not is_unchanged(quantized, last_quantized):
+                            terminal_state.begin_frame(frame_data, maybe_clear_sequence)
+                            frame_data.append(
+                                kitty_graphics.blit(
+                                    quantized,
+                                    None if redraw else last_quantized,
+                                    refx,
+                                    refy,
+                                    image_columns,
+                                    image_rows,
+                                )
+                            )
+                            terminal_state.end_frame(frame_data, not redraw)
+                            if lossy_filter:
+                                lossy_filter.commit(quantized)
+                            quantized, last_quantized = last_quantized, quantized
+                            redraw = False
+                    else:
+                        quantize(
+                            source,
+                            ColorMode.HAS_24_BIT_COLOR if sixel else color_mode,
+                            quantized,
+                        )
+                        if lossy_filter and not redraw:
+                            lossy_filter.apply(quantized)
+                        if shift and not redraw:
+                            interlace(
+                                quantized,
+                                palette.colors[last_frame],
+                                field,
+                                interlace_group,
+                            )
+                            field ^= 1
+                        indexed = palette.index(quantized, frame)
+                        # Sixel frames with too many colors are reduced to 256 colors,
+                        # and printed entirely using a new palette
+                        if sixel and not indexed:
+                            palette = Palette()
+                            quantize(source, ColorMode.HAS_8_BIT_COLOR, quantized)
+                            indexed = palette.index(quantized, frame)
+                            redraw = True
+                        if redraw or not indexed or not is_unchanged(frame, last_frame):
+                            terminal_state.begin_frame(frame_data, maybe_clear_sequence)
+                            if indexed and sixel:
+                                frame_data.sixel_blit(
+                                    frame,
+                                    None if redraw else last_frame,
+                                    palette.colors,
+                                    refx,
+                                    refy,
+                                    image_scale,
+                                )
+                                frame, last_frame = last_frame, frame
+                                palette.commit()
+                            elif indexed and not (
+                                redraw and color_mode != ColorMode.HAS_PALETTE_COLOR
+                            ):
+                                if color_mode == ColorMode.HAS_PALETTE_COLOR:
+                                    terminal_state.write(
+                                        frame_data,
+                                        "palette",
+                                        terminal_palette.update(palette),
+                                    )
+                                frame_data.blit(
+                                    frame,
+                                    None if redraw else last_frame,
+                                    refx,
+                                    refy,
+                                    width - 1,
+                                    height,
+                                    color_mode,
+                                    capabilities,
+                                    encoder_threads,
+                                    palette.colors,
+                                    renderer.glyph_set,
+                                    scale,
+                                    terminal_state.cursor,
+                                )
+                                frame, last_frame = last_frame, frame
+                                palette.commit()
+                            # Full redraws are printed by groups of rows from the RGB
+                            # colors, re-using the groups encoded before. Frames with too many
+                            # colors are printed this way too, using 256 colors
+                            # instead of the palette in the palette color mode, the
+                            # standard 256 colors being restored first.
+                            else:
+                                if color_mode == ColorMode.HAS_PALETTE_COLOR:
+                                    terminal_state.write(
+                                        frame_data,
+                                        "palette",
+                                        terminal_palette.restore(),
+                                    )
+                                frame_data.blit_rows(
+                                    quantized,
+                                    refx,
+                                    refy,
+                                    width - 1,
+                                    height,
+                                    (
+                                        ColorMode.HAS_8_BIT_COLOR
+                                        if color_mode == ColorMode.HAS_PALETTE_COLOR
+                                        else color_mode
+                                    ),
+                                    capabilities,
+                                    encoder_threads,
+                                    renderer.glyph_set,
+                                    scale,
+                                )
+                                terminal_state.forget_cursor()
+                                if indexed:
+                                    frame, last_frame = last_frame, frame
+                                    palette.commit()
+                            terminal_state.end_frame(frame_data, not redraw)
+                            if lossy_filter:
+                                lossy_filter.commit(quantized)
+                            redraw = not indexed
+
+                    # Update reporting
+                    data_length.append(len(frame_data))
+                    shown_frames.append(True)
+
+                # Ignore this video frame
+                else:
+                    data_length.append(0)
+                    shown_frames.append(False)
+
+            # Pacing and synchronization
+            with timing(sync_deltas):
+                # Video sync (also send the title if it changed during a static screen)
+                if frame_data or current_title_sequence != terminal_state.title:
+                    # Send CPR request
+                    if frame_data and use_cpr_sync:
+                        terminal_state.request_position(frame_data)
+                        screen_ready = False
+                    # Add the title, if it changed
+                    terminal_state.set_title(frame_data, current_title_sequence)
+                    # Write the entire frame in one go to avoid fragmentation
+                    write_frame(term, frame_data.getvalue())
+                # Timing sync
+                increment = samples / console.TICKS_IN_FRAME
+                deadline = start + increment / fps
+                current = time.time()
+                if current < deadline - 1e-3:
+                    time.sleep(deadline - current)
+                # Use deadline as new reference to prevent shifting
+                shifting.append(time.time() - deadline)
+                start = deadline
+
+            # Prepare title for the next frame
+            if i % average_over == 1:
+                tps = fps * console.TICKS_IN_FRAME
+                emu_fps = tps * len(ticks) / sum(ticks)
+                video_fps = emu_fps * sum(shown_frames) / len(shown_frames)
+                total_fps = len(total_deltas) / sum(total_deltas)
+                emu_percent = sum(emu_deltas) / len(emu_deltas) * total_fps * 100
+                audio_percent = sum(audio_deltas) / len(audio_deltas) * total_fps * 100
+                video_percent = sum(video_deltas) / len(video_deltas) * total_fps * 100
+                data_rate = sum(data_length) / len(data_length) * total_fps / 1000
+                control_percent = terminal_state.overhead() * 100
+                title = f"Gambaterm - {total_fps:.0f} FPS | "
+                title += f"{os.path.basename(console.romfile)} | "
+                title += (
+                    f"Emu: {speed:.2f}x - {emu_fps:.0f} FPS - {emu_percent:.0f}% CPU | "
+                )
+                title += f"Video: {video_fps:.0f} FPS - {video_percent:.0f}% CPU - "
+                title += f"{data_rate:.0f} KB/s - {control_percent:.0f}% control | "
+                title += f"Audio: {audio_percent:.0f}% CPU | "
+                reports = []
+                if renderer != Renderer.BLOCKS:
+                    reports.append(f"{renderer.report()} renderer")
+                if not sixel and not kitty:
+                    reports.append(f"{color_mode.report()} mode")
+                title += " - ".join(reports)
+                current_title_sequence = term.set_window_title(title).encode("utf-8")
+
+    # Reset the colors left by the last frame, restore the terminal colors redefined
+    # in the palette color mode, and delete the kitty image
+    finally:
+        frame_data.close()
+        with contextlib.suppress(OSError):
+            if restore_sequence := (
+                terminal_state.reset()
+                + terminal_palette.restore()
+                + kitty_graphics.close()
+            ):
+                write_frame(term, restore_sequence)
@@ -351,6 +351,13 @@ sandbox. More information here: https://security.stackexchange.com/a/7496
                 break_after=app_config.break_after,
                 speed=app_config.speed,
                 use_cpr_sync=app_config.cpr_sync,
+                encoder_threads=app_config.encoder_threads,
+                renderer=app_config.renderer,
+                fit_terminal=app_config.fit_terminal,
+                perceptual_threshold=app_config.perceptual_threshold,
+                interlaced=app_config.interlaced,
+                deflicker=app_config.deflicker,
+                stream_chunk_size=app_config.stream_chunk_size,
             )
             return 0
     finally:
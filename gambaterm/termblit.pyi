@@ -1,12 +1,63 @@
 import numpy as np
 import numpy.typing as npt
 
-def blit(
+def is_unchanged(
+    image: npt.NDArray[np.uint8] | npt.NDArray[np.uint32],
+    last: npt.NDArray[np.uint8] | npt.NDArray[np.uint32],
+) -> bool: ...
+def quantize(
+    image: npt.NDArray[np.uint32], color_mode: int, output: npt.NDArray[np.uint32]
+) -> None: ...
+def index_colors(
+    image: npt.NDArray[np.uint32],
+    palette: npt.NDArray[np.uint32],
+    stamps: npt.NDArray[np.int64],
+    generation: int,
+    output: npt.NDArray[np.uint8],
+    size: int = 256,
+) -> bool: ...
+def perceptual_filter(
     image: npt.NDArray[np.uint32],
-    last: npt.NDArray[np.uint32] | None,
+    displayed: npt.NDArray[np.uint32],
+    threshold: float,
+) -> bool: ...
+def max_blit_size(image_height: int, image_width: int, scale: int = 1) -> int: ...
+def blit(
+    image: npt.NDArray[np.uint8] | npt.NDArray[np.uint32],
+    last: npt.NDArray[np.uint8] | npt.NDArray[np.uint32] | None,
     refx: int,
     refy: int,
     width: int,
     height: int,
     color_mode: int,
+    capabilities: int = 0,
+    palette: npt.NDArray[np.uint32] | None = None,
+    glyph_set: int = 0,
+    scale: int = 1,
+    state: npt.NDArray[np.int64] | None = None,
 ) -> bytes: ...
+def blit_into(
+    image: npt.NDArray[np.uint8] | npt.NDArray[np.uint32],
+    last: npt.NDArray[np.uint8] | npt.NDArray[np.uint32] | None,
+    refx: int,
+    refy: int,
+    width: int,
+    height: int,
+    color_mode: int,
+    output: bytearray | memoryview,
+    capabilities: int = 0,
+    palette: npt.NDArray[np.uint32] | None = None,
+    glyph_set: int = 0,
+    scale: int = 1,
+    state: npt.NDArray[np.int64] | None = None,
+) -> int: ...
+def max_sixel_size(image_height: int, image_width: int, scale: int = 1) -> int: ...
+def sixel_blit_into(
+    image: npt.NDArray[np.uint8],
+    last: npt.NDArray[np.uint8] | None,
+    palette: npt.NDArray[np.uint32],
+    refx: int,
+    refy: int,
+    scale: int,
+    output: bytearray | memoryview,
+) -> int: ...
@@ -0,0 +1,138 @@
+"""Record the frame corpus used by the encoder benchmark (`tests/benchmark.py`).
+
+The static scene is recorded from the test rom, the other ones are rendered from a
+game boy like background (a scrolling map of 8x8 tiles using 4-color palettes) and
+sprites, covering the usual cases: scrolling, moving and flickering sprites, fades
+and full transitions.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+
+from gambaterm.console import GameboyColor
+
+TESTS = Path(__file__).parent.parent / "tests"
+TEST_ROM = TESTS / "test_rom.gb"
+CORPUS = TESTS / "corpus.npz"
+
+FRAMES_PER_SCENE = 8
+WIDTH, HEIGHT = GameboyColor.WIDTH, GameboyColor.HEIGHT
+MAP_SIZE = 32  # tiles
+TILE_SIZE = 8  # pixels
+
+
+def expand(colors: npt.NDArray[np.int64]) -> npt.NDArray[np.uint32]:
+    """Expand 15-bit colors to 24-bit colors."""
+    r, g, b = colors & 0x1F, (colors >> 5) & 0x1F, (colors >> 10) & 0x1F
+    r, g, b = (r << 3) | (r >> 2), (g << 3) | (g >> 2), (b << 3) | (b >> 2)
+    return (0xFF000000 | (r << 16) | (g << 8) | b).astype(np.uint32)
+
+
+class Scene:
+    """Background map and sprites, rendered like the game boy PPU does."""
+
+    def __init__(self, seed: int) -> None:
+        rng = np.random.default_rng(seed)
+        # Tiles: half of them flat with a few details (sky, ground), the others
+        # made of horizontal strokes (bricks, grass, text)
+        tiles = np.zeros((64, TILE_SIZE, TILE_SIZE), np.int64)
+        for index, tile in enumerate(tiles):
+            if index < 32:
+                tile[:] = index % 4
+                tile[rng.random((TILE_SIZE, TILE_SIZE)) < 0.1] = rng.integers(0, 4)
+            else:
+                strokes = rng.integers(0, 4, (TILE_SIZE, 3))
+                tile[:] = np.repeat(strokes, 3, axis=1)[:, :TILE_SIZE]
+        self.tiles = tiles
+        # Map: flat tiles on top, detailed ones below, each row using a palette
+        self.map = np.where(
+            np.arange(MAP_SIZE)[:, None] < MAP_SIZE // 2,
+            rng.integers(0, 32, (MAP_SIZE, MAP_SIZE)),
+            rng.integers(32, 64, (MAP_SIZE, MAP_SIZE)),
+        )
+        self.attributes = rng.integers(0, 4, (MAP_SIZE, MAP_SIZE))
+        self.palettes = expand(rng.integers(0, 1 << 15, (8, 4)))
+        # Sprites: position (row, column) and index
+        self.sprites = [
+            (int(rng.integers(0, HEIGHT - 16)), int(rng.integers(0, WIDTH - 16)), i)
+            for i in range(10)
+        ]
+        self.sprite_tiles = rng.integers(0, 4, (10, 16, 16))
+
+    def render(
+        self,
+        scx: int = 0,
+        scy: int = 0,
+        sprite_offset: int = 0,
+        visible_sprites: slice = slice(None),
+        fade: float = 0.0,
+    ) -> npt.NDArray[np.uint32]:
+        rows = (np.arange(HEIGHT) + scy) % (MAP_SIZE * TILE_SIZE)
+        columns = (np.arange(WIDTH) + scx) % (MAP_SIZE * TILE_SIZE)
+        tile_rows, tile_columns = rows // TILE_SIZE, columns // TILE_SIZE
+        tile_indices = self.map[tile_rows[:, None], tile_columns[None, :]]
+        pixels = self.tiles[
+            tile_indices, (rows % TILE_SIZE)[:, None], (columns % TILE_SIZE)[None, :]
+        ]
+        palettes = self.attributes[tile_rows[:, None], tile_columns[None, :]]
+        image = self.palettes[palettes, pixels]
+        for row, column, index in self.sprites[visible_sprites]:
+            # Sprites move down by one pixel and right by two pixels per step
+            row = (row + sprite_offset) % (HEIGHT - 16)
+            column = (column + 2 * sprite_offset) % (WIDTH - 16)
+            tile = self.sprite_tiles[index]
+            colors = self.palettes[4 + index % 4][tile]
+            area = image[row : row + 16, column : column + 16]
+            area[tile != 0] = colors[tile != 0]
+        if fade:
+            r, g, b = (image >> 16) & 0xFF, (image >> 8) & 0xFF, image & 0xFF
+            r, g, b = (
+                (c + (0xFF - c) * fade).astype(np.uint32) & 0xF8 for c in (r, g, b)
+            )
+            image = (0xFF000000 | (r << 16) | (g << 8) | b).astype(np.uint32)
+        return np.ascontiguousarray(image)
+
+
+def record_static() -> npt.NDArray[np.uint32]:
+    """Record the first frames of the test rom."""
+    console = GameboyColor(TEST_ROM)
+    video = np.zeros((HEIGHT, WIDTH), np.uint32)
+    audio = np.zeros((2 * console.TICKS_IN_FRAME, 2), np.int16)
+    frames: list[npt.NDArray[np.uint32]] = []
+    while len(frames) < FRAMES_PER_SCENE:
+        offset, _ = console.advance_one_frame(video, audio)
+        if offset > 0:
+            frames.append(video.copy())
+    return np.array(frames)
+
+
+def main() -> None:
+    scene, other = Scene(0), Scene(1)
+    steps = range(FRAMES_PER_SCENE)
+    corpus: dict[str, list[npt.NDArray[np.uint32]]] = {
+        "static": list(record_static()),
+        "scroll_horizontal": [scene.render(scx=step) for step in steps],
+        "scroll_vertical": [scene.render(scy=step) for step in steps],
+        "sprites": [scene.render(sprite_offset=step) for step in steps],
+        "flicker": [
+            scene.render(visible_sprites=slice(step % 2, None, 2)) for step in steps
+        ],
+        "fade": [scene.render(fade=step / FRAMES_PER_SCENE) for step in steps],
+        "transition": [(scene, other)[step % 2].render() for step in steps],
+    }
+    # The frames are stored as palette indices, to keep the corpus small
+    arrays: dict[str, npt.NDArray[np.uint8] | npt.NDArray[np.uint32]] = {}
+    for name, frames in corpus.items():
+        colors, indices = np.unique(np.array(frames), return_inverse=True)
+        assert len(colors) <= 256
+        arrays[name] = indices.reshape(len(frames), HEIGHT, WIDTH).astype(np.uint8)
+        arrays[f"{name}_palette"] = colors
+    np.savez_compressed(CORPUS, **arrays)  # type: ignore[arg-type]
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,14 @@
 # cython: language_level=3
 
+import threading
+
 from cython import boundscheck
+from cython cimport view
+from libc.math cimport cbrtf
 from libc.stdio cimport sprintf
-from libc.stdlib cimport malloc, free
-from libc.stdint cimport uint32_t
-
-cdef char* move_absolute(char* buff, int x, int y) noexcept nogil:
-    buff += sprintf(buff, "\033[%d;%dH", x, y)
-    return buff
-
-
-cdef char* move_relative(char* buff, int dx, int dy) noexcept nogil:
-    # Vertical move
-    if dx < -1:
-        buff += sprintf(buff, "\033[%dA", -dx)
-    elif dx == -1:
-        buff += sprintf(buff, "\033[A")
-    elif dx == 1:
-        buff += sprintf(buff, "\033[B")
-    elif dx > 1:
-        buff += sprintf(buff, "\033[%dB", dx)
-    # Horizontal move
-    if dy < -1:
-        buff += sprintf(buff, "\033[%dD", -dy)
-    elif dy == -1:
-        buff += sprintf(buff, "\033[D")
-    elif dy == 1:
-        buff += sprintf(buff, "\033[C")
-    elif dy > 1:
-        buff += sprintf(buff, "\033[%dC", dy)
-    return buff
-
-
+from libc.stdlib cimport malloc, free, qsort
+from libc.string cimport memcpy, memcmp, memmove, memset
+from libc.stdint cimport uint8_t, uint32_t, int64_t, uint64_t
 
 cdef int scale_256_to_6_shift(int x) noexcept nogil:
     x >>= 5
@@ -95,7 +72,23 @@ cdef int scale_rgb_to_4_colors(int r, int g, int b) noexcept nogil:
     # White color
     return 97
 
-cdef char* set_color(char* buff, int n, int color_mode, int foreground) noexcept nogil:
+cdef int color_index(int n, int color_mode) noexcept nogil:
+    # Terminal color used for the given RGB color, in the standard color modes
+    # (foreground SGR code for 4 and 16 colors, palette index for 256 colors)
+    cdef int b = n & 0xff
+    cdef int g = (n >> 8) & 0xff
+    cdef int r = (n >> 16) & 0xff
+    if color_mode == 1:
+        return scale_rgb_to_4_colors(r, g, b)
+    if color_mode == 2:
+        return scale_rgb_to_16_colors(r, g, b)
+    b = scale_256_to_6_shift(b)
+    g = scale_256_to_6_shift(g)
+    r = scale_256_to_6_shift(r)
+    return 16 + 36 * r + 6 * g + b
+
+
+cdef char* format_color(char* buff, int n, int color_mode, int foreground) noexcept nogil:
     cdef int c
     # Extract RGB components
     cdef int b = n & 0xff
@@ -103,19 +96,13 @@ cdef char* set_color(char* buff, int n, int color_mode, int foreground) noexcept
     cdef int r = (n >> 16) & 0xff
     # Standard colors
     if color_mode <= 2:
-        if color_mode == 1:
-            c = scale_rgb_to_4_colors(r, g, b)
-        elif color_mode == 2:
-            c = scale_rgb_to_16_colors(r, g, b)
+        c = color_index(n, color_mode)
         if not foreground:
             c += 10
         buff += sprintf(buff, "\033[%dm", c)
     # 256 colors
     elif color_mode == 3:
-        b = scale_256_to_6_shift(b)
-        g = scale_256_to_6_shift(g)
-        r = scale_256_to_6_shift(r)
-        c = 16 + 36 * r + 6 * g + b
+        c = color_index(n, color_mode)
         if foreground:
             buff += sprintf(buff, "\033[38;5;%dm", c)
         else:
@@ -129,126 +116,1889 @@ cdef char* set_color(char* buff, int n, int color_mode, int foreground) noexcept
     return buff
 
 
-cdef char* set_background(char* buff, int n, int color_mode) noexcept nogil:
+# Pre-formatted escape sequences, so that emitting a color boils down to a memcpy
+cdef struct Sgr:
+    char data[15]
+    unsigned char length
+
+
+# The game boy color only produces 15-bit colors (expanded to 24 bits by the emulator),
+# so the standard color modes use a table of foreground and background sequences indexed
+# by the 5 most significant bits of each RGB component. The tables are built lazily, the
+# first time a given color mode is used, and shared by all the sessions of the process.
+# The palette color mode uses a table indexed by the palette entry instead.
+cdef Sgr* sgr_tables[6]
+
+# In the palette color mode, the palette entries are mapped to the terminal colors
+# following the 16 standard colors, and redefined using OSC 4
+cdef enum:
+    PALETTE_FIRST_COLOR = 16
+
+# True colors use a table of pre-formatted decimal values for each component
+cdef Sgr decimal_table[256]
+
+
+cdef void build_decimal_table() noexcept nogil:
+    cdef int i
+    for i in range(256):
+        decimal_table[i].length = sprintf(decimal_table[i].data, "%d", i)
+
+
+build_decimal_table()
+
+
+cdef inline int color_key(uint32_t n) noexcept nogil:
+    return ((n >> 9) & 0x7c00) | ((n >> 6) & 0x03e0) | ((n >> 3) & 0x001f)
+
+
+cdef int build_palette_sgr_table() except -1:
+    cdef Sgr* table
+    cdef int index
+    if sgr_tables[5] != NULL:
+        return 0
+    table = <Sgr *> malloc(2 * 256 * sizeof(Sgr))
+    if table == NULL:
+        raise MemoryError
+    for index in range(256):
+        table[2 * index + 0].length = sprintf(
+            table[2 * index + 0].data, "\033[38;5;%dm", PALETTE_FIRST_COLOR + index
+        )
+        table[2 * index + 1].length = sprintf(
+            table[2 * index + 1].data, "\033[48;5;%dm", PALETTE_FIRST_COLOR + index
+        )
+    sgr_tables[5] = table
+    return 0
+
+
+cdef int build_sgr_table(int color_mode) except -1:
+    cdef Sgr* table
+    cdef int key, n
+    if color_mode == 5:
+        return build_palette_sgr_table()
+    if color_mode < 1 or color_mode > 3 or sgr_tables[color_mode] != NULL:
+        return 0
+    table = <Sgr *> malloc(2 * 32768 * sizeof(Sgr))
+    if table == NULL:
+        raise MemoryError
+    for key in range(32768):
+        n = expand_color_key(key) & 0xffffff
+        table[2 * key + 0].length = (
+            format_color(table[2 * key + 0].data, n, color_mode, True)
+            - table[2 * key + 0].data
+        )
+        table[2 * key + 1].length = (
+            format_color(table[2 * key + 1].data, n, color_mode, False)
+            - table[2 * key + 1].data
+        )
+    sgr_tables[color_mode] = table
+    return 0
+
+
+cdef inline uint32_t expand_color_key(int key) noexcept nogil:
+    # Expand each 5-bit component back to 8 bits
+    cdef uint32_t r = (key >> 10) & 0x1f
+    cdef uint32_t g = (key >> 5) & 0x1f
+    cdef uint32_t b = key & 0x1f
+    r = (r << 3) | (r >> 2)
+    g = (g << 3) | (g >> 2)
+    b = (b << 3) | (b >> 2)
+    return 0xff000000U | (r << 16) | (g << 8) | b
+
+
+# Quantization tables of the standard color modes, mapping each 15-bit color to a
+# representative color of its terminal color. Quantized frames only differ where the
+# printed colors differ, and the representative colors share the same SGR sequences.
+cdef uint32_t* quantize_tables[4]
+
+
+cdef int build_quantize_table(int color_mode) except -1:
+    cdef uint32_t* table
+    cdef int first_keys[256]
+    cdef int key, index
+    if color_mode < 1 or color_mode > 3 or quantize_tables[color_mode] != NULL:
+        return 0
+    table = <uint32_t *> malloc(32768 * sizeof(uint32_t))
+    if table == NULL:
+        raise MemoryError
+    for index in range(256):
+        first_keys[index] = -1
+    for key in range(32768):
+        index = color_index(expand_color_key(key), color_mode)
+        if first_keys[index] < 0:
+            first_keys[index] = key
+        table[key] = expand_color_key(first_keys[index])
+    quantize_tables[color_mode] = table
+    return 0
+
+
+cdef inline char* copy_sgr(char* buff, Sgr* sgr) noexcept nogil:
+    memcpy(buff, sgr.data, sgr.length)
+    return buff + sgr.length
+
+
+cdef char* set_color(char* buff, uint32_t n, int color_mode, int foreground) noexcept nogil:
+    # True colors
+    if color_mode == 4:
+        if foreground:
+            memcpy(buff, b"\033[38;2;", 7)
+        else:
+            memcpy(buff, b"\033[48;2;", 7)
+        buff += 7
+        buff = copy_sgr(buff, &decimal_table[(n >> 16) & 0xff])
+        buff[0] = b';'
+        buff = copy_sgr(buff + 1, &decimal_table[(n >> 8) & 0xff])
+        buff[0] = b';'
+        buff = copy_sgr(buff + 1, &decimal_table[n & 0xff])
+        buff[0] = b'm'
+        return buff + 1
+    # Palette colors, `n` being the palette entry
+    if color_mode == 5:
+        return copy_sgr(buff, &sgr_tables[5][2 * (n & 0xff) + (not foreground)])
+    # Standard colors
+    return copy_sgr(buff, &sgr_tables[color_mode][2 * color_key(n) + (not foreground)])
+
+
+cdef char* set_background(char* buff, uint32_t n, int color_mode) noexcept nogil:
     return set_color(buff, n, color_mode, False)
 
 
-cdef char* set_foreground(char* buff, int n, int color_mode) noexcept nogil:
+cdef char* set_foreground(char* buff, uint32_t n, int color_mode) noexcept nogil:
     return set_color(buff, n, color_mode, True)
 
 
-cdef char* move_from_to(
-    char *buff, int from_x, int from_y, int to_x, int to_y
+cdef char* set_colors(char* buff, uint32_t fg, uint32_t bg, int color_mode) noexcept nogil:
+    # Merge `CSI fg m` and `CSI bg m` into a single `CSI fg ; bg m` sequence
+    cdef char* start = set_foreground(buff, fg, color_mode)
+    cdef char* stop = set_background(start, bg, color_mode)
+    start[-1] = b';'
+    memmove(start, start + 2, stop - start - 2)
+    return stop - 2
+
+
+# Width of the blocks of cells compared at once, i.e. the width of a console tile
+cdef enum:
+    BLOCK_WIDTH = 8
+
+
+# Terminal capabilities, matching `gambaterm.capabilities.Capability`
+cdef enum:
+    HAS_REPEAT = 1
+    HAS_ERASE_CHARACTERS = 2
+    HAS_SCROLL_REGION = 4
+    HAS_RECTANGLES = 8
+
+
+cdef const char* SPACE = " "
+
+
+# Glyph sets, matching `gambaterm.renderers.GlyphSet`
+cdef enum:
+    HALF_BLOCKS = 0
+    QUADRANTS = 1
+    SEXTANTS = 2
+
+
+# Glyphs of each mask of sub-cell pixels printed using the foreground color,
+# the pixels being numbered in raster order within the cell
+cdef struct Glyph:
+    char data[4]
+    int length
+
+
+cdef Glyph glyph_tables[3][64]
+cdef int cell_widths[3]
+cdef int cell_heights[3]
+cell_widths[:] = [1, 2, 2]
+cell_heights[:] = [2, 2, 3]
+
+
+cdef void set_glyph(Glyph* glyph, int codepoint) noexcept nogil:
+    # UTF-8 encoding of the codepoint
+    if codepoint < 0x80:
+        glyph.data[0] = codepoint
+        glyph.length = 1
+    elif codepoint < 0x10000:
+        glyph.data[0] = 0xe0 | (codepoint >> 12)
+        glyph.data[1] = 0x80 | ((codepoint >> 6) & 0x3f)
+        glyph.data[2] = 0x80 | (codepoint & 0x3f)
+        glyph.length = 3
+    else:
+        glyph.data[0] = 0xf0 | (codepoint >> 18)
+        glyph.data[1] = 0x80 | ((codepoint >> 12) & 0x3f)
+        glyph.data[2] = 0x80 | ((codepoint >> 6) & 0x3f)
+        glyph.data[3] = 0x80 | (codepoint & 0x3f)
+        glyph.length = 4
+
+
+cdef void build_glyph_tables():
+    cdef int half_blocks[4]
+    cdef int quadrants[16]
+    cdef int mask
+    half_blocks[:] = [0x20, 0x2580, 0x2584, 0x2588]
+    quadrants[:] = [
+        0x20, 0x2598, 0x259d, 0x2580, 0x2596, 0x258c, 0x259e, 0x259b,
+        0x2597, 0x259a, 0x2590, 0x259c, 0x2584, 0x2599, 0x259f, 0x2588,
+    ]
+    for mask in range(4):
+        set_glyph(&glyph_tables[HALF_BLOCKS][mask], half_blocks[mask])
+    for mask in range(16):
+        set_glyph(&glyph_tables[QUADRANTS][mask], quadrants[mask])
+    # Sextants follow the mask order, except for the ones that already
+    # exist as spaces, half blocks and full blocks
+    for mask in range(64):
+        if mask == 0:
+            set_glyph(&glyph_tables[SEXTANTS][mask], 0x20)
+        elif mask == 21:
+            set_glyph(&glyph_tables[SEXTANTS][mask], 0x258c)
+        elif mask == 42:
+            set_glyph(&glyph_tables[SEXTANTS][mask], 0x2590)
+        elif mask == 63:
+            set_glyph(&glyph_tables[SEXTANTS][mask], 0x2588)
+        else:
+            set_glyph(
+                &glyph_tables[SEXTANTS][mask],
+                0x1fb00 + (mask - 1) - (mask > 21) - (mask > 42),
+            )
+
+
+build_glyph_tables()
+
+
+# Cells of the frame to print. Each cell is stored as two pixel rows of the image
+# holding its two colors, along with the mask of the sub-cell pixels using the first
+# color. Half blocks need no masks, since the first color is the top pixel.
+cdef struct Cells:
+    const Glyph* glyphs
+    int full_mask
+    const uint8_t* masks
+    const uint8_t* last_masks
+    int stride
+
+
+cdef inline int cell_mask(Cells* cells, int row_index, int column_index) noexcept nogil:
+    if cells.masks == NULL:
+        return 1
+    return cells.masks[row_index * cells.stride + column_index]
+
+
+cdef inline int count_digits(int n) noexcept nogil:
+    cdef int digits = 1
+    while n >= 10:
+        n //= 10
+        digits += 1
+    return digits
+
+
+cdef inline int csi_cost(int n) noexcept nogil:
+    # Length of `CSI n A` (and alike), the parameter being omitted when 1
+    return 3 if n == 1 else 3 + count_digits(n)
+
+
+cdef inline int vertical_cost(int dx) noexcept nogil:
+    # Length of the CUU/CUD sequence
+    return 0 if dx == 0 else csi_cost(abs(dx))
+
+
+cdef inline int horizontal_cost(int dy) noexcept nogil:
+    # Length of the CUF sequence, or of the shortest of BS and CUB
+    if dy < 0:
+        return min(-dy, csi_cost(-dy))
+    return 0 if dy == 0 else csi_cost(dy)
+
+
+cdef inline int line_feed_cost(int dx) noexcept nogil:
+    # Length of the shortest of LF and CUD, or of the CUU sequence
+    if dx > 0:
+        return min(dx, csi_cost(dx))
+    return vertical_cost(dx)
+
+
+cdef inline int absolute_cost(int x, int y) noexcept nogil:
+    # Length of the CUP sequence, the column being omitted when 1
+    if y == 1:
+        return 3 + count_digits(x)
+    return 4 + count_digits(x) + count_digits(y)
+
+
+cdef inline int relative_cost(int x, int y, int new_x, int new_y) noexcept nogil:
+    return vertical_cost(new_x - x) + horizontal_cost(new_y - y)
+
+
+cdef inline int carriage_return_cost(int x, int new_x, int new_y) noexcept nogil:
+    # CR, then down (or up) to the new row, then forward to the new column
+    return 1 + line_feed_cost(new_x - x) + horizontal_cost(new_y - 1)
+
+
+cdef int move_cost(int x, int y, int new_x, int new_y) noexcept nogil:
+    # The cursor position is unknown (negative) before the first move
+    if x < 0:
+        return absolute_cost(new_x, new_y)
+    return min(
+        relative_cost(x, y, new_x, new_y),
+        absolute_cost(new_x, new_y),
+        carriage_return_cost(x, new_x, new_y),
+    )
+
+
+cdef char* move_vertical(char* buff, int dx) noexcept nogil:
+    if dx == -1:
+        buff += sprintf(buff, "\033[A")
+    elif dx < 0:
+        buff += sprintf(buff, "\033[%dA", -dx)
+    elif dx == 1:
+        buff += sprintf(buff, "\033[B")
+    elif dx > 0:
+        buff += sprintf(buff, "\033[%dB", dx)
+    return buff
+
+
+cdef char* move_horizontal(char* buff, int dy) noexcept nogil:
+    if dy < 0 and -dy <= csi_cost(-dy):
+        memset(buff, b'\b', -dy)
+        buff += -dy
+    elif dy < -1:
+        buff += sprintf(buff, "\033[%dD", -dy)
+    elif dy == 1:
+        buff += sprintf(buff, "\033[C")
+    elif dy > 1:
+        buff += sprintf(buff, "\033[%dC", dy)
+    return buff
+
+
+cdef char* move_absolute(char* buff, int x, int y) noexcept nogil:
+    if y == 1:
+        buff += sprintf(buff, "\033[%dH", x)
+    else:
+        buff += sprintf(buff, "\033[%d;%dH", x, y)
+    return buff
+
+
+cdef char* move_cursor(char* buff, int x, int y, int new_x, int new_y) noexcept nogil:
+    # Use the shortest of a relative move, an absolute move (CUP) or a carriage return
+    # followed by line feeds. Line feeds are only used right after a carriage return, so
+    # the output does not depend on the newline translation (ONLCR) of the tty.
+    cdef int cost = move_cost(x, y, new_x, new_y)
+    if x >= 0 and relative_cost(x, y, new_x, new_y) == cost:
+        buff = move_vertical(buff, new_x - x)
+        return move_horizontal(buff, new_y - y)
+    if x >= 0 and carriage_return_cost(x, new_x, new_y) == cost:
+        buff[0] = b'\r'
+        buff += 1
+        if new_x > x and new_x - x <= csi_cost(new_x - x):
+            memset(buff, b'\n', new_x - x)
+            buff += new_x - x
+        else:
+            buff = move_vertical(buff, new_x - x)
+        return move_horizontal(buff, new_y - 1)
+    return move_absolute(buff, new_x, new_y)
+
+
+cdef inline int repeat_cost(int count) noexcept nogil:
+    # Length of `CSI n b` (REP)
+    return 3 + count_digits(count)
+
+
+cdef inline int glyph_cost(int length, int count, int capabilities) noexcept nogil:
+    # Print the glyph once and repeat it using REP, or print it `count` times
+    if capabilities & HAS_REPEAT and count > 1:
+        return min(length * count, length + repeat_cost(count - 1))
+    return length * count
+
+
+cdef char* print_glyph(
+    char* buff, const char* glyph, int length, int count, int capabilities
+) noexcept nogil:
+    cdef int i
+    if glyph_cost(length, count, capabilities) < length * count:
+        memcpy(buff, glyph, length)
+        buff += length
+        buff += sprintf(buff, "\033[%db", count - 1)
+        return buff
+    for i in range(count):
+        memcpy(buff, glyph, length)
+        buff += length
+    return buff
+
+
+# Frames are either made of RGB colors, or of indices in a palette of 256 colors
+ctypedef fused pixel_t:
+    uint8_t
+    uint32_t
+
+
+# Cursor colors before the first color change, matching neither
+# a palette index nor an RGB color (always 0xFF in the high byte)
+cdef enum:
+    UNDRAWN = 0x100
+
+
+cdef inline uint32_t pixel_color(
+    const uint32_t* palette, uint32_t value, int color_mode
+) noexcept nogil:
+    # RGB color of a pixel value, or palette entry in the palette color mode
+    return value if palette == NULL or color_mode == 5 else palette[value]
+
+
+cdef inline int64_t state_color(
+    const uint32_t* palette, uint32_t value, int color_mode
 ) noexcept nogil:
-    return move_relative(buff, to_x - from_x, to_y - from_y)
+    # The colors of the cursor state are kept as RGB colors (or palette entries in
+    # the palette color mode), since the indices of a frame are not those of the next
+    if value == UNDRAWN:
+        return UNDRAWN
+    return pixel_color(palette, value, color_mode)
+
+
+cdef inline uint32_t state_pixel(
+    const uint32_t* palette, int64_t color, int color_mode
+) noexcept nogil:
+    # Pixel value of a color of the cursor state, or unknown if not in the palette
+    cdef int i
+    if color == UNDRAWN or palette == NULL or color_mode == 5:
+        return <uint32_t> color
+    for i in range(PALETTE_SIZE):
+        if palette[i] == color:
+            return i
+    return UNDRAWN
 
 
 @boundscheck(False)
-cdef char* _blit(
-    uint32_t[:, ::1] image,
-    uint32_t[:, ::1] last,
-    int refx, int refy, int width, int height,
+cdef int span_changed(
+    pixel_t[:, ::1] image,
+    pixel_t[:, ::1] last,
+    Cells* cells,
+    int row_index, int last_index, int start, int stop,
+) noexcept nogil:
+    # Compare both pixel rows (and the masks) of a span of terminal cells at once,
+    # against the given row of the last printed frame (-1 if unknown)
+    cdef size_t size = (stop - start) * sizeof(pixel_t)
+    if last is None or last_index < 0:
+        return True
+    if stop <= start:
+        return False
+    return (
+        memcmp(&image[2 * row_index + 0, start], &last[2 * last_index + 0, start], size) != 0 or
+        memcmp(&image[2 * row_index + 1, start], &last[2 * last_index + 1, start], size) != 0 or
+        (cells.masks != NULL and memcmp(
+            &cells.masks[row_index * cells.stride + start],
+            &cells.last_masks[last_index * cells.stride + start],
+            stop - start,
+        ) != 0)
+    )
+
+
+@boundscheck(False)
+cdef inline int cell_changed(
+    pixel_t[:, ::1] image,
+    pixel_t[:, ::1] last,
+    Cells* cells,
+    int row_index, int last_index, int column_index,
+) noexcept nogil:
+    return (
+        last is None or
+        last_index < 0 or
+        last[2 * last_index + 0, column_index] != image[2 * row_index + 0, column_index] or
+        last[2 * last_index + 1, column_index] != image[2 * row_index + 1, column_index] or
+        (cells.masks != NULL and
+         cells.last_masks[last_index * cells.stride + column_index] !=
+         cells.masks[row_index * cells.stride + column_index])
+    )
+
+
+@boundscheck(False)
+cdef int reprint_cost(
+    pixel_t[:, ::1] image,
+    Cells* cells,
+    int row_index, int start, int stop,
+    uint32_t fg, uint32_t bg, int limit,
+) noexcept nogil:
+    # Length of the cells printed again with the current colors,
+    # or `limit` if some cell needs other colors or it is not shorter
+    cdef int column_index
+    cdef uint32_t color1, color2
+    cdef int cost = 0
+    for column_index in range(start, stop):
+        color1 = image[2 * row_index + 0, column_index]
+        color2 = image[2 * row_index + 1, column_index]
+        if color1 == color2 == bg:
+            cost += 1
+        elif color1 == color2 == fg:
+            cost += cells.glyphs[cells.full_mask].length
+        elif (color1 == fg or color1 == bg) and (color2 == fg or color2 == bg):
+            cost += cells.glyphs[cell_mask(cells, row_index, column_index)].length
+        else:
+            return limit
+        if cost >= limit:
+            return limit
+    return cost
+
+
+@boundscheck(False)
+cdef char* reprint(
+    char* buff,
+    pixel_t[:, ::1] image,
+    Cells* cells,
+    int row_index, int start, int stop,
+    uint32_t fg, uint32_t bg,
+) noexcept nogil:
+    cdef int column_index
+    cdef uint32_t color1, color2
+    cdef const Glyph* glyph
+    for column_index in range(start, stop):
+        color1 = image[2 * row_index + 0, column_index]
+        color2 = image[2 * row_index + 1, column_index]
+        if color1 == color2 == bg:
+            buff = print_glyph(buff, SPACE, 1, 1, 0)
+            continue
+        if color1 == color2:
+            glyph = &cells.glyphs[cells.full_mask]
+        elif color1 == fg:
+            glyph = &cells.glyphs[cell_mask(cells, row_index, column_index)]
+        else:
+            glyph = &cells.glyphs[cell_mask(cells, row_index, column_index) ^ cells.full_mask]
+        buff = print_glyph(buff, glyph.data, glyph.length, 1, 0)
+    return buff
+
+
+cdef inline int cell_pending(
+    pixel_t[:, ::1] image,
+    pixel_t[:, ::1] last,
+    Cells* cells,
+    const uint8_t* filled,
+    int row_index, int last_index, int column_index, int column_count,
+) noexcept nogil:
+    # Whether the cell changed, and was not printed by a rectangle fill
+    return (
+        (filled == NULL or not filled[row_index * column_count + column_index]) and
+        cell_changed(image, last, cells, row_index, last_index, column_index)
+    )
+
+
+@boundscheck(False)
+cdef inline int blank_cell(
+    pixel_t[:, ::1] image,
+    const uint8_t* filled,
+    int row_index, int column_index, int column_count, uint32_t color,
+) noexcept nogil:
+    # Whether the cell is blank with the given color, and not filled yet
+    return (
+        not filled[row_index * column_count + column_index] and
+        image[2 * row_index + 0, column_index] == color and
+        image[2 * row_index + 1, column_index] == color
+    )
+
+
+@boundscheck(False)
+cdef char* fill_rectangles(
+    char* buff,
+    pixel_t[:, ::1] image,
+    pixel_t[:, ::1] last,
+    Cells* cells,
+    Scroll* scroll,
+    const uint32_t* palette,
+    int row_count, int column_count,
+    int refx, int refy,
     int color_mode,
-    char* base,
+    int capabilities,
+    Cursor* cursor,
+    uint8_t* filled,
+) noexcept nogil:
+    # Fill the large rectangles of blank cells with spaces (DECFRA), using the
+    # current background color. Starting from each blank cell that changed, the
+    # rectangle extends right then down, and it is filled if it is shorter than
+    # printing the cells that changed in each of its rows.
+    cdef int row_index, column_index, last_index, stop, bottom, i, j
+    cdef int first, count, saved, cost
+    cdef uint32_t color
+    memset(filled, 0, row_count * column_count)
+    for row_index in range(row_count):
+        last_index = scrolled_index(scroll, row_index)
+        if not span_changed(image, last, cells, row_index, last_index, 0, column_count):
+            continue
+        column_index = 0
+        while column_index < column_count:
+            color = image[2 * row_index + 0, column_index]
+            if not blank_cell(
+                image, filled, row_index, column_index, column_count, color
+            ) or not cell_changed(image, last, cells, row_index, last_index, column_index):
+                column_index += 1
+                continue
+
+            # Extend the rectangle right, then down
+            stop = column_index + 1
+            while stop < column_count and blank_cell(
+                image, filled, row_index, stop, column_count, color
+            ):
+                stop += 1
+            bottom = row_index + 1
+            while bottom < row_count:
+                for j in range(column_index, stop):
+                    if not blank_cell(image, filled, bottom, j, column_count, color):
+                        break
+                else:
+                    bottom += 1
+                    continue
+                break
+
+            # Cost of the cells that changed, printed row by row
+            saved = 0
+            for i in range(row_index, bottom):
+                first = count = 0
+                for j in range(column_index, stop):
+                    if cell_changed(image, last, cells, i, scrolled_index(scroll, i), j):
+                        if count == 0:
+                            first = j
+                        count = j - first + 1
+                if count > 0:
+                    saved += absolute_cost(i + refx, first + refy)
+                    saved += glyph_cost(1, count, capabilities)
+            cost = 10 + (
+                count_digits(row_index + refx) + count_digits(column_index + refy) +
+                count_digits(bottom - 1 + refx) + count_digits(stop - 1 + refy)
+            )
+            if cost >= saved:
+                column_index = stop
+                continue
+
+            if color != cursor.bg:
+                buff = set_background(buff, pixel_color(palette, color, color_mode), color_mode)
+                cursor.bg = color
+            buff += sprintf(
+                buff, "\033[32;%d;%d;%d;%d$x",
+                row_index + refx, column_index + refy, bottom - 1 + refx, stop - 1 + refy,
+            )
+            for i in range(row_index, bottom):
+                memset(&filled[i * column_count + column_index], 1, stop - column_index)
+            column_index = stop
+    return buff
+
+
+# Maximum number of terminal rows considered for scroll detection
+cdef enum:
+    MAX_SCROLL_ROWS = 256
+
+
+# Vertical shift of a band of terminal rows, applied using a scroll region
+cdef struct Scroll:
+    int top
+    int bottom
+    int shift
+
+
+cdef inline int scrolled_index(Scroll* scroll, int row_index) noexcept nogil:
+    # Row of the last printed frame displayed at the given row, once scrolled
+    cdef int last_index = row_index
+    if scroll.top <= row_index < scroll.bottom:
+        last_index += scroll.shift
+        if not scroll.top <= last_index < scroll.bottom:
+            return -1
+    return last_index
+
+
+@boundscheck(False)
+cdef uint64_t hash_row(pixel_t[:, ::1] image, int row_index, int column_count) noexcept nogil:
+    # FNV-1a over both pixel rows of a terminal row
+    cdef uint64_t result = 14695981039346656037ULL
+    cdef int i, j
+    for i in range(2):
+        for j in range(column_count):
+            result = (result ^ image[2 * row_index + i, j]) * 1099511628211ULL
+    return result
+
+
+cdef void detect_scroll(
+    pixel_t[:, ::1] image,
+    pixel_t[:, ::1] last,
+    Cells* cells,
+    int row_count, int column_count,
+    Scroll* scroll,
 ) noexcept nogil:
+    cdef uint64_t image_hashes[MAX_SCROLL_ROWS]
+    cdef uint64_t last_hashes[MAX_SCROLL_ROWS]
+    cdef int row_index, shift, gain, best_gain, band_clean
+    cdef int top = -1
+    cdef int bottom = -1
+
+    # No scrolling by default
+    scroll.top = scroll.bottom = scroll.shift = 0
+    if last is None or row_count > MAX_SCROLL_ROWS or column_count <= 0:
+        return
+
+    # Hash the rows and find the band of rows that changed
+    for row_index in range(row_count):
+        image_hashes[row_index] = hash_row(image, row_index, column_count)
+        last_hashes[row_index] = hash_row(last, row_index, column_count)
+        if span_changed(image, last, cells, row_index, row_index, 0, column_count):
+            if top < 0:
+                top = row_index
+            bottom = row_index + 1
+    if top < 0:
+        return
+
+    # Count the rows of the band that are already up-to-date
+    band_clean = 0
+    for row_index in range(top, bottom):
+        if not span_changed(image, last, cells, row_index, row_index, 0, column_count):
+            band_clean += 1
+
+    # Find the shift that brings the most rows up-to-date, minus the ones
+    # that were already up-to-date and would need to be printed again
+    best_gain = 1
+    for shift in range(top - bottom + 1, bottom - top):
+        if shift == 0:
+            continue
+        gain = -band_clean
+        for row_index in range(max(top, top - shift), min(bottom, bottom - shift)):
+            if (
+                image_hashes[row_index] == last_hashes[row_index + shift] and
+                not span_changed(
+                    image, last, cells, row_index, row_index + shift, 0, column_count
+                )
+            ):
+                gain += 1
+        if gain > best_gain:
+            best_gain = gain
+            scroll.top = top
+            scroll.bottom = bottom
+            scroll.shift = shift
+
 
-    cdef int current_x = refx
-    cdef int current_y = refy
-    # Use 0x0 as "undrawn" sentinel: real GB pixels always have 0xFF
-    # in the high byte, so 0x0 can never match
-    cdef uint32_t current_fg = 0x0
-    cdef uint32_t current_bg = 0x0
+# A run of identical cells to print, with the colors used to group the runs
+cdef struct Run:
+    uint32_t low
+    uint32_t high
+    int row_index
+    int column_index
+    int count
+
+
+# Position of the cursor and current colors of the terminal
+cdef struct Cursor:
+    int x
+    int y
+    uint32_t fg
+    uint32_t bg
+
+
+cdef int compare_runs(const void* a, const void* b) noexcept nogil:
+    # Group the runs by colors, then keep the raster order within a group
+    cdef const Run* first = <const Run*> a
+    cdef const Run* second = <const Run*> b
+    if first.low != second.low:
+        return -1 if first.low < second.low else 1
+    if first.high != second.high:
+        return -1 if first.high < second.high else 1
+    if first.row_index != second.row_index:
+        return first.row_index - second.row_index
+    return first.column_index - second.column_index
+
+
+@boundscheck(False)
+cdef int collect_runs(
+    pixel_t[:, ::1] image,
+    pixel_t[:, ::1] last,
+    Cells* cells,
+    Scroll* scroll,
+    int row_count, int column_count,
+    int capabilities,
+    const uint8_t* filled,
+    Run* runs,
+) noexcept nogil:
     cdef int row_index, column_index
     cdef uint32_t color1, color2
-    cdef int new_x, new_y
-    cdef int invert_print
-    cdef int image_height = image.shape[0]
-    cdef int image_width = image.shape[1]
-    cdef char* result = base
+    cdef int mask, count, clean, length, repeatable
+    cdef int last_index
+    cdef int run_count = 0
 
-    # Move at reference point
-    result = move_absolute(result, refx, refy)
+    # Loop over terminal rows
+    for row_index in range(row_count):
+        last_index = scrolled_index(scroll, row_index)
 
-    # Loop over terminal cells
-    for row_index in range(min(height - refx, image_height // 2)):
-        for column_index in range(min(width - refy, image_width)):
+        # Skip the row if identical to last printed frame
+        if not span_changed(image, last, cells, row_index, last_index, 0, column_count):
+            continue
+
+        # Loop over terminal cells
+        column_index = 0
+        while column_index < column_count:
+
+            # Skip the block if identical to last printed frame,
+            # blocks of cells matching the 8x8 tiles of the console
+            if column_index % BLOCK_WIDTH == 0 and not span_changed(
+                image, last, cells, row_index, last_index,
+                column_index, min(column_index + BLOCK_WIDTH, column_count),
+            ):
+                column_index += BLOCK_WIDTH
+                continue
+
+            # Skip if identical to last printed frame, or already filled
+            if not cell_pending(
+                image, last, cells, filled, row_index, last_index, column_index, column_count
+            ):
+                column_index += 1
+                continue
 
             # Extract colors
             color1 = image[2 * row_index + 0, column_index]
             color2 = image[2 * row_index + 1, column_index]
+            mask = cell_mask(cells, row_index, column_index)
 
-            # Skip if identical to last printed frame
-            if (
-                last is not None and
-                last[2 * row_index + 0, column_index] == color1 and
-                last[2 * row_index + 1, column_index] == color2
+            # Detect the run of identical cells, without the trailing up-to-date cells.
+            # Without REP (or ECH for blank cells), stop at the first stretch of
+            # up-to-date cells that is shorter to skip with a forward move than to
+            # print again.
+            length = 1 if color1 == color2 else cells.glyphs[mask].length
+            repeatable = capabilities & HAS_REPEAT or (
+                color1 == color2 and capabilities & HAS_ERASE_CHARACTERS
+            )
+            count = 1
+            clean = 0
+            while (
+                column_index + count < column_count and
+                image[2 * row_index + 0, column_index + count] == color1 and
+                image[2 * row_index + 1, column_index + count] == color2 and
+                cell_mask(cells, row_index, column_index + count) == mask
             ):
-                continue
+                if cell_pending(
+                    image, last, cells, filled,
+                    row_index, last_index, column_index + count, column_count,
+                ):
+                    clean = 0
+                else:
+                    clean += 1
+                count += 1
+                if not repeatable and length * clean > repeat_cost(clean):
+                    break
+            count -= clean
 
-            # Go to the new position
-            new_x, new_y = row_index + refx, column_index + refy
-            result = move_from_to(result, current_x, current_y, new_x, new_y)
-            current_x, current_y = new_x, new_y
+            # Cells can be printed either way, so the colors are sorted
+            runs[run_count].low = min(color1, color2)
+            runs[run_count].high = max(color1, color2)
+            runs[run_count].row_index = row_index
+            runs[run_count].column_index = column_index
+            runs[run_count].count = count
+            run_count += 1
+            column_index += count
 
-            # Print full block
-            if color1 == color2 == current_fg != current_bg:
-                result += sprintf(result, "\xe2\x96\x88")
-                current_y += 1
-                continue
+    return run_count
 
-            # Print empty block (space)
-            if color1 == color2:
-                if color1 != current_bg:
-                    result = set_background(result, color1, color_mode)
-                    current_bg = color1
-                result += sprintf(result, " ")
-                current_y += 1
-                continue
 
-            # Detect print type
-            invert_print = (current_fg == color2 or current_bg == color1)
-
-            # Inverted print
-            if invert_print:
-                color1, color2 = color2, color1
-
-            # Set background and foreground colors if necessary
-            if current_fg != color1:
-                result = set_foreground(result, color1, color_mode)
-                current_fg = color1
-            if current_bg != color2:
-                result = set_background(result, color2, color_mode)
-                current_bg = color2
-
-            # Print lower half block
-            if invert_print:
-                result += sprintf(result, "\xe2\x96\x84")
-                current_y += 1
-
-            # Print upper half block
-            else:
-                result += sprintf(result, "\xe2\x96\x80")
-                current_y += 1
-
-    # Reset attributes before returning the buffer
-    result += sprintf(result, "\033[0m")
-    return result
+@boundscheck(False)
+cdef char* print_run(
+    char* buff,
+    Cursor* cursor,
+    pixel_t[:, ::1] image,
+    Cells* cells,
+    const uint32_t* palette,
+    Run* run, Run* next_run,
+    int refx, int refy,
+    int color_mode,
+    int capabilities,
+) noexcept nogil:
+    cdef int row_index = run.row_index
+    cdef int column_index = run.column_index
+    cdef int count = run.count
+    cdef int new_x = row_index + refx
+    cdef int new_y = column_index + refy
+    cdef int cost, erase_cost, invert_print, mask
+    cdef const Glyph* glyph
+    cdef char sgr[32]
 
+    # Extract colors
+    cdef uint32_t color1 = image[2 * row_index + 0, column_index]
+    cdef uint32_t color2 = image[2 * row_index + 1, column_index]
 
-def blit(
-    uint32_t[:, ::1] image,
-    uint32_t[:, ::1] last,
+    # Go to the new position, or print the cells in between again if it's shorter
+    cost = move_cost(cursor.x, cursor.y, new_x, new_y)
+    if new_x == cursor.x and new_y > cursor.y and reprint_cost(
+        image, cells, row_index, cursor.y - refy, column_index, cursor.fg, cursor.bg, cost,
+    ) < cost:
+        buff = reprint(
+            buff, image, cells, row_index, cursor.y - refy, column_index,
+            cursor.fg, cursor.bg,
+        )
+    else:
+        buff = move_cursor(buff, cursor.x, cursor.y, new_x, new_y)
+    cursor.x, cursor.y = new_x, new_y
+
+    # Erase characters (ECH) cost, when printing empty blocks. The cursor does
+    # not move, so account for the forward move needed if the next run follows.
+    erase_cost = repeat_cost(count)
+    if (
+        next_run != NULL and
+        next_run.row_index == row_index and
+        next_run.column_index == column_index + count
+    ):
+        erase_cost += repeat_cost(count)
+    if not capabilities & HAS_ERASE_CHARACTERS:
+        erase_cost = glyph_cost(1, count, capabilities)
+
+    # Print full blocks, unless the background has to be set anyway and
+    # empty blocks are cheaper (e.g the foreground is left over from a
+    # previous frame, when the cursor state is carried over)
+    if color1 == color2 == cursor.fg != cursor.bg:
+        glyph = &cells.glyphs[cells.full_mask]
+        cost = glyph_cost(glyph.length, count, capabilities)
+        if cost <= min(erase_cost, glyph_cost(1, count, capabilities)) + (
+            set_background(sgr, pixel_color(palette, color1, color_mode), color_mode) - sgr
+        ):
+            buff = print_glyph(buff, glyph.data, glyph.length, count, capabilities)
+            cursor.y += count
+            return buff
+
+    # Print empty blocks (spaces)
+    if color1 == color2:
+        if color1 != cursor.bg:
+            buff = set_background(buff, pixel_color(palette, color1, color_mode), color_mode)
+            cursor.bg = color1
+        # Erase characters (ECH) instead, if it's shorter
+        if (
+            capabilities & HAS_ERASE_CHARACTERS and
+            erase_cost < glyph_cost(1, count, capabilities)
+        ):
+            buff += sprintf(buff, "\033[%dX", count)
+            return buff
+        buff = print_glyph(buff, SPACE, 1, count, capabilities)
+        cursor.y += count
+        return buff
+
+    # Detect print type
+    invert_print = (cursor.fg == color2 or cursor.bg == color1)
+
+    # Inverted print, using the complementary glyph
+    mask = cell_mask(cells, row_index, column_index)
+    if invert_print:
+        color1, color2 = color2, color1
+        mask ^= cells.full_mask
+
+    # Set background and foreground colors if necessary
+    if cursor.fg != color1 and cursor.bg != color2:
+        buff = set_colors(
+            buff, pixel_color(palette, color1, color_mode), pixel_color(palette, color2, color_mode), color_mode
+        )
+        cursor.fg, cursor.bg = color1, color2
+    if cursor.fg != color1:
+        buff = set_foreground(buff, pixel_color(palette, color1, color_mode), color_mode)
+        cursor.fg = color1
+    if cursor.bg != color2:
+        buff = set_background(buff, pixel_color(palette, color2, color_mode), color_mode)
+        cursor.bg = color2
+
+    # Print the glyphs (upper half blocks, or lower half blocks if inverted)
+    glyph = &cells.glyphs[mask]
+    buff = print_glyph(buff, glyph.data, glyph.length, count, capabilities)
+    cursor.y += count
+    return buff
+
+
+cdef char* print_runs(
+    char* buff,
+    Cursor* cursor,
+    pixel_t[:, ::1] image,
+    Cells* cells,
+    const uint32_t* palette,
+    Run* runs, int run_count,
+    int refx, int refy,
+    int color_mode,
+    int capabilities,
+) noexcept nogil:
+    cdef int i
+    for i in range(run_count):
+        buff = print_run(
+            buff, cursor, image, cells, palette,
+            &runs[i], &runs[i + 1] if i + 1 < run_count else NULL,
+            refx, refy, color_mode, capabilities,
+        )
+    return buff
+
+
+cdef char* _blit(
+    pixel_t[:, ::1] image,
+    pixel_t[:, ::1] last,
+    Cells* cells,
+    const uint32_t* palette,
     int refx, int refy, int width, int height,
     int color_mode,
+    int capabilities,
+    char* base,
+    Run* runs,
+    uint8_t* filled,
+    Cursor* cursor,
+    int reset,
+) noexcept nogil:
+    cdef Scroll scroll
+    cdef Cursor grouped_cursor
+    cdef int i, run_count, switches, groups
+    cdef int row_count = min(height - refx, image.shape[0] // 2)
+    cdef int column_count = min(width - refy, image.shape[1])
+    cdef Run* grouped_runs
+    cdef char* start
+    cdef char* grouped
+    cdef char* result = base
+
+    # The cursor position is forgotten if it is outside of the cells, since the
+    # cells in between might be printed again from there
+    if not (
+        0 <= cursor.x - refx < row_count and 0 <= cursor.y - refy <= column_count
+    ):
+        cursor.x = cursor.y = -1
+
+    # Shift the rows that scrolled since the last printed frame, using a scroll
+    # region (DECSTBM) and SU/SD. Attributes are reset first so that the exposed
+    # rows are blank, and setting the scroll regions moves the cursor home.
+    scroll.top = scroll.bottom = scroll.shift = 0
+    if capabilities & HAS_SCROLL_REGION:
+        detect_scroll(image, last, cells, row_count, column_count, &scroll)
+    if scroll.shift != 0:
+        result += sprintf(
+            result, "\033[0m\033[%d;%dr", scroll.top + refx, scroll.bottom + refx - 1
+        )
+        if scroll.shift > 0:
+            result += sprintf(result, "\033[%dS", scroll.shift)
+        else:
+            result += sprintf(result, "\033[%dT", -scroll.shift)
+        result += sprintf(result, "\033[r")
+        cursor.x = cursor.y = -1
+        cursor.fg = cursor.bg = UNDRAWN
+
+    # Fill the large blank areas first, with a rectangular fill (DECFRA)
+    if capabilities & HAS_RECTANGLES and row_count > 0 and column_count > 0:
+        result = fill_rectangles(
+            result, image, last, cells, &scroll, palette, row_count, column_count,
+            refx, refy, color_mode, capabilities, cursor, filled,
+        )
+    else:
+        filled = NULL
+
+    # Print the runs of cells that changed in raster order
+    run_count = collect_runs(
+        image, last, cells, &scroll, row_count, column_count, capabilities, filled, runs
+    )
+    start = result
+    grouped_cursor = cursor[0]
+    result = print_runs(
+        result, cursor, image, cells, palette, runs, run_count,
+        refx, refy, color_mode, capabilities,
+    )
+
+    # Runs with the same colors can also be printed together, to save the color
+    # changes at the cost of longer moves. When there are fewer groups of colors
+    # than color changes in raster order, print them in this order right after
+    # the raster output, and keep the shortest.
+    grouped_runs = runs + run_count
+    memcpy(grouped_runs, runs, run_count * sizeof(Run))
+    qsort(grouped_runs, run_count, sizeof(Run), compare_runs)
+    switches = groups = 0
+    for i in range(1, run_count):
+        switches += runs[i].low != runs[i - 1].low or runs[i].high != runs[i - 1].high
+        groups += (
+            grouped_runs[i].low != grouped_runs[i - 1].low or
+            grouped_runs[i].high != grouped_runs[i - 1].high
+        )
+    if groups < switches:
+        grouped = print_runs(
+            result, &grouped_cursor, image, cells, palette, grouped_runs, run_count,
+            refx, refy, color_mode, capabilities,
+        )
+        if grouped - result < result - start:
+            memcpy(start, result, grouped - result)
+            result = start + (grouped - result)
+            cursor[0] = grouped_cursor
+
+    # Reset attributes before returning the buffer, unless the caller keeps track
+    # of the cursor colors
+    if reset:
+        result += sprintf(result, "\033[0m")
+        cursor.fg = cursor.bg = UNDRAWN
+    return result
+
+
+def is_unchanged(pixel_t[:, ::1] image not None, pixel_t[:, ::1] last not None):
+    cdef size_t size = image.shape[0] * image.shape[1] * sizeof(pixel_t)
+    cdef int result
+    if image.shape[0] != last.shape[0] or image.shape[1] != last.shape[1]:
+        return False
+    if size == 0:
+        return True
+    with nogil:
+        result = memcmp(&image[0, 0], &last[0, 0], size) == 0
+    return bool(result)
+
+
+def quantize(
+    uint32_t[:, ::1] image not None, int color_mode, uint32_t[:, ::1] output not None
 ):
-    cdef char* base
+    cdef Py_ssize_t i, j
+    cdef uint32_t* table
+    if image.shape[0] != output.shape[0] or image.shape[1] != output.shape[1]:
+        raise ValueError("Output shape does not match the image shape")
+
+    # True colors and palette colors are printed as is
+    if color_mode >= 4:
+        output[:, :] = image
+        return
+
+    build_quantize_table(color_mode)
+    table = quantize_tables[color_mode]
+    with nogil, boundscheck(False):
+        for i in range(image.shape[0]):
+            for j in range(image.shape[1]):
+                output[i, j] = table[color_key(image[i, j])]
+
+
+# Indexed frames use a palette of 256 colors, looked up using a hash table
+cdef enum:
+    PALETTE_SIZE = 256
+    PALETTE_SLOTS = 512
+
+
+cdef inline int palette_slot(uint32_t color) noexcept nogil:
+    # Multiplicative hashing, keeping the 9 most significant bits
+    return <uint32_t> (color * 2654435761U) >> 23
+
+
+cdef void fill_slots(
+    const uint32_t* palette, const int64_t* stamps, int size, int* slots
+) noexcept nogil:
+    cdef int index, slot
+    for slot in range(PALETTE_SLOTS):
+        slots[slot] = -1
+    for index in range(size):
+        if stamps[index] > 0:
+            slot = palette_slot(palette[index])
+            while slots[slot] >= 0:
+                slot = (slot + 1) % PALETTE_SLOTS
+            slots[slot] = index
+
+
+@boundscheck(False)
+cdef int _index_colors(
+    uint32_t[:, ::1] image,
+    uint32_t* palette,
+    int64_t* stamps,
+    int size,
+    int64_t generation,
+    uint8_t[:, ::1] output,
+) noexcept nogil:
+    cdef int slots[PALETTE_SLOTS]
+    cdef int64_t saved_stamps[PALETTE_SIZE]
+    cdef Py_ssize_t i, j
+    cdef int k, slot, index
+    cdef uint32_t color
+    cdef uint32_t previous_color = 0
+    cdef int previous_index = -1
+
+    # The stamps are restored if the frame does not fit, so that the entries it
+    # used can be re-used by the next frames
+    memcpy(saved_stamps, stamps, PALETTE_SIZE * sizeof(int64_t))
+    fill_slots(palette, stamps, size, slots)
+    for i in range(image.shape[0]):
+        for j in range(image.shape[1]):
+            color = image[i, j]
+
+            # Same color as the previous pixel
+            if previous_index >= 0 and color == previous_color:
+                output[i, j] = previous_index
+                continue
+
+            # Look up the color in the palette
+            slot = palette_slot(color)
+            while slots[slot] >= 0 and palette[slots[slot]] != color:
+                slot = (slot + 1) % PALETTE_SLOTS
+            index = slots[slot]
+
+            # Allocate a free entry or the least recently used one, among the
+            # entries used by neither the current frame nor the last printed one
+            if index < 0:
+                for k in range(size):
+                    if (stamps[k] == 0 or stamps[k] < generation - 1) and (
+                        index < 0 or stamps[k] < stamps[index]
+                    ):
+                        index = k
+                if index < 0:
+                    memcpy(stamps, saved_stamps, PALETTE_SIZE * sizeof(int64_t))
+                    return False
+                palette[index] = color
+                if stamps[index] > 0:
+                    stamps[index] = generation
+                    fill_slots(palette, stamps, size, slots)
+                else:
+                    slots[slot] = index
+
+            stamps[index] = generation
+            output[i, j] = index
+            previous_color, previous_index = color, index
+
+    return True
+
+
+def index_colors(
+    uint32_t[:, ::1] image not None,
+    uint32_t[::1] palette not None,
+    int64_t[::1] stamps not None,
+    int64_t generation,
+    uint8_t[:, ::1] output not None,
+    int size=PALETTE_SIZE,
+):
+    cdef int result
+    if image.shape[0] != output.shape[0] or image.shape[1] != output.shape[1]:
+        raise ValueError("Output shape does not match the image shape")
+    if palette.shape[0] != PALETTE_SIZE or stamps.shape[0] != PALETTE_SIZE:
+        raise ValueError("The palette must have 256 entries")
+    if not 0 < size <= PALETTE_SIZE:
+        raise ValueError("The number of usable entries must be between 1 and 256")
+    if generation < 1:
+        raise ValueError("The generation must be positive")
+    with nogil:
+        result = _index_colors(
+            image, &palette[0], &stamps[0], size, generation, output
+        )
+    return bool(result)
+
+
+# Perceptual distances are measured in the CIELAB color space (CIE76 delta E)
+cdef float linear_table[256]
+
+
+cdef void build_linear_table() noexcept nogil:
+    cdef int i
+    cdef float x
+    for i in range(256):
+        x = i / 255.0
+        linear_table[i] = x / 12.92 if x <= 0.04045 else ((x + 0.055) / 1.055) ** 2.4
+
+
+build_linear_table()
+
+
+cdef inline float lab_function(float t) noexcept nogil:
+    return cbrtf(t) if t > 0.008856 else 7.787 * t + 16.0 / 116.0
+
+
+cdef void color_to_lab(uint32_t color, float* lab) noexcept nogil:
+    cdef float r = linear_table[(color >> 16) & 0xFF]
+    cdef float g = linear_table[(color >> 8) & 0xFF]
+    cdef float b = linear_table[color & 0xFF]
+    # sRGB to XYZ, normalized to the D65 white point
+    cdef float x = lab_function((0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.9505)
+    cdef float y = lab_function(0.2126 * r + 0.7152 * g + 0.0722 * b)
+    cdef float z = lab_function((0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.089)
+    lab[0] = 116.0 * y - 16.0
+    lab[1] = 500.0 * (x - y)
+    lab[2] = 200.0 * (y - z)
+
+
+cdef inline int is_perceptible(
+    uint32_t color, uint32_t displayed, float squared_threshold
+) noexcept nogil:
+    cdef float first[3]
+    cdef float second[3]
+    color_to_lab(color, first)
+    color_to_lab(displayed, second)
+    return (
+        (first[0] - second[0]) ** 2
+        + (first[1] - second[1]) ** 2
+        + (first[2] - second[2]) ** 2
+    ) >= squared_threshold
+
+
+@boundscheck(False)
+cdef int _perceptual_filter(
+    uint32_t[:, ::1] image, uint32_t[:, ::1] displayed, float threshold
+) noexcept nogil:
+    cdef Py_ssize_t i, j, k
+    cdef float squared_threshold = threshold * threshold
+    cdef Py_ssize_t changed = 0
+    cdef Py_ssize_t scene_change = image.shape[0] * image.shape[1] // 2
+    cdef uint32_t color, previous_color = 0, previous_displayed = 0
+    cdef int perceptible = False
+
+    # A scene change is printed as is, which also clears the accumulated error.
+    # Runs of the same pair of colors share the same result.
+    for k in range(2):
+        for i in range(image.shape[0]):
+            for j in range(image.shape[1]):
+                color = image[i, j]
+                if color == displayed[i, j]:
+                    continue
+                if color != previous_color or displayed[i, j] != previous_displayed:
+                    previous_color, previous_displayed = color, displayed[i, j]
+                    perceptible = is_perceptible(
+                        color, previous_displayed, squared_threshold
+                    )
+                if k == 0 and perceptible:
+                    changed += 1
+                    if changed > scene_change:
+                        return True
+                elif k == 1 and not perceptible:
+                    image[i, j] = displayed[i, j]
+    return False
+
 
+# Replace the pixels that are not perceptibly different from the displayed ones
+# (less than `threshold`) with the displayed colors, unless more than half of the
+# pixels changed. Return whether the image was left as is for that reason.
+def perceptual_filter(
+    uint32_t[:, ::1] image not None,
+    uint32_t[:, ::1] displayed not None,
+    float threshold,
+):
+    cdef int result
+    if image.shape[0] != displayed.shape[0] or image.shape[1] != displayed.shape[1]:
+        raise ValueError("Displayed shape does not match the image shape")
+    if threshold < 0:
+        raise ValueError("The threshold must be positive")
     with nogil:
-        base = <char *> malloc(image.shape[0] * image.shape[1] * 30)
-        result = _blit(image, last, refx, refy, width, height, color_mode, base)
+        result = _perceptual_filter(image, displayed, threshold)
+    return bool(result)
+
+
+# Upper bound of the number of bytes written for each pixel of the image, twice
+# the size of the raster output since the grouped output is written right after it
+cdef enum:
+    MAX_BYTES_PER_PIXEL = 60
+
+
+def max_blit_size(int image_height, int image_width, int scale=1):
+    return image_height * image_width * scale * scale * MAX_BYTES_PER_PIXEL
+
+
+cdef inline int color_distance(uint32_t first, uint32_t second) noexcept nogil:
+    cdef int r = <int> ((first >> 16) & 0xff) - <int> ((second >> 16) & 0xff)
+    cdef int g = <int> ((first >> 8) & 0xff) - <int> ((second >> 8) & 0xff)
+    cdef int b = <int> (first & 0xff) - <int> (second & 0xff)
+    return r * r + g * g + b * b
+
+
+@boundscheck(False)
+cdef void pack_cells(
+    pixel_t[:, ::1] image,
+    const uint32_t* palette,
+    int glyph_set,
+    pixel_t[:, ::1] cells,
+    uint8_t[:, ::1] masks,
+) noexcept nogil:
+    # Approximate each cell of sub-cell pixels using two colors, stored as the
+    # two pixel rows of a cell, along with the mask of the pixels of the first color
+    cdef pixel_t values[6]
+    cdef pixel_t colors[6]
+    cdef uint32_t rgb[6]
+    cdef int cell_width = cell_widths[glyph_set]
+    cdef int cell_height = cell_heights[glyph_set]
+    cdef int size = cell_width * cell_height
+    cdef int row_index, column_index, i, j, k, count, error, best_error
+    cdef int first, second, mask
+    for row_index in range(masks.shape[0]):
+        for column_index in range(masks.shape[1]):
+
+            # Sub-cell pixels in raster order, and their distinct colors
+            count = 0
+            for i in range(cell_height):
+                for j in range(cell_width):
+                    k = i * cell_width + j
+                    values[k] = image[row_index * cell_height + i, column_index * cell_width + j]
+                    for first in range(count):
+                        if colors[first] == values[k]:
+                            break
+                    else:
+                        colors[count] = values[k]
+                        rgb[count] = palette[values[k]] if palette != NULL else values[k]
+                        count += 1
+
+            # Pick the pair of colors with the lowest error, the pixels of any other
+            # color being printed using the closest color of the pair
+            first, second = 0, min(1, count - 1)
+            if count > 2:
+                best_error = -1
+                for i in range(count):
+                    for j in range(i + 1, count):
+                        error = 0
+                        for k in range(count):
+                            error += min(
+                                color_distance(rgb[k], rgb[i]),
+                                color_distance(rgb[k], rgb[j]),
+                            )
+                        if best_error < 0 or error < best_error:
+                            best_error, first, second = error, i, j
+
+            # The first color is the color of the first pixel, and uniform cells
+            # have an empty mask, so that identical cells are stored the same way
+            mask = 0
+            for k in range(size):
+                for i in range(count):
+                    if colors[i] == values[k]:
+                        break
+                if i == first or (
+                    i != second and
+                    color_distance(rgb[i], rgb[first]) <= color_distance(rgb[i], rgb[second])
+                ):
+                    mask |= 1 << k
+            if not mask & 1:
+                first, second = second, first
+                mask ^= (1 << size) - 1
+            if mask == (1 << size) - 1:
+                second, mask = first, 0
+            cells[2 * row_index + 0, column_index] = colors[first]
+            cells[2 * row_index + 1, column_index] = colors[second]
+            masks[row_index, column_index] = mask
+
+
+# Scratch buffers of `encode`, kept per thread since the bands of a frame are encoded
+# concurrently, and allocated once for each size of frame
+_scratch = threading.local()
+MAX_SCRATCH_BUFFERS = 32
+
+
+cdef object scratch_buffer(
+    str name, Py_ssize_t rows, Py_ssize_t columns, Py_ssize_t itemsize, const char* format
+):
+    cdef dict buffers = getattr(_scratch, "buffers", None)
+    if buffers is None:
+        buffers = _scratch.buffers = {}
+    key = (name, rows, columns, itemsize)
+    result = buffers.get(key)
+    if result is None:
+        # Forget the buffers of the previous sizes if the frame keeps being resized
+        if len(buffers) >= MAX_SCRATCH_BUFFERS:
+            buffers.clear()
+        result = buffers[key] = view.array((rows, columns), itemsize, format)
+    return result
+
+
+@boundscheck(False)
+cdef void upscale(
+    pixel_t[:, ::1] image,
+    pixel_t[:, ::1] reference,
+    pixel_t[:, ::1] scaled_reference,
+    const int* row_map, const int* column_map,
+    pixel_t[:, ::1] output,
+) noexcept nogil:
+    # Gather the pixels of the scaled image using the index maps. The rows that are
+    # identical to the reference image (compared in source pixels) are copied from
+    # its scaled version instead.
+    cdef int row_index, column_index, source_index
+    cdef size_t size = output.shape[1] * sizeof(pixel_t)
+    for row_index in range(output.shape[0]):
+        source_index = row_map[row_index]
+        if row_index > 0 and row_map[row_index - 1] == source_index:
+            memcpy(&output[row_index, 0], &output[row_index - 1, 0], size)
+        elif reference is not None and memcmp(
+            &image[source_index, 0], &reference[source_index, 0],
+            image.shape[1] * sizeof(pixel_t),
+        ) == 0:
+            memcpy(&output[row_index, 0], &scaled_reference[row_index, 0], size)
+        else:
+            for column_index in range(output.shape[1]):
+                output[row_index, column_index] = image[source_index, column_map[column_index]]
+
+
+cdef Py_ssize_t encode(
+    pixel_t[:, ::1] image,
+    pixel_t[:, ::1] last,
+    const uint32_t* palette,
+    int refx, int refy, int width, int height,
+    int color_mode,
+    int capabilities,
+    int glyph_set,
+    int scale,
+    int64_t* state,
+    char* base,
+) except -1:
+    cdef char* result
+    cdef Run* runs
+    cdef Cursor cursor
+    cdef int* row_map
+    cdef int* column_map
+    cdef int i
+    cdef pixel_t[:, ::1] scaled_image
+    cdef pixel_t[:, ::1] scaled_last = None
+    cdef pixel_t[:, ::1] no_reference = None
+    cdef Cells cells
+    cdef pixel_t[:, ::1] image_cells
+    cdef pixel_t[:, ::1] last_cells = None
+    cdef uint8_t[:, ::1] image_masks
+    cdef uint8_t[:, ::1] last_masks
+    cdef int row_count, column_count, cell_count
+    cdef const char* pixel_format = "B" if pixel_t is uint8_t else "I"
+
+    # Make sure the escape sequences are ready for this color mode
+    build_sgr_table(color_mode)
+
+    if glyph_set < HALF_BLOCKS or glyph_set > SEXTANTS:
+        raise ValueError(f"Invalid glyph set: {glyph_set}")
+    if scale < 1:
+        raise ValueError(f"Invalid scale: {scale}")
+
+    # Upscale the frames using precomputed maps from the scaled pixels to the source
+    # pixels. The last printed frame is kept at the source resolution, so the rows
+    # that did not change are detected in source pixels.
+    if scale > 1 and image.shape[0] > 0 and image.shape[1] > 0:
+        row_map = <int *> malloc((image.shape[0] + image.shape[1]) * scale * sizeof(int))
+        if row_map == NULL:
+            raise MemoryError
+        column_map = row_map + image.shape[0] * scale
+        for i in range(image.shape[0] * scale):
+            row_map[i] = i // scale
+        for i in range(image.shape[1] * scale):
+            column_map[i] = i // scale
+        try:
+            scaled_image = scratch_buffer(
+                "scaled_image", image.shape[0] * scale, image.shape[1] * scale,
+                sizeof(pixel_t), pixel_format,
+            )
+            with nogil:
+                upscale(image, no_reference, no_reference, row_map, column_map, scaled_image)
+            if last is not None:
+                scaled_last = scratch_buffer(
+                    "scaled_last", image.shape[0] * scale, image.shape[1] * scale,
+                    sizeof(pixel_t), pixel_format,
+                )
+                with nogil:
+                    upscale(last, image, scaled_image, row_map, column_map, scaled_last)
+        finally:
+            free(row_map)
+        image, last = scaled_image, scaled_last
+
+    # Half blocks are printed from the image directly, while the cells of the other
+    # glyph sets are packed first (along with the cells of the last printed frame)
+    cells.glyphs = glyph_tables[glyph_set]
+    cells.full_mask = (1 << (cell_widths[glyph_set] * cell_heights[glyph_set])) - 1
+    cells.masks = cells.last_masks = NULL
+    row_count = image.shape[0] // cell_heights[glyph_set]
+    column_count = image.shape[1] // cell_widths[glyph_set]
+    if glyph_set != HALF_BLOCKS and (row_count == 0 or column_count == 0):
+        image, last = image[:0], None
+    elif glyph_set != HALF_BLOCKS:
+        image_cells = scratch_buffer(
+            "image_cells", 2 * row_count, column_count, sizeof(pixel_t), pixel_format
+        )
+        image_masks = scratch_buffer("image_masks", row_count, column_count, 1, "B")
+        pack_cells(image, palette, glyph_set, image_cells, image_masks)
+        cells.masks = &image_masks[0, 0]
+        cells.stride = column_count
+        if last is not None:
+            last_cells = scratch_buffer(
+                "last_cells", 2 * row_count, column_count, sizeof(pixel_t), pixel_format
+            )
+            last_masks = scratch_buffer("last_masks", row_count, column_count, 1, "B")
+            pack_cells(last, palette, glyph_set, last_cells, last_masks)
+            cells.last_masks = &last_masks[0, 0]
+        image, last = image_cells, last_cells
+
+    # The cursor position and colors are unknown until the first move, unless they
+    # are provided by the caller (as left by the previous frame). Only the position
+    # and background are reused: a known foreground makes the greedy run printing
+    # favor full blocks over erased cells, which turns out longer overall.
+    cursor.x = cursor.y = -1
+    cursor.fg = cursor.bg = UNDRAWN
+    if state != NULL:
+        cursor.x, cursor.y = state[0], state[1]
+        cursor.bg = state_pixel(palette, state[3], color_mode)
+
+    # The runs are stored twice, in raster order and grouped by colors,
+    # followed by the cells printed by rectangular fills
+    cell_count = max(image.shape[0] // 2 * image.shape[1], 1)
+    runs = <Run *> malloc(2 * cell_count * sizeof(Run) + cell_count)
+    if runs == NULL:
+        raise MemoryError
+    try:
+        with nogil:
+            result = _blit(
+                image, last, &cells, palette, refx, refy, width, height,
+                color_mode, capabilities, base, runs, <uint8_t *> (runs + 2 * cell_count),
+                &cursor, state == NULL,
+            )
+    finally:
+        free(runs)
+    if state != NULL:
+        state[0], state[1] = cursor.x, cursor.y
+        state[2] = state_color(palette, cursor.fg, color_mode)
+        state[3] = state_color(palette, cursor.bg, color_mode)
+    return result - base
+
+
+cdef Py_ssize_t encode_frame(
+    object image,
+    object last,
+    object palette,
+    int refx, int refy, int width, int height,
+    int color_mode,
+    int capabilities,
+    int glyph_set,
+    int scale,
+    object state,
+    char* base,
+) except -1:
+    cdef uint32_t[::1] colors
+    cdef int64_t[::1] cursor_state
+    cdef int64_t* state_pointer = NULL
+
+    # Cursor state kept across frames: position and colors
+    if state is not None:
+        cursor_state = state
+        if cursor_state.shape[0] != 4:
+            raise ValueError("The cursor state must have 4 entries")
+        state_pointer = &cursor_state[0]
+
+    # RGB frame
+    if palette is None:
+        if color_mode == 5:
+            raise ValueError("The palette color mode requires an indexed frame")
+        return encode[uint32_t](
+            image, last, NULL, refx, refy, width, height,
+            color_mode, capabilities, glyph_set, scale, state_pointer, base,
+        )
+
+    # Indexed frame
+    colors = palette
+    if colors.shape[0] != PALETTE_SIZE:
+        raise ValueError("The palette must have 256 entries")
+    return encode[uint8_t](
+        image, last, &colors[0], refx, refy, width, height,
+        color_mode, capabilities, glyph_set, scale, state_pointer, base,
+    )
 
+
+def blit(
+    image,
+    last,
+    int refx, int refy, int width, int height,
+    int color_mode,
+    int capabilities=0,
+    palette=None,
+    int glyph_set=0,
+    int scale=1,
+    state=None,
+):
+    cdef Py_ssize_t length
+    cdef char* base = <char *> malloc(max_blit_size(image.shape[0], image.shape[1], scale))
+    if base == NULL:
+        raise MemoryError
     try:
-        return base[:result - base]
+        length = encode_frame(
+            image, last, palette, refx, refy, width, height,
+            color_mode, capabilities, glyph_set, scale, state, base,
+        )
+        return base[:length]
     finally:
         free(base)
 
+
+def blit_into(
+    image,
+    last,
+    int refx, int refy, int width, int height,
+    int color_mode,
+    unsigned char[::1] output,
+    int capabilities=0,
+    palette=None,
+    int glyph_set=0,
+    int scale=1,
+    state=None,
+):
+    # The output buffer is owned by the caller, and must be large enough for the worst case
+    if output.shape[0] < max_blit_size(image.shape[0], image.shape[1], scale):
+        raise ValueError("Output buffer is too small")
+    return encode_frame(
+        image, last, palette, refx, refy, width, height,
+        color_mode, capabilities, glyph_set, scale, state, <char *> &output[0],
+    )
+
+
+# Sixel images are made of bands of 6 pixel rows
+cdef enum:
+    SIXEL_BAND_HEIGHT = 6
+    MAX_SIXEL_SCALE = 16
+
+
+def max_sixel_size(int image_height, int image_width, int scale=1):
+    # Each band has at most 6 colors per column, so the runs of the color
+    # passes of a band change at most 12 times per column
+    cdef int bands = (image_height * scale + SIXEL_BAND_HEIGHT - 1) // SIXEL_BAND_HEIGHT
+    return 16384 + bands * (96 * image_width + 8192)
+
+
+cdef inline char* print_sixel(char* buff, char sixel, int count) noexcept nogil:
+    # Use the repeat introducer for runs longer than itself
+    if count > 3:
+        buff += sprintf(buff, "!%d%c", count, sixel)
+    else:
+        memset(buff, sixel, count)
+        buff += count
+    return buff
+
+
+@boundscheck(False)
+cdef int sixel_rows(int band, int scale, int image_height, int* rows) noexcept nogil:
+    # Image rows of the pixel rows of a band (-1 below the image), returns the count
+    cdef int k, y
+    cdef int count = 0
+    for k in range(SIXEL_BAND_HEIGHT):
+        y = band * SIXEL_BAND_HEIGHT + k
+        rows[k] = y // scale if y < image_height * scale else -1
+        count += rows[k] >= 0
+    return count
+
+
+@boundscheck(False)
+cdef int band_changed(
+    uint8_t[:, ::1] image,
+    uint8_t[:, ::1] last,
+    int* rows,
+    int* start, int* stop,
+) noexcept nogil:
+    # Range of columns that changed in the rows of a band
+    cdef int k, x
+    cdef int width = image.shape[1]
+    start[0], stop[0] = width, 0
+    for k in range(SIXEL_BAND_HEIGHT):
+        if rows[k] < 0 or (k > 0 and rows[k] == rows[k - 1]):
+            continue
+        if last is None:
+            start[0], stop[0] = 0, width
+            break
+        if memcmp(&image[rows[k], 0], &last[rows[k], 0], width) == 0:
+            continue
+        for x in range(width):
+            if image[rows[k], x] != last[rows[k], x]:
+                start[0] = min(start[0], x)
+                break
+        for x in range(width - 1, -1, -1):
+            if image[rows[k], x] != last[rows[k], x]:
+                stop[0] = max(stop[0], x + 1)
+                break
+    return start[0] < stop[0]
+
+
+@boundscheck(False)
+cdef char* print_band(
+    char* buff,
+    uint8_t[:, ::1] image,
+    int* rows, int start, int stop, int scale,
+) noexcept nogil:
+    cdef uint8_t used[256]
+    cdef int k, x, color, bits
+    cdef char sixel, pending
+    cdef int pending_count
+    cdef int first = True
+
+    # Colors used in the changed part of the band
+    memset(used, 0, sizeof(used))
+    for k in range(SIXEL_BAND_HEIGHT):
+        if rows[k] >= 0:
+            for x in range(start, stop):
+                used[image[rows[k], x]] = True
+
+    # One pass per color, going back to the start of the band (`$`) in between.
+    # The background is transparent, so the columns on the left are skipped
+    # using empty sixels, and the trailing empty sixels are omitted.
+    for color in range(256):
+        if not used[color]:
+            continue
+        if not first:
+            buff[0] = b'$'
+            buff += 1
+        first = False
+        buff += sprintf(buff, "#%d", color)
+        pending, pending_count = b'?', start * scale
+        for x in range(start, stop):
+            bits = 0
+            for k in range(SIXEL_BAND_HEIGHT):
+                if rows[k] >= 0 and image[rows[k], x] == color:
+                    bits |= 1 << k
+            sixel = 63 + bits
+            if sixel == pending:
+                pending_count += scale
+                continue
+            if pending_count > 0:
+                buff = print_sixel(buff, pending, pending_count)
+            pending, pending_count = sixel, scale
+        if pending != b'?':
+            buff = print_sixel(buff, pending, pending_count)
+    return buff
+
+
+@boundscheck(False)
+cdef char* _sixel_blit(
+    uint8_t[:, ::1] image,
+    uint8_t[:, ::1] last,
+    const uint32_t* palette,
+    int refx, int refy, int scale,
+    char* base,
+) noexcept nogil:
+    cdef int rows[SIXEL_BAND_HEIGHT]
+    cdef uint8_t used[256]
+    cdef int band, k, x, start, stop, color
+    cdef int image_height = image.shape[0]
+    cdef int bands = (image_height * scale + SIXEL_BAND_HEIGHT - 1) // SIXEL_BAND_HEIGHT
+    cdef int last_band = -1
+    cdef char* buff = base
+
+    # Find the last band that changed, and the colors used by the changed bands
+    memset(used, 0, sizeof(used))
+    for band in range(bands):
+        sixel_rows(band, scale, image_height, rows)
+        if band_changed(image, last, rows, &start, &stop):
+            last_band = band
+            for k in range(SIXEL_BAND_HEIGHT):
+                if rows[k] >= 0:
+                    for x in range(start, stop):
+                        used[image[rows[k], x]] = True
+    if last_band < 0:
+        return buff
+
+    # Move to the reference point and start the sixel image, with square pixels
+    # and a transparent background so that the unchanged pixels are left as is
+    buff += sprintf(buff, "\033[%d;%dH\033P0;1;0q\"1;1;%d;%d", refx, refy,
+                    <int> image.shape[1] * scale, image_height * scale)
+
+    # Define the color registers, numbered after the palette entries
+    for color in range(256):
+        if used[color]:
+            buff += sprintf(
+                buff, "#%d;2;%d;%d;%d", color,
+                <int> ((((palette[color] >> 16) & 0xff) * 100 + 127) // 255),
+                <int> ((((palette[color] >> 8) & 0xff) * 100 + 127) // 255),
+                <int> (((palette[color] & 0xff) * 100 + 127) // 255),
+            )
+
+    # Print the bands that changed, and skip the others using graphics new lines (`-`)
+    for band in range(last_band + 1):
+        if band > 0:
+            buff[0] = b'-'
+            buff += 1
+        sixel_rows(band, scale, image_height, rows)
+        if band_changed(image, last, rows, &start, &stop):
+            buff = print_band(buff, image, rows, start, stop, scale)
+
+    # String terminator
+    buff += sprintf(buff, "\033\\")
+    return buff
+
+
+def sixel_blit_into(
+    uint8_t[:, ::1] image not None,
+    uint8_t[:, ::1] last,
+    uint32_t[::1] palette not None,
+    int refx, int refy, int scale,
+    unsigned char[::1] output not None,
+):
+    cdef char* base
+    cdef char* result
+    if last is not None and (
+        image.shape[0] != last.shape[0] or image.shape[1] != last.shape[1]
+    ):
+        raise ValueError("Last frame shape does not match the image shape")
+    if palette.shape[0] != PALETTE_SIZE:
+        raise ValueError("The palette must have 256 entries")
+    if not 1 <= scale <= MAX_SIXEL_SCALE:
+        raise ValueError(f"The scale must be between 1 and {MAX_SIXEL_SCALE}")
+
+    # The output buffer is owned by the caller, and must be large enough for the worst case
+    if output.shape[0] < max_sixel_size(image.shape[0], image.shape[1], scale):
+        raise ValueError("Output buffer is too small")
+
+    with nogil:
+        base = <char *> &output[0]
+        result = _sixel_blit(image, last, &palette[0], refx, refy, scale, base)
+    return result - base
@@ -0,0 +1,223 @@
+"""Benchmark of the video encoder over the recorded corpus of consecutive frames
+(see `scripts/record_corpus.py`), reporting the encoding time and the size of the
+frames for each color mode and terminal size.
+
+The sizes are checked against the stored baselines by the test suite, while the
+encoding times are only checked on demand, since they depend on the machine:
+
+    python tests/benchmark.py [--check-timing] [--update]
+"""
+
+from __future__ import annotations
+
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from dataclasses import dataclass
+
+import numpy as np
+import numpy.typing as npt
+
+from gambaterm.capabilities import Capability
+from gambaterm.colors import ColorMode
+from gambaterm.console import GameboyColor
+from gambaterm.run import (
+    UNKNOWN_CURSOR,
+    Palette,
+    TerminalPalette,
+    get_palette_size,
+    get_ref,
+)
+from gambaterm.termblit import blit, quantize
+
+CORPUS = Path(__file__).parent / "corpus.npz"
+BASELINES = Path(__file__).parent / "benchmark_baselines.json"
+
+COLOR_MODES = tuple(mode for mode in ColorMode if mode != ColorMode.COULD_NOT_DETECT)
+# Terminal sizes (width, height): cropping the screen, and fitting it
+TERMINAL_SIZES = ((80, 24), (164, 76))
+CAPABILITIES = (
+    Capability.REPEAT | Capability.ERASE_CHARACTERS | Capability.SCROLL_REGION
+)
+
+# Slower encoding times are only reported as regressions above this margin
+TIMING_TOLERANCE = 0.25
+
+
+@dataclass
+class Result:
+    frames: int
+    size: int  # bytes
+    duration: float  # seconds
+
+    @property
+    def bytes_per_frame(self) -> float:
+        return self.size / self.frames
+
+    @property
+    def ns_per_frame(self) -> float:
+        return self.duration / self.frames * 1e9
+
+
+def load_corpus() -> dict[str, npt.NDArray[np.uint32]]:
+    """Return the frames of each scene of the corpus."""
+    with np.load(CORPUS) as data:
+        return {
+            name: data[f"{name}_palette"][data[name]]
+            for name in data.files
+            if not name.endswith("_palette")
+        }
+
+
+def benchmark_scene(
+    frames: npt.NDArray[np.uint32],
+    color_mode: ColorMode,
+    width: int,
+    height: int,
+    repeat: int = 1,
+) -> Result:
+    """Encode each frame of a scene over the previous one, as `run` does, keeping
+    the best time out of `repeat` encodings."""
+    # Only the dimensions of the console are used
+    refx, refy = get_ref(width, height, GameboyColor)  # type: ignore[arg-type]
+    palette = Palette()
+    palette.size = get_palette_size(color_mode)
+    terminal_palette = TerminalPalette()
+    state = np.array(UNKNOWN_CURSOR, np.int64)
+    quantized = np.empty_like(frames[0])
+    indexed, last_indexed = np.zeros((2, *frames[0].shape), np.uint8)
+    quantize(frames[0], color_mode, quantized)
+    assert palette.index(quantized, last_indexed)
+    palette.commit()
+    terminal_palette.update(palette)
+    size = 0
+    duration = 0.0
+    for frame in frames[1:]:
+        quantize(frame, color_mode, quantized)
+        assert palette.index(quantized, indexed)
+        if color_mode == ColorMode.HAS_PALETTE_COLOR:
+            size += len(terminal_palette.update(palette))
+        best = float("inf")
+        for _ in range(repeat):
+            frame_state = state.copy()
+            start = time.perf_counter()
+            data = blit(
+                indexed,
+                last_indexed,
+                refx,
+                refy,
+                width - 1,
+                height,
+                color_mode,
+                CAPABILITIES,
+                palette.colors,
+                state=frame_state,
+            )
+            best = min(best, time.perf_counter() - start)
+        state = frame_state
+        size += len(data)
+        duration += best
+        palette.commit()
+        indexed, last_indexed = last_indexed, indexed
+    return Result(len(frames) - 1, size, duration)
+
+
+def run_benchmark(repeat: int = 1) -> dict[str, Result]:
+    """Return the results for each color mode, terminal size and scene."""
+    results = {}
+    for name, frames in load_corpus().items():
+        for color_mode in COLOR_MODES:
+            for width, height in TERMINAL_SIZES:
+                key = f"{color_mode.name.lower()}/{width}x{height}/{name}"
+                results[key] = benchmark_scene(
+                    frames, color_mode, width, height, repeat
+                )
+    return results
+
+
+def load_baselines() -> dict[str, dict[str, float]]:
+    with open(BASELINES) as file:
+        baselines: dict[str, dict[str, float]] = json.load(file)
+    return baselines
+
+
+def save_baselines(results: dict[str, Result]) -> None:
+    baselines = {
+        key: {
+            "bytes_per_frame": result.bytes_per_frame,
+            "ns_per_frame": round(result.ns_per_frame),
+        }
+        for key, result in sorted(results.items())
+    }
+    with open(BASELINES, "w") as file:
+        json.dump(baselines, file, indent=2)
+        file.write("\n")
+
+
+def regressions(
+    results: dict[str, Result],
+    baselines: dict[str, dict[str, float]],
+    timing: bool = False,
+) -> list[str]:
+    """Return the descriptions of the results worse than their baseline.
+
+    The sizes are compared for each scene, and the encoding times for each color
+    mode and terminal size, summed over the scenes to reduce the noise.
+    """
+    descriptions = []
+    durations: dict[str, list[float]] = {}
+    for key, result in results.items():
+        if key not in baselines:
+            descriptions.append(f"{key}: no baseline")
+            continue
+        baseline = baselines[key]
+        if result.bytes_per_frame > baseline["bytes_per_frame"]:
+            descriptions.append(
+                f"{key}: {result.bytes_per_frame:.1f} bytes/frame"
+                f" (baseline {baseline['bytes_per_frame']:.1f})"
+            )
+        group = durations.setdefault(key.rsplit("/", 1)[0], [0.0, 0.0])
+        group[0] += result.ns_per_frame
+        group[1] += baseline["ns_per_frame"]
+    for group_key, (duration, baseline_duration) in durations.items():
+        if timing and duration > baseline_duration * (1 + TIMING_TOLERANCE):
+            descriptions.append(
+                f"{group_key}: {duration:.0f} ns/frame over all scenes"
+                f" (baseline {baseline_duration:.0f})"
+            )
+    return descriptions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--check-timing", action="store_true", help="Also check the encoding times"
+    )
+    parser.add_argument(
+        "--update", action="store_true", help="Store the results as new baselines"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=20, help="Number of timed encodings per frame"
+    )
+    args = parser.parse_args()
+    results = run_benchmark(args.repeat)
+    baselines = {} if args.update else load_baselines()
+    print(f"{'benchmark':<40} {'bytes/frame':>12} {'ns/frame':>12} {'baseline':>12}")
+    for key, result in results.items():
+        baseline = baselines.get(key, {}).get("bytes_per_frame", float("nan"))
+        print(
+            f"{key:<40} {result.bytes_per_frame:>12.1f}"
+            f" {result.ns_per_frame:>12.0f} {baseline:>12.1f}"
+        )
+    if args.update:
+        save_baselines(results)
+        return
+    if failures := regressions(results, baselines, args.check_timing):
+        print("\nRegressions:", *failures, sep="\n")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
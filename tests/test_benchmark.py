@@ -0,0 +1,28 @@
+from benchmark import (
+    COLOR_MODES,
+    TERMINAL_SIZES,
+    load_baselines,
+    load_corpus,
+    regressions,
+    run_benchmark,
+)
+
+
+def test_corpus() -> None:
+    corpus = load_corpus()
+    assert set(corpus) == {
+        "static",
+        "scroll_horizontal",
+        "scroll_vertical",
+        "sprites",
+        "flicker",
+        "fade",
+        "transition",
+    }
+    assert all(frames.shape == (8, 144, 160) for frames in corpus.values())
+
+
+def test_bytes_per_frame() -> None:
+    results = run_benchmark()
+    assert len(results) == 7 * len(COLOR_MODES) * len(TERMINAL_SIZES)
+    assert regressions(results, load_baselines()) == []
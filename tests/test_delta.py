@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import socket
+from pathlib import Path
+from subprocess import Popen, PIPE
+
+import numpy as np
+import pytest
+
+from benchmark import TERMINAL_SIZES, benchmark_scene, load_corpus
+from gambaterm.colors import ColorMode
+from gambaterm.delta_client import RemoteConsole
+from gambaterm.delta_protocol import (
+    Compression,
+    FrameDecoder,
+    FrameEncoder,
+    MessageReader,
+    ProtocolError,
+    choose_compression,
+    pack_hello,
+    unpack_hello,
+)
+
+TEST_ROM = Path(__file__).parent / "test_rom.gb"
+
+
+@pytest.mark.parametrize("compression", Compression.available())
+def test_delta_corpus(compression: Compression) -> None:
+    corpus = load_corpus()
+    size = 0
+    for frames in corpus.values():
+        height, width = frames[0].shape
+        encoder = FrameEncoder(height, width, compression)
+        decoder = FrameDecoder(height, width, compression)
+        reader = MessageReader()
+        image = np.zeros((height, width), np.uint32)
+        for index, frame in enumerate(frames):
+            data = encoder.encode(frame)
+            size += len(data) if index else 0
+            reader.feed(data)
+            for _, payload in reader:
+                decoder.decode(payload)
+            decoder.image(image)
+            assert (image & 0xFFFFFF == frame & 0xFFFFFF).all()
+        assert encoder.encode(frames[-1]) == b""
+    if compression != Compression.NONE:
+        # About 9 times smaller than the true color frames printed on a large
+        # terminal
+        width, height = TERMINAL_SIZES[-1]
+        ansi_size = sum(
+            benchmark_scene(frames, ColorMode.HAS_24_BIT_COLOR, width, height).size
+            for frames in corpus.values()
+        )
+        assert size * 8 < ansi_size
+
+
+def test_delta_handshake() -> None:
+    requested = [Compression.ZSTD, Compression.ZLIB]
+    assert unpack_hello(pack_hello(requested)[5:]) == requested
+    assert choose_compression(requested, [Compression.ZLIB]) == Compression.ZLIB
+    assert choose_compression(requested, []) == Compression.NONE
+    with pytest.raises(ProtocolError):
+        unpack_hello(b"HTTP/1.1")
+    reader = MessageReader()
+    reader.feed(b"GET / HTTP/1.1\r\n")
+    with pytest.raises(ProtocolError):
+        list(reader)
+
+
+def test_gambaterm_delta(tmp_path: Path) -> None:
+    path = tmp_path / "delta.sock"
+    command = (
+        f"{sys.executable} -m gambaterm.delta {TEST_ROM} --break-after 120"
+        f" --unix-socket {path} --max-clients 1"
+    )
+    env = os.environ.copy()
+    env["PYTHONUNBUFFERED"] = "1"
+    server = Popen(command.split(), stdout=PIPE, bufsize=0, text=True, env=env)
+    assert server.stdout is not None
+    try:
+        assert "Running delta server" in server.stdout.readline()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(str(path))
+        with sock:
+            console = RemoteConsole(sock, [Compression.ZLIB])
+            assert console.romfile == "test_rom.gb"
+            assert console.compression == Compression.ZLIB
+            # The clients over the limit are rejected
+            other = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            other.connect(str(path))
+            with other, pytest.raises(ProtocolError):
+                RemoteConsole(other)
+            while "Too many clients" not in server.stdout.readline():
+                pass
+            video = np.zeros((console.HEIGHT, console.WIDTH), np.uint32)
+            audio = np.zeros((2 * console.TICKS_IN_FRAME, 2), np.int16)
+            frames = 0
+            with pytest.raises(EOFError):
+                for _ in range(10_000):
+                    console.set_input({console.Input.START})
+                    offset, samples = console.advance_one_frame(video, audio)
+                    assert samples == console.TICKS_IN_FRAME
+                    frames += offset
+                    time.sleep(0.01)
+        assert frames > 0
+        assert len(np.unique(video)) > 1
+    finally:
+        server.terminate()
+        server.wait()
+        server.stdout.close()
@@ -12,9 +12,11 @@ TEST_ROM = Path(__file__).parent / "test_rom.gb"
 
 # Color argument variants for parametrization:
 #   "forced"  -- explicit --color-mode 4, bypasses auto-detection
+#   "palette" -- explicit --color-mode 5, redefines the terminal palette
 #   "auto"    -- no --color-mode, exercises detect_local_color_mode
 COLOR_ARG_VARIANTS = (
     pytest.param("--color-mode 4", id="forced-color"),
+    pytest.param("--color-mode 5", id="palette-color"),
     pytest.param("", id="auto-color"),
 )
 
@@ -63,6 +65,27 @@ def test_gambaterm(interactive: bool, color_arg: str) -> None:
         assert "▀ ▄▄ ▀" in result.stdout
 
 
+@pytest.mark.parametrize(
+    "renderer, sequence", (("sixel", "\033P0;1;0q"), ("kitty", "\033_Ga=T,"))
+)
+def test_gambaterm_graphics(renderer: str, sequence: str) -> None:
+    assert TEST_ROM.exists()
+    command = (
+        f"gambaterm {TEST_ROM} --break-after 10"
+        f" --input-file /dev/null --disable-audio --renderer {renderer}"
+    )
+    result = run(
+        f"script -e -q -c '{command}' /dev/null",
+        shell=True,
+        check=True,
+        text=True,
+        capture_output=True,
+    )
+    assert result.stderr == ""
+    assert f"| {renderer.capitalize()} renderer" in result.stdout
+    assert sequence in result.stdout
+
+
 @pytest.mark.parametrize("color_arg", COLOR_ARG_VARIANTS)
 def test_gambaterm_ssh(
     ssh_config: Path, gambaterm_config: Path, color_arg: str
@@ -0,0 +1,57 @@
+import base64
+import zlib
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pytest
+
+from gambaterm.kitty import KittyGraphics, graphics_command
+
+HEIGHT, WIDTH = 144, 160
+
+
+def random_frame(seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 1 << 24, (HEIGHT, WIDTH), dtype=np.uint32) | 0xFF000000
+
+
+def test_graphics_command() -> None:
+    assert graphics_command("a=d,q=2") == b"\033_Ga=d,q=2\033\\"
+    data = graphics_command("a=T", bytes(8192))
+    assert data.startswith(b"\033_Ga=T,m=1;")
+    assert data.count(b"\033_G") == 3
+    assert b"\033_Gm=0;" in data
+
+
+def test_shared_memory() -> None:
+    graphics = KittyGraphics(shared_memory=True)
+    image = random_frame(0)
+    data = graphics.blit(image, None, 2, 3, 40, 18)
+    assert data.startswith(b"\033[2;3H\033_Ga=T,i=1,p=1,t=s,f=24,s=160,v=144,")
+    assert len(data) < 128
+    name = base64.standard_b64decode(data.split(b";")[-1][:-2]).decode()
+    segment = SharedMemory(name)
+    try:
+        pixels = np.ndarray((HEIGHT, WIDTH, 3), np.uint8, segment.buf)
+        assert pixels[10, 20].tolist() == [
+            (int(image[10, 20]) >> shift) & 0xFF for shift in (16, 8, 0)
+        ]
+        del pixels
+    finally:
+        segment.close()
+    # The remaining objects are unlinked when closing
+    assert graphics.close() == b"\033_Ga=d,d=I,i=1,q=2\033\\"
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name)
+
+
+def test_changed_rectangle() -> None:
+    graphics = KittyGraphics(shared_memory=False)
+    image, last = random_frame(0), random_frame(0)
+    assert graphics.blit(last, None, 2, 3, 40, 18).startswith(b"\033[2;3H\033_Ga=T,")
+    assert graphics.blit(image, last, 2, 3, 40, 18) == b""
+    image[20:30, 40:45] = 0xFF102030
+    data = graphics.blit(image, last, 2, 3, 40, 18)
+    keys, payload = data[3:-2].split(b";")
+    assert keys == b"a=f,i=1,r=1,x=40,y=20,s=5,v=10,f=24,o=z,q=2"
+    assert zlib.decompress(base64.standard_b64decode(payload)) == b"\x10\x20\x30" * 50
@@ -0,0 +1,630 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import numpy.typing as npt
+import pytest
+from blessed import Terminal
+
+from gambaterm.capabilities import Capability
+from gambaterm.colors import ColorMode
+from gambaterm.console import Console
+from gambaterm.input_getter import BaseInputGetter
+from gambaterm.renderers import GlyphSet
+from gambaterm.run import (
+    Deflicker,
+    FrameBuffer,
+    LossyFilter,
+    Palette,
+    TerminalPalette,
+    ROW_GROUP_SIZE,
+    TerminalState,
+    UNKNOWN_CURSOR,
+    encode_rows,
+    interlace,
+    run,
+)
+from gambaterm.termblit import (
+    blit,
+    blit_into,
+    is_unchanged,
+    max_blit_size,
+    max_sixel_size,
+    perceptual_filter,
+    quantize,
+    sixel_blit_into,
+)
+
+HEIGHT, WIDTH = 144, 160
+
+
+def random_frame(seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 1 << 24, 8, dtype=np.uint32) | 0xFF000000
+    return np.ascontiguousarray(palette[rng.integers(0, 8, (HEIGHT, WIDTH))])
+
+
+@pytest.mark.parametrize("color_mode", (1, 2, 3, 4))
+def test_blit_into(color_mode: int) -> None:
+    image, last = random_frame(0), random_frame(1)
+    output = bytearray(max_blit_size(HEIGHT, WIDTH))
+    for previous in (None, last):
+        expected = blit(image, previous, 2, 3, 79, 24, color_mode)
+        length = blit_into(image, previous, 2, 3, 79, 24, color_mode, output)
+        assert output[:length] == expected
+
+
+def test_blit_into_small_buffer() -> None:
+    image = random_frame(0)
+    output = bytearray(max_blit_size(HEIGHT, WIDTH) - 1)
+    with pytest.raises(ValueError):
+        blit_into(image, None, 2, 3, 79, 24, 4, output)
+
+
+def test_unchanged_frame() -> None:
+    image = random_frame(0)
+    last = image.copy()
+    assert is_unchanged(image, last)
+    assert blit(image, last, 2, 3, 79, 24, 4) == b"\033[0m"
+    last[100, 50] ^= 1
+    assert not is_unchanged(image, last)
+    assert len(blit(image, last, 2, 3, 200, 80, 4)) < 64
+
+
+@pytest.mark.parametrize("color_mode", (1, 2, 3, 4))
+def test_quantize(color_mode: int) -> None:
+    image = random_frame(0)
+    quantized, twice = np.empty_like(image), np.empty_like(image)
+    quantize(image, color_mode, quantized)
+    quantize(quantized, color_mode, twice)
+    assert (quantized == twice).all()
+    # A slight color change is only printed in true color mode
+    changed = image.copy()
+    changed[changed == changed[0, 0]] ^= 0x000100
+    quantize(changed, color_mode, twice)
+    assert is_unchanged(quantized, twice) == (color_mode != 4)
+
+
+def baseline_4_colors(image: np.ndarray) -> np.ndarray:
+    """Foreground SGR code of the 4 color mode, computed for each pixel as the
+    original encoder did."""
+    r, g, b = ((image.astype(np.int64) >> shift & 0xFF) for shift in (16, 8, 0))
+    luminance = 2 * (r * r >> 3) + 5 * (g * g >> 3) + (b * b >> 3)
+    thresholds = [(64 - 40) ** 2, (128 - 64) ** 2, (64 + 128 - 42) ** 2]
+    codes = np.array([30, 90, 37, 97])
+    result: np.ndarray = codes[np.searchsorted(thresholds, luminance, side="left")]
+    return result
+
+
+def test_quantize_4_colors() -> None:
+    # All the 15-bit colors, expanded to 24 bits as the emulator does
+    key = np.arange(1 << 15, dtype=np.uint32).reshape(128, 256)
+    r, g, b = key >> 10 & 0x1F, key >> 5 & 0x1F, key & 0x1F
+    r, g, b = (r << 3) | (r >> 2), (g << 3) | (g >> 2), (b << 3) | (b >> 2)
+    image = (0xFF000000 | (r << 16) | (g << 8) | b).astype(np.uint32)
+    quantized = np.empty_like(image)
+    quantize(image, 1, quantized)
+    assert (baseline_4_colors(quantized) == baseline_4_colors(image)).all()
+    # The quantized colors are printed using the baseline codes
+    for color in np.unique(quantized):
+        code = int(baseline_4_colors(color))
+        cell = np.full((2, 1), color, np.uint32)
+        assert b"\033[%dm" % (code + 10) in blit(cell, None, 2, 3, 80, 24, 1)
+
+
+def test_palette() -> None:
+    palette = Palette()
+    frames = [random_frame(seed) for seed in range(64)]
+    indices = [np.empty(frame.shape, np.uint8) for frame in frames]
+    for i, (frame, output) in enumerate(zip(frames, indices)):
+        assert palette.index(frame, output)
+        assert (palette.colors[output] == frame).all()
+        # The colors of the last printed frame keep their indices
+        if i > 0:
+            assert (palette.colors[indices[i - 1]] == frames[i - 1]).all()
+        palette.commit()
+    # Too many colors
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 1 << 24, (HEIGHT, WIDTH), dtype=np.uint32)
+    assert not palette.index(image | np.uint32(0xFF000000), indices[0])
+    # The palette recovers from a frame with too many colors
+    image = rng.integers(0, 1 << 24, (HEIGHT, WIDTH), dtype=np.uint32)
+    image[:] = (image[:1, :10] | np.uint32(0xFF000000))[:, np.arange(WIDTH) % 10]
+    assert palette.index(image, indices[0])
+    assert (palette.colors[indices[0]] == image).all()
+    assert (palette.colors[indices[-1]] == frames[-1]).all()
+
+
+def test_terminal_palette() -> None:
+    palette, terminal_palette = Palette(), TerminalPalette()
+    palette.size = TerminalPalette.SIZE
+    image = np.full((HEIGHT, WIDTH), 0xFF102030, np.uint32)
+    indexed = np.empty((HEIGHT, WIDTH), np.uint8)
+    assert palette.index(image, indexed)
+    assert terminal_palette.update(palette) == b"\033]4;16;rgb:10/20/30\033\\"
+    assert blit(indexed, None, 2, 3, 79, 24, 5, 0, palette.colors).startswith(
+        b"\033[2;3H\033[48;5;16m"
+    )
+    palette.commit()
+    assert palette.index(image, indexed)
+    assert terminal_palette.update(palette) == b""
+    assert terminal_palette.restore() == b"\033]104;16\033\\"
+    assert terminal_palette.restore() == b""
+
+
+@pytest.mark.parametrize("color_mode", (1, 2, 3, 4))
+def test_indexed_frame(color_mode: int) -> None:
+    palette = Palette()
+    image, last = random_frame(0), random_frame(0)
+    last[100, 50] ^= 1
+    indexed, last_indexed = np.empty((2, HEIGHT, WIDTH), np.uint8)
+    assert palette.index(last, last_indexed)
+    palette.commit()
+    assert palette.index(image, indexed)
+    assert blit(indexed, indexed, 2, 3, 79, 24, color_mode, 0, palette.colors) == (
+        b"\033[0m"
+    )
+    assert blit(
+        indexed, last_indexed, 2, 3, 200, 80, color_mode, 0, palette.colors
+    ) == (blit(image, last, 2, 3, 200, 80, color_mode))
+
+
+def test_cursor_movement() -> None:
+    image = np.full((HEIGHT, WIDTH), 0xFF102030, np.uint32)
+    image[2, 10], image[3, 10] = 0xFF708090, 0xFF405060
+    last = image.copy()
+    last[0, 10] = last[0, 12] = last[2, 10] = 0
+    # The gap is printed again, then the cursor moves down and back,
+    # and both colors are set using a single sequence
+    assert blit(image, last, 2, 3, 200, 80, 4) == (
+        b"\033[2;13H\033[48;2;16;32;48m   "
+        b"\033[B\b\b\b\033[38;2;112;128;144;48;2;64;80;96m\xe2\x96\x80\033[0m"
+    )
+
+
+@pytest.mark.parametrize("capabilities", (1, 2, 3))
+def test_run_length_encoding(capabilities: int) -> None:
+    image = np.full((HEIGHT, WIDTH), 0xFF102030, np.uint32)
+    image[HEIGHT // 2 :, :] = 0xFF405060
+    plain = blit(image, None, 2, 3, 200, 80, 4)
+    encoded = blit(image, None, 2, 3, 200, 80, 4, capabilities)
+    assert len(encoded) < len(plain) // 10
+    if capabilities & 2:
+        assert b"\033[160X" in encoded
+    else:
+        assert b" \033[159b" in encoded
+
+
+def test_grouped_emission() -> None:
+    # Small sprites with alternating colors, over a uniform background
+    last = np.full((HEIGHT, WIDTH), 0xFF102030, np.uint32)
+    image = last.copy()
+    for column in range(0, WIDTH, 8):
+        colors = (0xFF405060, 0xFF708090) if column % 16 else (0xFFA0B0C0, 0xFFD0E0F0)
+        image[0:16:2, column : column + 4] = colors[0]
+        image[1:16:2, column : column + 4] = colors[1]
+    encoded = blit(image, last, 2, 3, 200, 80, 4)
+    assert encoded.count(b"\033[38;2;") == 2
+    assert encoded.count(b"\033[48;2;") == 0
+
+
+@pytest.mark.parametrize("shift", (-6, -2, 2, 6))
+def test_scroll_detection(shift: int) -> None:
+    last = random_frame(0)
+    image = np.roll(last, -shift, axis=0)
+    plain = blit(image, last, 2, 3, 200, 80, 4)
+    scrolled = blit(image, last, 2, 3, 200, 80, 4, 4)
+    assert len(scrolled) < len(plain) // 10
+    sequence = f"\033[{abs(shift) // 2}{'S' if shift > 0 else 'T'}"
+    assert sequence.encode() in scrolled
+
+
+@pytest.mark.parametrize("threads", (2, 3))
+def test_band_encoding(threads: int) -> None:
+    image, last = random_frame(0), random_frame(1)
+    frame_data = FrameBuffer(0)
+    frame_data.blit(
+        image, last, 2, 3, 200, 80, ColorMode.HAS_24_BIT_COLOR, threads=threads
+    )
+    bounds = [2 * (HEIGHT // 2 * i // threads) for i in range(threads + 1)]
+    expected = b"".join(
+        blit(image[start:stop], last[start:stop], 2 + start // 2, 3, 200, 80, 4)
+        for start, stop in zip(bounds, bounds[1:])
+    )
+    assert frame_data.getvalue() == expected
+
+
+@pytest.mark.parametrize("glyph_set, threads", ((0, 1), (1, 1), (2, 3)))
+def test_row_encoding(glyph_set: int, threads: int) -> None:
+    image = random_frame(0)
+    frame_data = FrameBuffer(0)
+    encode_rows.cache_clear()
+    frame_data.blit_rows(
+        image,
+        2,
+        3,
+        200,
+        80,
+        ColorMode.HAS_24_BIT_COLOR,
+        Capability.NONE,
+        threads,
+        GlyphSet(glyph_set),
+    )
+    # The groups of rows start with an absolute move, so they can be concatenated
+    size = ROW_GROUP_SIZE * GlyphSet(glyph_set).cell_height
+    expected = b"".join(
+        blit(
+            image[start : start + size],
+            None,
+            2 + i * ROW_GROUP_SIZE,
+            3,
+            200,
+            80,
+            4,
+            glyph_set=glyph_set,
+        )
+        for i, start in enumerate(range(0, HEIGHT, size))
+    )
+    assert frame_data.getvalue() == expected
+    # A second redraw re-uses the encoded groups
+    frame_data.clear()
+    frame_data.blit_rows(
+        image,
+        2,
+        3,
+        200,
+        80,
+        ColorMode.HAS_24_BIT_COLOR,
+        Capability.NONE,
+        threads,
+        GlyphSet(glyph_set),
+    )
+    assert frame_data.getvalue() == expected
+    assert encode_rows.cache_info().hits == -(-HEIGHT // size)
+
+
+@pytest.mark.parametrize("threads", (1, 2))
+def test_streaming(threads: int) -> None:
+    image = random_frame(0)
+    chunks: list[bytes] = []
+    frame_data = FrameBuffer(0, lambda chunk: chunks.append(bytes(chunk)), 4096)
+    frame_data.append(b"\033[?2026h")
+    frame_data.blit(
+        image, None, 2, 3, 200, 80, ColorMode.HAS_24_BIT_COLOR, threads=threads
+    )
+    frame_data.append(b"\033[?2026l")
+    frame_data.close()
+    expected = FrameBuffer(0)
+    expected.blit(
+        image,
+        None,
+        2,
+        3,
+        200,
+        80,
+        ColorMode.HAS_24_BIT_COLOR,
+        threads=FrameBuffer.STREAM_BANDS,
+    )
+    # The chunks are sent while encoding, and end before an escape sequence
+    data = b"".join(chunks) + frame_data.getvalue()
+    assert data == b"\033[?2026h" + expected.getvalue() + b"\033[?2026l"
+    assert len(chunks) > 5
+    assert all(len(chunk) <= 4096 for chunk in chunks)
+    assert all(chunk.startswith(b"\033") for chunk in chunks)
+    assert bytes(frame_data.getvalue()).startswith(b"\033")
+    assert len(frame_data) == len(data)
+
+
+@pytest.mark.parametrize("scale", (1, 2, 3))
+def test_sixel_blit(scale: int) -> None:
+    palette = Palette()
+    image = random_frame(0)
+    indexed, last_indexed = np.empty((2, HEIGHT, WIDTH), np.uint8)
+    assert palette.index(image, indexed)
+    output = bytearray(max_sixel_size(HEIGHT, WIDTH, scale))
+    length = sixel_blit_into(indexed, None, palette.colors, 2, 3, scale, output)
+    header = f'\033[2;3H\033P0;1;0q"1;1;{WIDTH * scale};{HEIGHT * scale}#'
+    assert output[:length].startswith(header.encode())
+    assert output[:length].endswith(b"\033\\")
+    # Only the registers and the band of the changed pixel are printed
+    last_indexed[:] = indexed
+    assert (
+        sixel_blit_into(indexed, last_indexed, palette.colors, 2, 3, scale, output) == 0
+    )
+    color = int(indexed[100, 50]) ^ 1
+    indexed[100, 50] = color
+    length = sixel_blit_into(indexed, last_indexed, palette.colors, 2, 3, scale, output)
+    # The unchanged bands are skipped using graphics new lines
+    data = bytes(output[:length])
+    assert f"#{color};2;".encode() in data
+    assert data.count(b"-") == 100 * scale // 6
+    assert length < 200
+
+
+@pytest.mark.parametrize(
+    "glyph_set, glyph", ((1, "▙▜"), (2, "\U0001fb2c\U0001fb2c\U0001fb2c"))
+)
+def test_glyph_sets(glyph_set: int, glyph: str) -> None:
+    last = np.full((HEIGHT, WIDTH), 0xFF102030, np.uint32)
+    image = last.copy()
+    # Top-right pixel of a quadrant and bottom-left pixel of the next one,
+    # or bottom-left pixel of 3 sextants. The first color of a cell is the
+    # color of its top-left pixel.
+    if glyph_set == 1:
+        image[0, 1] = image[1, 2] = 0xFF405060
+    else:
+        image[2, 0:6:2] = 0xFF405060
+    assert blit(image, last, 2, 3, 200, 80, 4, 0, None, glyph_set) == (
+        b"\033[2;3H\033[38;2;16;32;48;48;2;64;80;96m" + glyph.encode() + b"\033[0m"
+    )
+    # Cells with more than two colors are printed using the closest colors
+    image[0, 0], image[1, 0] = 0xFF405062, 0xFFF0F0F0
+    encoded = blit(image, None, 2, 3, 200, 80, 4, 0, None, glyph_set)
+    assert b"64;80;98" not in encoded
+    assert len(encoded) < len(blit(image, None, 2, 3, 200, 80, 4)) * 0.6
+
+
+@pytest.mark.parametrize("scale", (2, 3))
+def test_upscaling(scale: int) -> None:
+    image, last = random_frame(0), random_frame(0)
+    last[100, 50] ^= 1
+    scaled_image, scaled_last = (
+        np.ascontiguousarray(np.repeat(np.repeat(frame, scale, 0), scale, 1))
+        for frame in (image, last)
+    )
+    assert blit(image, None, 2, 3, 1000, 500, 4, 1, scale=scale) == blit(
+        scaled_image, None, 2, 3, 1000, 500, 4, 1
+    )
+    assert blit(image, last, 2, 3, 1000, 500, 4, 1, scale=scale) == blit(
+        scaled_image, scaled_last, 2, 3, 1000, 500, 4, 1
+    )
+    # Horizontally duplicated cells are printed using REP
+    plain = blit(image, None, 2, 3, 1000, 500, 4, scale=scale)
+    assert len(blit(image, None, 2, 3, 1000, 500, 4, 1, scale=scale)) < len(plain)
+    output = bytearray(max_blit_size(HEIGHT, WIDTH, scale) - 1)
+    with pytest.raises(ValueError):
+        blit_into(image, None, 2, 3, 1000, 500, 4, output, scale=scale)
+
+
+def test_upscaling_buffers() -> None:
+    # The scratch buffers are shared by the frames of the same size, encoded
+    # one after the other or concurrently by several threads
+    frames = [(random_frame(i), random_frame(i + 1)) for i in range(4)]
+    frames += [(image[:64], last[:64]) for image, last in frames]
+    jobs = [
+        (image, last, glyph_set)
+        for image, last in frames
+        for glyph_set in (GlyphSet.HALF_BLOCKS, GlyphSet.SEXTANTS)
+    ]
+
+    def encode(
+        job: tuple[npt.NDArray[np.uint32], npt.NDArray[np.uint32], int]
+    ) -> bytes:
+        image, last, glyph_set = job
+        return blit(image, last, 2, 3, 1000, 500, 4, 1, glyph_set=glyph_set, scale=2)
+
+    expected = [encode(job) for job in jobs]
+    assert [encode(job) for job in reversed(jobs)] == expected[::-1]
+    with ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(encode, jobs * 4)) == expected * 4
+
+
+def test_perceptual_filter() -> None:
+    displayed = random_frame(0)
+    image = displayed.copy()
+    image[0, :10] ^= 0x010101
+    image[1, :10] ^= 0x808080
+    changed = image.copy()
+    assert not perceptual_filter(image, displayed, 3.0)
+    assert (image[0] == displayed[0]).all()
+    assert (image[1:] == changed[1:]).all()
+    # Scene changes are kept as is
+    image = random_frame(1)
+    changed = image.copy()
+    assert perceptual_filter(image, displayed, 3.0)
+    assert (image == changed).all()
+
+
+def test_lossy_filter() -> None:
+    lossy_filter = LossyFilter(3.0, (HEIGHT, WIDTH))
+    lossy_filter.commit(random_frame(0))
+    # A slow fade is printed by steps, without accumulating the error
+    printed = []
+    for step in range(1, 9):
+        image = random_frame(0) - np.uint32(0x010101 * step)
+        lossy_filter.apply(image)
+        printed.append(not is_unchanged(image, lossy_filter.displayed))
+        lossy_filter.commit(image)
+        assert (lossy_filter.displayed == image).all()
+    assert 0 < sum(printed) < len(printed)
+    # Static screens settle to their exact colors
+    for _ in range(LossyFilter.SETTLE_FRAMES):
+        image = random_frame(0) - np.uint32(0x010101 * 9)
+        lossy_filter.apply(image)
+    assert (image == random_frame(0) - np.uint32(0x010101 * 9)).all()
+
+
+@pytest.mark.parametrize("glyph_set", (0, 1, 2))
+def test_interlace(glyph_set: int) -> None:
+    image, last = random_frame(0), random_frame(1)
+    group = 3 if glyph_set == 2 else 2
+    plain = blit(image, last, 2, 3, 200, 80, 4, 0, None, glyph_set)
+    # Both fields together update the whole image, by groups of cell rows
+    for field in (0, 1):
+        interlaced = image.copy()
+        interlace(interlaced, last, field, group)
+        fields = np.arange(HEIGHT) // group % 2 == field
+        assert (interlaced[fields] == image[fields]).all()
+        assert (interlaced[~fields] == last[~fields]).all()
+        encoded = blit(interlaced, last, 2, 3, 200, 80, 4, 0, None, glyph_set)
+        assert len(encoded) < len(plain) * 0.6
+
+
+def test_deflicker() -> None:
+    deflicker = Deflicker((HEIGHT, WIDTH))
+    background = np.full((HEIGHT, WIDTH), 0xFF000000, np.uint32)
+    # A sprite blinking on every other frame, and another one moving
+    sprite = background.copy()
+    sprite[8:16, 16:24] = 0xFF2040FF
+    outputs = []
+    for i in range(6):
+        image = sprite.copy() if i % 2 else background.copy()
+        image[32:40, 8 * i : 8 * i + 8] = 0xFFFFFFFF
+        outputs.append(deflicker.apply(image).copy())
+    assert (outputs[3][8:16, 16:24] == 0xFF102080).all()
+    for before, after in zip(outputs[3:], outputs[4:]):
+        assert (before[:16] == after[:16]).all()
+    assert (outputs[-1][32:40, 40:48] == 0xFFFFFFFF).all()
+    assert (outputs[-1][32:40, :40] == 0xFF000000).all()
+    # The tile is printed as is once it stops blinking
+    assert (deflicker.apply(sprite) == sprite).all()
+    assert (deflicker.apply(sprite) == sprite).all()
+
+
+def test_rectangle_fill() -> None:
+    last = random_frame(0)
+    image = np.full((HEIGHT, WIDTH), 0xFF102030, np.uint32)
+    image[40:50, 60:70] = 0xFF405060
+    plain = blit(image, last, 2, 3, 200, 80, 4, 3)
+    encoded = blit(image, last, 2, 3, 200, 80, 4, 11)
+    assert len(encoded) < len(plain) // 5
+    # The blank areas above, left of, inside, right of and below the square
+    assert encoded == (
+        b"\033[48;2;16;32;48m\033[32;2;3;21;162$x\033[32;22;3;73;62$x"
+        b"\033[48;2;64;80;96m\033[32;22;63;26;72$x"
+        b"\033[48;2;16;32;48m\033[32;22;73;73;162$x\033[32;27;63;73;72$x\033[0m"
+    )
+
+
+def test_cursor_state() -> None:
+    last = random_frame(0)
+    image = last.copy()
+    image[100:102, 50:60] = 0xFF102030
+    state = np.array(UNKNOWN_CURSOR, np.int64)
+    # The colors are not reset at the end of the frame when the state is kept
+    encoded = blit(image, last, 2, 3, 200, 80, 4, state=state)
+    assert encoded == b"\033[52;53H\033[48;2;16;32;48m" + b" " * 10
+    assert state[3] == 0xFF102030
+    # The next frame starts from the position and colors left by the previous one
+    new_image = image.copy()
+    new_image[100:102, 60:64] = 0xFF102030
+    band_state = state.copy()
+    assert blit(new_image, image, 2, 3, 200, 80, 4, state=state) == b" " * 4
+    # Only the first band starts from the state, which is left by the last one
+    frame_data = FrameBuffer(0)
+    frame_data.blit(
+        new_image,
+        image,
+        2,
+        3,
+        200,
+        80,
+        ColorMode.HAS_24_BIT_COLOR,
+        threads=2,
+        state=band_state,
+    )
+    assert bytes(frame_data.getvalue()).endswith(b" " * 4)
+    assert (band_state == state).all()
+    # The colors are kept as RGB colors, since the palette indices may change
+    palette = Palette()
+    indexed, last_indexed = np.empty((2, HEIGHT, WIDTH), np.uint8)
+    assert palette.index(image, last_indexed)
+    palette.commit()
+    assert palette.index(new_image, indexed)
+    state[:] = (52, 63, 0x100, 0xFF102030)
+    encoded = blit(
+        indexed, last_indexed, 2, 3, 200, 80, 4, palette=palette.colors, state=state
+    )
+    assert encoded == b" " * 4
+    assert state[3] == 0xFF102030
+
+
+def test_terminal_state() -> None:
+    terminal_state = TerminalState()
+    frame_data = FrameBuffer(0)
+    # Frames are wrapped in synchronized output
+    terminal_state.begin_frame(frame_data, b"")
+    frame_data.blit(
+        random_frame(0),
+        None,
+        2,
+        3,
+        200,
+        80,
+        ColorMode.HAS_24_BIT_COLOR,
+        state=terminal_state.cursor,
+    )
+    terminal_state.end_frame(frame_data, incremental=False)
+    assert bytes(frame_data.getvalue()).startswith(b"\033[?2026h\033[2;9H")
+    assert bytes(frame_data.getvalue()).endswith(b"\033[?2026l")
+    # Including the small incremental frames, that may still be split
+    frame_data.clear()
+    terminal_state.begin_frame(frame_data, b"")
+    frame_data.append(b"  ")
+    terminal_state.end_frame(frame_data, incremental=True)
+    assert bytes(frame_data.getvalue()) == b"\033[?2026h  \033[?2026l"
+    # But not the incremental frames changing nothing but the title, which is
+    # only sent when it changes
+    for expected in (b"title", b"", b""):
+        frame_data.clear()
+        terminal_state.begin_frame(frame_data, b"")
+        terminal_state.set_title(frame_data, b"title")
+        terminal_state.end_frame(frame_data, incremental=True)
+        assert bytes(frame_data.getvalue()) == expected
+    # The colors are reset before clearing the screen, and after the last frame
+    frame_data.clear()
+    terminal_state.begin_frame(frame_data, b"\033[2J")
+    assert bytes(frame_data.getvalue()) == b"\033[?2026h\033[0m\033[2J"
+    assert terminal_state.reset() == b""
+    assert terminal_state.counters["title"] == 5
+    assert terminal_state.counters["sync"] == 40
+    assert 0 < terminal_state.overhead() < 0.01
+
+
+class FrameConsole(Console):
+    """Console showing the given frames."""
+
+    WIDTH, HEIGHT = WIDTH, HEIGHT
+    FPS = 60.0
+    TICKS_IN_FRAME = 1
+
+    def __init__(self, frames: list[np.ndarray]) -> None:
+        self.romfile = "frames.gb"
+        self.frames = iter(frames)
+
+    def advance_one_frame(
+        self, video: np.ndarray, audio: np.ndarray
+    ) -> tuple[int, int]:
+        video[:] = next(self.frames)
+        return 1, self.TICKS_IN_FRAME
+
+
+class NoInput(BaseInputGetter):
+    def get_pressed(self) -> set[Console.Input]:
+        return set()
+
+    def pop_keystrokes(self) -> list:  # type: ignore[type-arg]
+        return []
+
+
+def test_palette_overflow(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    overflow = rng.integers(0, 1 << 24, (HEIGHT, WIDTH), dtype=np.uint32)
+    frames = [random_frame(0), overflow | np.uint32(0xFF000000), random_frame(1)]
+    console = FrameConsole(frames)
+    with open(tmp_path / "output", "w") as stream:
+        terminal = Terminal(kind="xterm-256color", stream=stream, force_styling=None)
+        run(
+            console,
+            NoInput(console, terminal),
+            terminal,
+            color_mode=ColorMode.HAS_PALETTE_COLOR,
+            break_after=len(frames),
+        )
+    output = (tmp_path / "output").read_bytes()
+    first, second, third = output.split(b"\033[?2026h")[1:]
+    assert b"\033]4;16;" in first
+    # The frame with too many colors is printed using the standard 256 colors,
+    # and the next frame redefines them
+    assert second.startswith(b"\033]104;" + b";".join(b"%d" % i for i in range(16, 24)))
+    assert third.count(b"\033]4;") == 8
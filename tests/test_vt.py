@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from typing import Iterator
+
+import numpy as np
+import pytest
+
+from benchmark import CAPABILITIES, TERMINAL_SIZES, load_corpus
+from gambaterm.capabilities import Capability
+from gambaterm.colors import ColorMode
+from gambaterm.console import GameboyColor
+from gambaterm.renderers import GlyphSet
+from gambaterm.run import UNKNOWN_CURSOR, Palette, get_palette_size, get_ref
+from gambaterm.termblit import blit, quantize
+from vt import (
+    DEFAULT_COLOR,
+    INDEXED_COLOR,
+    RGB_COLOR,
+    UnsupportedSequence,
+    VirtualTerminal,
+    check_frame,
+)
+
+
+def test_virtual_terminal() -> None:
+    terminal = VirtualTerminal(4, 10)
+    terminal.feed(b"\033[2;3H\033[38;2;1;2;3;41m\xe2\x96\x80\033[3b\033[2D\033[X")
+    assert terminal.characters[1, 2:7].tolist() == [0x2580, 0x2580, 0x20, 0x2580, 0x20]
+    assert terminal.foregrounds[1, 2] == RGB_COLOR | 0x010203
+    assert terminal.backgrounds[1, 2:6].tolist() == [INDEXED_COLOR | 1] * 4
+    assert (terminal.row, terminal.column) == (1, 4)
+    # Scrolling regions, exposing blank rows in the current background color
+    terminal.feed(b"\033[0m\033[2;3r\033[1T\033[r")
+    assert terminal.characters[2, 2] == 0x2580
+    assert (terminal.backgrounds[1] == DEFAULT_COLOR).all()
+    assert (terminal.row, terminal.column) == (0, 0)
+    # Sequence types are counted along with their size
+    terminal.feed(b"\033[?2026h\r\n\033[?2026l")
+    assert terminal.counts["SGR"] == 2
+    assert terminal.costs["SGR"] == len(b"\033[38;2;1;2;3;41m\033[0m")
+    assert terminal.costs["TEXT"] == 3
+    assert terminal.counts["DECSET"] == terminal.counts["DECRST"] == 1
+    assert not terminal.synchronized
+    with pytest.raises(UnsupportedSequence):
+        terminal.feed(b"\033[?25l")
+    with pytest.raises(UnsupportedSequence):
+        terminal.feed(b"\033[1;8H" + b" " * 4)
+
+
+def encode_scene(
+    frames: np.ndarray,
+    color_mode: ColorMode,
+    width: int,
+    height: int,
+    capabilities: Capability,
+    glyph_set: GlyphSet,
+) -> Iterator[tuple[np.ndarray, np.ndarray, bytes]]:
+    """Encode the frames of a scene as `run` does, starting with a full redraw, and
+    yield the indexed frames with their palette and output."""
+    refx, refy = get_ref(width, height, GameboyColor, glyph_set)  # type: ignore
+    palette = Palette()
+    palette.size = get_palette_size(color_mode)
+    state = np.array(UNKNOWN_CURSOR, np.int64)
+    quantized = np.empty_like(frames[0])
+    indexed, last_indexed = np.zeros((2, *frames[0].shape), np.uint8)
+    for index, frame in enumerate(frames):
+        quantize(frame, color_mode, quantized)
+        assert palette.index(quantized, indexed)
+        data = blit(
+            indexed,
+            last_indexed if index else None,
+            refx,
+            refy,
+            width - 1,
+            height,
+            color_mode,
+            capabilities,
+            palette.colors,
+            glyph_set,
+            state=state,
+        )
+        yield indexed, palette.colors, data
+        palette.commit()
+        indexed, last_indexed = last_indexed, indexed
+
+
+@pytest.mark.parametrize("glyph_set", list(GlyphSet))
+@pytest.mark.parametrize(
+    "capabilities",
+    # All the sequences, or none of the optional ones
+    (Capability.NONE, CAPABILITIES | Capability.RECTANGLES),
+    ids=("none", "all"),
+)
+def test_corpus_output(capabilities: Capability, glyph_set: GlyphSet) -> None:
+    corpus = load_corpus()
+    for color_mode in ColorMode:
+        if color_mode == ColorMode.COULD_NOT_DETECT:
+            continue
+        for width, height in TERMINAL_SIZES:
+            refx, refy = get_ref(width, height, GameboyColor, glyph_set)  # type: ignore
+            for name, frames in corpus.items():
+                terminal = VirtualTerminal(height, width)
+                scene = encode_scene(
+                    frames, color_mode, width, height, capabilities, glyph_set
+                )
+                for index, (indexed, colors, data) in enumerate(scene):
+                    terminal.feed(data)
+                    errors = check_frame(
+                        terminal,
+                        indexed,
+                        refx,
+                        refy,
+                        width - 1,
+                        height,
+                        color_mode,
+                        glyph_set,
+                        colors,
+                    )
+                    assert errors == [], (color_mode, width, name, index)
+                # Nothing is printed out of the image area
+                assert (terminal.characters[: refx - 1] == 0x20).all()
+                assert (terminal.characters[:, : refy - 1] == 0x20).all()
@@ -0,0 +1,371 @@
+"""In-process model of a terminal, applying the escape sequences emitted by the
+video encoder to a grid of cells.
+
+It is used to check that the encoded frames produce the expected screen, and to
+measure the cost of each type of sequence. Only the subset emitted by gambaterm is
+supported, any other sequence being rejected.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Any
+from collections import Counter
+
+import numpy as np
+import numpy.typing as npt
+
+from gambaterm.colors import ColorMode
+from gambaterm.renderers import GlyphSet
+
+# Cell colors: default, indexed (standard and 256 colors) or RGB (true colors)
+DEFAULT_COLOR = -1
+INDEXED_COLOR = 1 << 32
+RGB_COLOR = 0xFF000000
+
+# Terminal colors used for the palette entries, in the palette color mode
+PALETTE_FIRST_COLOR = 16
+
+TOKEN = re.compile(
+    r"(?P<csi>\x1b\[(?P<private>\??)(?P<params>[0-9;]*)(?P<final>\$?[@-~]))"
+    r"|(?P<osc>\x1b\][^\x07\x1b]*(?:\x07|\x1b\\))"
+    r"|(?P<control>[\r\n\b])"
+    r"|(?P<text>[^\x00-\x1f\x7f]+)"
+)
+
+SEQUENCE_NAMES = {
+    "A": "CUU",
+    "B": "CUD",
+    "C": "CUF",
+    "D": "CUB",
+    "H": "CUP",
+    "m": "SGR",
+    "b": "REP",
+    "X": "ECH",
+    "K": "EL",
+    "r": "DECSTBM",
+    "S": "SU",
+    "T": "SD",
+    "$x": "DECFRA",
+    "?h": "DECSET",
+    "?l": "DECRST",
+    "\r": "CR",
+    "\n": "LF",
+    "\b": "BS",
+}
+
+# Synchronized output mode
+SYNCHRONIZED_OUTPUT = 2026
+
+
+class UnsupportedSequence(ValueError):
+    pass
+
+
+def glyph_masks(glyph_set: GlyphSet) -> dict[int, int]:
+    """Return the masks of the pixels printed in the foreground color by each
+    glyph, the pixels of a cell being numbered in raster order."""
+    if glyph_set == GlyphSet.HALF_BLOCKS:
+        return {0x20: 0, 0x2580: 1, 0x2584: 2, 0x2588: 3}
+    if glyph_set == GlyphSet.QUADRANTS:
+        codepoints = "▘▝▀▖▌▞▛▗▚▐▜▄▙▟█"
+        return {0x20: 0, **{ord(c): mask for mask, c in enumerate(codepoints, 1)}}
+    # Sextants are in the mask order, without the half and full blocks
+    masks = {0x20: 0, 0x258C: 21, 0x2590: 42, 0x2588: 63}
+    for mask in range(1, 63):
+        if mask not in (21, 42):
+            masks[0x1FB00 + (mask - 1) - (mask > 21) - (mask > 42)] = mask
+    return masks
+
+
+class VirtualTerminal:
+    """Grid of cells, each holding a character along with its foreground and
+    background colors. The cursor position is 0-based.
+
+    The rows are stored as lists, which is faster than arrays for the short runs
+    of characters printed by the encoder.
+    """
+
+    def __init__(self, height: int, width: int) -> None:
+        self.height, self.width = height, width
+        self.lines = [[" "] * width for _ in range(height)]
+        self.line_foregrounds = [[DEFAULT_COLOR] * width for _ in range(height)]
+        self.line_backgrounds = [[DEFAULT_COLOR] * width for _ in range(height)]
+        self.row = self.column = 0
+        self.foreground = self.background = DEFAULT_COLOR
+        self.top, self.bottom = 0, height
+        self.last_character = " "
+        self.synchronized = False
+        # Number and size of the sequences of each type
+        self.counts: Counter[str] = Counter()
+        self.costs: Counter[str] = Counter()
+
+    @property
+    def characters(self) -> npt.NDArray[np.uint32]:
+        return np.array(self.lines, dtype="U1").view(np.uint32)
+
+    @property
+    def foregrounds(self) -> npt.NDArray[np.int64]:
+        return np.array(self.line_foregrounds, np.int64)
+
+    @property
+    def backgrounds(self) -> npt.NDArray[np.int64]:
+        return np.array(self.line_backgrounds, np.int64)
+
+    def feed(self, data: bytes | bytearray | memoryview) -> None:
+        data = bytes(data)
+        text = data.decode()
+        counts, costs = self.counts, self.costs
+        position = 0
+        # The characters are counted at the end, as the remaining bytes
+        control_size = 0
+        for match in TOKEN.finditer(text):
+            start, position_after = match.span()
+            if start != position:
+                raise UnsupportedSequence(repr(text[position:start]))
+            position = position_after
+            kind = match.lastgroup
+            if kind == "text":
+                self.write(match[0])
+                counts["TEXT"] += 1
+                continue
+            if kind == "control":
+                name = SEQUENCE_NAMES[match[0]]
+                self.control(match[0])
+            elif kind == "osc":
+                name = "OSC"
+            else:
+                private, final = match["private"], match["final"]
+                name = SEQUENCE_NAMES.get(private + final, "")
+                self.csi(private, match["params"], final)
+            counts[name] += 1
+            costs[name] += position - start
+            control_size += position - start
+        if position != len(text):
+            raise UnsupportedSequence(repr(text[position:]))
+        costs["TEXT"] += len(data) - control_size
+
+    def write(self, text: str) -> None:
+        column, stop = self.column, self.column + len(text)
+        if stop > self.width:
+            raise UnsupportedSequence(f"Line wrap at row {self.row}")
+        self.lines[self.row][column:stop] = text
+        self.line_foregrounds[self.row][column:stop] = [self.foreground] * len(text)
+        self.line_backgrounds[self.row][column:stop] = [self.background] * len(text)
+        self.column = stop
+        self.last_character = text[-1]
+
+    def erase(self, row: int, start: int, stop: int) -> None:
+        # Erased cells use the current background color (back color erase)
+        stop = max(start, stop)
+        self.lines[row][start:stop] = " " * (stop - start)
+        self.line_foregrounds[row][start:stop] = [DEFAULT_COLOR] * (stop - start)
+        self.line_backgrounds[row][start:stop] = [self.background] * (stop - start)
+
+    def scroll(self, count: int) -> None:
+        """Scroll the rows of the scrolling region up (or down if negative)."""
+        top, bottom = self.top, self.bottom
+        count = max(-(bottom - top), min(bottom - top, count))
+        grids: tuple[list[list[Any]], ...] = (
+            self.lines,
+            self.line_foregrounds,
+            self.line_backgrounds,
+        )
+        for lines in grids:
+            if count > 0:
+                lines[top : bottom - count] = lines[top + count : bottom]
+            elif count < 0:
+                lines[top - count : bottom] = lines[top : bottom + count]
+        exposed = (
+            range(bottom - count, bottom) if count > 0 else range(top, top - count)
+        )
+        for row in exposed:
+            self.lines[row] = [" "] * self.width
+            self.line_foregrounds[row] = [DEFAULT_COLOR] * self.width
+            self.line_backgrounds[row] = [self.background] * self.width
+
+    def control(self, character: str) -> None:
+        if character == "\r":
+            self.column = 0
+        elif character == "\b":
+            self.column = max(0, self.column - 1)
+        elif self.row == self.bottom - 1:
+            self.scroll(1)
+        else:
+            self.row = min(self.height - 1, self.row + 1)
+
+    def csi(self, private: str, params: str, final: str) -> None:
+        args = [int(arg) if arg else 0 for arg in params.split(";")] if params else []
+        first = args[0] if args else 0
+        count = max(1, first)
+        if private:
+            if args != [SYNCHRONIZED_OUTPUT] or final not in "hl":
+                raise UnsupportedSequence(f"DEC private mode {params}{final}")
+            self.synchronized = final == "h"
+        elif final == "A":
+            self.row = max(self.top if self.row >= self.top else 0, self.row - count)
+        elif final == "B":
+            limit = self.bottom if self.row < self.bottom else self.height
+            self.row = min(limit - 1, self.row + count)
+        elif final == "C":
+            self.column = min(self.width - 1, self.column + count)
+        elif final == "D":
+            self.column = max(0, self.column - count)
+        elif final == "H":
+            row, column = (args + [1, 1])[:2]
+            self.row = min(self.height, max(1, row)) - 1
+            self.column = min(self.width, max(1, column)) - 1
+        elif final == "m":
+            self.select_graphic_rendition(args or [0])
+        elif final == "b":
+            self.write(self.last_character * count)
+        elif final == "X":
+            self.erase(self.row, self.column, min(self.width, self.column + count))
+        elif final == "K":
+            if first == 0:
+                self.erase(self.row, self.column, self.width)
+            elif first == 1:
+                self.erase(self.row, 0, self.column + 1)
+            else:
+                self.erase(self.row, 0, self.width)
+        elif final == "r":
+            top, bottom = (args + [0, 0])[:2]
+            self.top = max(1, top) - 1
+            self.bottom = bottom if bottom else self.height
+            self.row = self.column = 0
+        elif final == "S":
+            self.scroll(count)
+        elif final == "T":
+            self.scroll(-count)
+        elif final == "$x":
+            character, top, left, bottom, right = args
+            for row in range(top - 1, bottom):
+                self.erase(row, left - 1, right)
+                self.lines[row][left - 1 : right] = chr(character) * (right - left + 1)
+        else:
+            raise UnsupportedSequence(f"CSI {private}{params}{final}")
+
+    def select_graphic_rendition(self, args: list[int]) -> None:
+        index = 0
+        while index < len(args):
+            arg = args[index]
+            if arg == 0:
+                self.foreground = self.background = DEFAULT_COLOR
+            elif arg in (38, 48):
+                if args[index + 1] == 5:
+                    color = INDEXED_COLOR | args[index + 2]
+                    index += 2
+                else:
+                    r, g, b = args[index + 2 : index + 5]
+                    color = RGB_COLOR | (r << 16) | (g << 8) | b
+                    index += 4
+                if arg == 38:
+                    self.foreground = color
+                else:
+                    self.background = color
+            elif 30 <= arg <= 37 or 90 <= arg <= 97:
+                self.foreground = INDEXED_COLOR | (arg % 10 + 8 * (arg >= 90))
+            elif 40 <= arg <= 47 or 100 <= arg <= 107:
+                self.background = INDEXED_COLOR | (arg % 10 + 8 * (arg >= 100))
+            elif arg == 39:
+                self.foreground = DEFAULT_COLOR
+            elif arg == 49:
+                self.background = DEFAULT_COLOR
+            else:
+                raise UnsupportedSequence(f"SGR {arg}")
+            index += 1
+
+    def pixels(
+        self,
+        top: int,
+        left: int,
+        rows: int,
+        columns: int,
+        glyph_set: GlyphSet = GlyphSet.HALF_BLOCKS,
+    ) -> npt.NDArray[np.int64]:
+        """Return the colors of the pixels printed in an area of cells."""
+        masks = glyph_masks(glyph_set)
+        area = np.s_[top : top + rows, left : left + columns]
+        characters = self.characters[area]
+        foregrounds, backgrounds = self.foregrounds[area], self.backgrounds[area]
+        cell_masks = np.zeros(characters.shape, np.int64)
+        for character in np.unique(characters):
+            if int(character) not in masks:
+                raise UnsupportedSequence(f"Unexpected character {chr(character)!r}")
+            cell_masks[characters == character] = masks[int(character)]
+        height, width = glyph_set.cell_height, glyph_set.cell_width
+        result = np.empty((rows * height, columns * width), np.int64)
+        for i in range(height):
+            for j in range(width):
+                foreground = (cell_masks >> (i * width + j)) & 1 == 1
+                result[i::height, j::width] = np.where(
+                    foreground, foregrounds, backgrounds
+                )
+        return result
+
+
+def check_frame(
+    terminal: VirtualTerminal,
+    image: npt.NDArray[np.uint32] | npt.NDArray[np.uint8],
+    refx: int,
+    refy: int,
+    width: int,
+    height: int,
+    color_mode: ColorMode,
+    glyph_set: GlyphSet = GlyphSet.HALF_BLOCKS,
+    palette: npt.NDArray[np.uint32] | None = None,
+) -> list[str]:
+    """Return the differences between the screen and the frame printed by `blit`
+    with the same arguments.
+
+    The true colors must match the RGB colors of the pixels, and the palette colors
+    their palette entries. In the other modes, the colors of the terminal only have
+    to be consistent, the same pixel color always being printed the same way. The
+    cells using more than two colors are skipped, since the sub-cell glyph sets
+    approximate them.
+    """
+    cell_height, cell_width = glyph_set.cell_height, glyph_set.cell_width
+    rows = min(height - refx, image.shape[0] // cell_height)
+    columns = min(width - refy, image.shape[1] // cell_width)
+    if rows <= 0 or columns <= 0:
+        return []
+    values = image[: rows * cell_height, : columns * cell_width].astype(np.int64)
+    if color_mode == ColorMode.HAS_PALETTE_COLOR:
+        assert palette is not None
+        expected = INDEXED_COLOR | (PALETTE_FIRST_COLOR + values)
+    elif palette is not None:
+        expected = palette[values].astype(np.int64)
+    else:
+        expected = values
+    actual = terminal.pixels(refx - 1, refy - 1, rows, columns, glyph_set)
+    errors = []
+    if terminal.synchronized:
+        errors.append("Synchronized output left enabled")
+    if (actual == DEFAULT_COLOR).any():
+        errors.append(f"{(actual == DEFAULT_COLOR).sum()} pixels in default colors")
+
+    # Skip the cells using more than two colors
+    cells = (
+        values.reshape(rows, cell_height, columns, cell_width)
+        .swapaxes(1, 2)
+        .reshape(rows, columns, cell_height * cell_width)
+    )
+    low = cells.min(axis=2, keepdims=True)
+    high = cells.max(axis=2, keepdims=True)
+    two_colors = ((cells == low) | (cells == high)).all(axis=2)
+    exact = np.repeat(np.repeat(two_colors, cell_height, 0), cell_width, 1)
+    values, expected, actual = values[exact], expected[exact], actual[exact]
+
+    # Exact colors, or a consistent mapping from the pixel colors
+    if color_mode in (ColorMode.HAS_24_BIT_COLOR, ColorMode.HAS_PALETTE_COLOR):
+        if mismatches := int((expected != actual).sum()):
+            errors.append(f"{mismatches} pixels in the wrong color")
+        return errors
+    # Map each pixel value to the color printed for its first occurrence
+    if palette is None:
+        values = np.unique(values, return_inverse=True)[1]
+    first = np.zeros(int(values.max(initial=0)) + 1, np.int64)
+    first[values[::-1]] = actual[::-1]
+    if inconsistent := len(np.unique(values[first[values] != actual])):
+        errors.append(f"{inconsistent} colors printed inconsistently")
+    return errors